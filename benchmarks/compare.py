@@ -0,0 +1,90 @@
+"""Run the same load test against two commits and print the per-method difference.
+
+Usage: python -m benchmarks.compare <base-commit> <new-commit> [loadtest options]
+
+Each commit is checked out into a temporary git worktree and served with uvicorn on --port, using the
+current environment (database, S3_ENDPOINT_URL, ...). Seed the database once beforehand with benchmarks.seed.
+Rate and concurrency limits are turned off for the servers unless RATE_LIMITS or CONCURRENCY_LIMITS is set.
+"""
+import argparse
+import asyncio
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchmarks import loadtest
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+# A few hundred simulated clients share one address and a handful of users; the default limits would measure 429s.
+UNLIMITED = {'RATE_LIMITS': '{"default": [0, 0]}', 'CONCURRENCY_LIMITS': '{}'}
+
+
+def wait_until_ready(url: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f'{url}/openapi.json').status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f'server at {url} did not start')
+
+
+def benchmark_commit(commit: str, port: int, args):
+    workdir = pathlib.Path(tempfile.mkdtemp(prefix='urfube-bench-'))
+    subprocess.run(['git', 'worktree', 'add', '--detach', str(workdir), commit], cwd=ROOT, check=True)
+    env_file = ROOT / 'urfube' / '.env'
+    if env_file.exists():
+        shutil.copy(env_file, workdir / 'urfube' / '.env')
+    server = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'urfube.app:app', '--port', str(port),
+                               '--no-access-log'], cwd=workdir, env=UNLIMITED | os.environ)
+    url = f'http://127.0.0.1:{port}'
+    try:
+        wait_until_ready(url)
+        return asyncio.run(loadtest.run(url, args.scenario or list(loadtest.SCENARIOS), args.duration,
+                                        args.concurrency, args.users, args.videos, args.seed))
+    finally:
+        server.terminate()
+        server.wait()
+        subprocess.run(['git', 'worktree', 'remove', '--force', str(workdir)], cwd=ROOT, check=True)
+
+
+def change(base: float, new: float):
+    return f'{(new - base) / base * 100:+.1f}%' if base else 'n/a'
+
+
+def print_comparison(base: dict, new: dict):
+    for scenario, methods in new.items():
+        print(f'\n{scenario}')
+        print(f'  {"method":<28}{"rps":>18}{"p50 ms":>22}{"p95 ms":>22}{"p99 ms":>22}')
+        for method, row in methods.items():
+            old = base.get(scenario, {}).get(method)
+            if old is None:
+                continue
+            cells = [f'{old[key]}->{row[key]} ({change(old[key], row[key])})'
+                     for key in ('rps', 'p50_ms', 'p95_ms', 'p99_ms')]
+            print(f'  {method:<28}' + ''.join(f'{cell:>22}' for cell in cells))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('base')
+    parser.add_argument('new')
+    parser.add_argument('--port', type=int, default=5055)
+    loadtest.add_arguments(parser)
+    args = parser.parse_args()
+
+    base = benchmark_commit(args.base, args.port, args)
+    new = benchmark_commit(args.new, args.port, args)
+    print_comparison(base, new)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+"""Drive a running server with scripted scenarios and report throughput and latency percentiles per method.
+
+Usage: python -m benchmarks.loadtest --url http://127.0.0.1:5000 [--scenario feed_browse ...]
+                                     [--duration 30] [--concurrency 20] [--output result.json]
+
+Expects a database filled by benchmarks.seed (with matching --users/--videos) and, for the upload
+scenario, an app pointed at benchmarks.s3_stub. Start that app with RATE_LIMITS='{"default": [0, 0]}' and
+CONCURRENCY_LIMITS='{}', or the default admission limits reject much of the load.
+"""
+import argparse
+import asyncio
+import functools
+import io
+import json
+import random
+import statistics
+import time
+from collections import defaultdict
+
+import httpx
+from PIL import Image
+
+PASSWORD = 'benchmark'
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def report(self, duration: float):
+        report = {}
+        for method, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+            report[method] = {'requests': len(latencies), 'errors': self.errors[method],
+                              'rps': round(len(latencies) / duration, 2),
+                              'p50_ms': round(quantiles[49] * 1000, 2), 'p95_ms': round(quantiles[94] * 1000, 2),
+                              'p99_ms': round(quantiles[98] * 1000, 2)}
+        return report
+
+
+class Session:
+    def __init__(self, client: httpx.AsyncClient, recorder: Recorder, rng: random.Random, users: int, videos: int):
+        self.client = client
+        self.recorder = recorder
+        self.rng = rng
+        self.users = users
+        self.videos = videos
+        self.token = None
+
+    def random_user(self):
+        return f'user{self.rng.randint(1, self.users)}'
+
+    def random_video(self):
+        return self.rng.randint(1, self.videos)
+
+    async def timed(self, name: str, request):
+        start = time.perf_counter()
+        try:
+            response = await request
+            content = response.json() if response.headers.get('content-type') == 'application/json' else None
+            # The REST upload answers its errors with a bare JSON string and a 200, so any string body is one.
+            failed = response.status_code >= 400 or isinstance(content, str) or \
+                (isinstance(content, dict) and 'error' in content)
+        except httpx.HTTPError:
+            response, failed = None, True
+        self.recorder.latencies[name].append(time.perf_counter() - start)
+        if failed:
+            self.recorder.errors[name] += 1
+        return response
+
+    async def call(self, method: str, params: dict, auth: bool = False):
+        headers = {'User-Auth-Token': await self.login()} if auth else {}
+        body = {'jsonrpc': '2.0', 'id': 0, 'method': method, 'params': params}
+        response = await self.timed(method, self.client.post('/api', json=body, headers=headers))
+        if response is not None and response.status_code == 200:
+            return response.json().get('result')
+
+    async def login(self, force: bool = False):
+        if self.token is None or force:
+            body = {'jsonrpc': '2.0', 'id': 0, 'method': 'login',
+                    'params': {'user': {'username': self.random_user(), 'password': PASSWORD}}}
+            response = await self.timed('login', self.client.post('/api', json=body))
+            result = response.json().get('result') if response is not None else None
+            self.token = result['access_token'] if result else None
+        return self.token
+
+
+async def feed_browse(session: Session):
+    await session.call('get_videos', {})
+    await session.call('get_subscription_videos', {}, auth=True)
+
+
+async def video_page(session: Session):
+    video_id = session.random_video()
+    info = await session.call('get_video_info', {'video_id': video_id})
+    await session.call('generate_video_link', {'video_id': video_id})
+    await session.call('get_comments', {'video_id': video_id})
+    await session.call('get_likes', {'video_id': video_id})
+    await session.call('post_view', {'video_id': video_id}, auth=True)
+    if info is not None:
+        await session.call('get_channel_info', {'channel': info['author']})
+
+
+async def login_storm(session: Session):
+    await session.login(force=True)
+
+
+async def heartbeat_flood(session: Session):
+    video_id = session.random_video()
+    for second in range(0, 50, 5):
+        await session.call('add_or_update_history',
+                           {'video': {'video_id': video_id, 'timestamp': second, 'length': 600}}, auth=True)
+
+
+@functools.cache
+def thumbnail() -> bytes:
+    # Thumbnails are decoded on upload, so this has to be a real image.
+    buffer = io.BytesIO()
+    Image.new('RGB', (1280, 720), (32, 96, 160)).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+async def upload(session: Session):
+    headers = {'User-Auth-Token': await session.login()}
+    title = f'upload {session.rng.getrandbits(64):x}'
+    files = {'video_file': ('video.mp4', b'\0' * 256 * 1024, 'video/mp4'),
+             'image_file': ('image.jpg', thumbnail(), 'image/jpeg')}
+    await session.timed('upload_video', session.client.post(
+        '/upload_video/', params={'video_title': title, 'video_description': 'load test'}, files=files,
+        headers=headers))
+
+
+SCENARIOS = {
+    'feed_browse': feed_browse,
+    'video_page': video_page,
+    'login_storm': login_storm,
+    'heartbeat_flood': heartbeat_flood,
+    'upload': upload,
+}
+
+
+async def worker(session: Session, scenario, deadline: float):
+    while time.perf_counter() < deadline:
+        await scenario(session)
+
+
+async def run(url: str, scenario_names, duration: float, concurrency: int, users: int, videos: int, seed: int):
+    results = {}
+    async with httpx.AsyncClient(base_url=url, timeout=60) as client:
+        for name in scenario_names:
+            recorder = Recorder()
+            sessions = [Session(client, recorder, random.Random(seed + i), users, videos) for i in range(concurrency)]
+            start = time.perf_counter()
+            await asyncio.gather(*(worker(session, SCENARIOS[name], start + duration) for session in sessions))
+            results[name] = recorder.report(time.perf_counter() - start)
+    return results
+
+
+def print_report(results: dict):
+    for scenario, methods in results.items():
+        print(f'\n{scenario}')
+        print(f'  {"method":<28}{"requests":>10}{"errors":>8}{"rps":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+        for method, row in methods.items():
+            print(f'  {method:<28}{row["requests"]:>10}{row["errors"]:>8}{row["rps"]:>10}'
+                  f'{row["p50_ms"]:>10}{row["p95_ms"]:>10}{row["p99_ms"]:>10}')
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='may be repeated, defaults to every scenario')
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--videos', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--output', help='write the report as json')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args.url, args.scenario or list(SCENARIOS), args.duration, args.concurrency,
+                              args.users, args.videos, args.seed))
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
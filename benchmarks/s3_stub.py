@@ -0,0 +1,97 @@
+"""In-memory stand-in for the S3 calls the app makes, so load tests don't touch object storage.
+
+Usage: python -m benchmarks.s3_stub [--port 9000]
+Then start the app with S3_ENDPOINT_URL=http://127.0.0.1:9000.
+"""
+import argparse
+import hashlib
+import re
+import uuid
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Route
+
+objects: dict[tuple[str, str], bytes] = {}
+uploads: dict[str, dict[int, bytes]] = {}
+
+XML = '<?xml version="1.0" encoding="UTF-8"?>'
+NOT_FOUND = f'{XML}<Error><Code>NoSuchKey</Code></Error>'
+
+
+def etag(body: bytes):
+    return f'"{hashlib.md5(body).hexdigest()}"'
+
+
+async def multipart_handler(request: Request, key: tuple[str, str]):
+    params = request.query_params
+    if 'uploads' in params:
+        upload_id = uuid.uuid4().hex
+        uploads[upload_id] = {}
+        return Response(f'{XML}<InitiateMultipartUploadResult><Bucket>{key[0]}</Bucket><Key>{key[1]}</Key>'
+                        f'<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>',
+                        media_type='application/xml')
+    upload_id = params['uploadId']
+    if request.method == 'PUT':
+        body = await request.body()
+        uploads[upload_id][int(params['partNumber'])] = body
+        return Response(headers={'ETag': etag(body)})
+    parts = uploads.pop(upload_id)
+    if request.method == 'DELETE':
+        return Response(status_code=204)
+    objects[key] = b''.join(parts[number] for number in sorted(parts))
+    return Response(f'{XML}<CompleteMultipartUploadResult><Bucket>{key[0]}</Bucket><Key>{key[1]}</Key>'
+                    f'<ETag>{etag(objects[key])}</ETag></CompleteMultipartUploadResult>',
+                    media_type='application/xml')
+
+
+async def object_handler(request: Request):
+    key = (request.path_params['bucket'], request.path_params['key'])
+    if 'uploads' in request.query_params or 'uploadId' in request.query_params:
+        return await multipart_handler(request, key)
+    if request.method == 'PUT':
+        body = await request.body()
+        objects[key] = body
+        return Response(headers={'ETag': etag(body)})
+    if request.method == 'DELETE':
+        objects.pop(key, None)
+        return Response(status_code=204)
+    if key not in objects:
+        return Response(NOT_FOUND, status_code=404, media_type='application/xml')
+    body = objects[key]
+    headers = {'ETag': etag(body), 'Content-Length': str(len(body))}
+    if request.method == 'HEAD':
+        return Response(headers=headers)
+    return Response(body, headers=headers, media_type='application/octet-stream')
+
+
+async def bucket_handler(request: Request):
+    bucket = request.path_params['bucket']
+    if 'delete' not in request.query_params:
+        return Response(status_code=501)
+    keys = re.findall(r'<Key>(.*?)</Key>', (await request.body()).decode())
+    for key in keys:
+        objects.pop((bucket, key), None)
+    deleted = ''.join(f'<Deleted><Key>{key}</Key></Deleted>' for key in keys)
+    return Response(f'{XML}<DeleteResult>{deleted}</DeleteResult>',
+                    media_type='application/xml')
+
+
+app = Starlette(routes=[
+    Route('/{bucket}', bucket_handler, methods=['POST']),
+    Route('/{bucket}/{key:path}', object_handler, methods=['GET', 'HEAD', 'PUT', 'POST', 'DELETE']),
+])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    args = parser.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port, access_log=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Bulk-load a reproducible dataset into the configured database.
+
+Usage: python -m benchmarks.seed [--users 1000] [--videos 5000] [--reset]
+
+Every seeded user is called user{i} and has the password PASSWORD, so load tests can log in as any of them.
+"""
+import argparse
+import datetime
+import random
+
+import peewee
+
+from benchmarks.loadtest import PASSWORD
+from urfube import migrations, models
+from urfube.database import db
+from urfube.utils import get_hashed_password
+
+BATCH_SIZE = 1000
+
+
+def insert_batches(model, rows):
+    rows = list(rows)
+    for start in range(0, len(rows), BATCH_SIZE):
+        model.insert_many(rows[start:start + BATCH_SIZE]).execute()
+
+
+def unique_pairs(rng, count, left, right):
+    pairs = set()
+    count = min(count, left * right)
+    while len(pairs) < count:
+        pairs.add((rng.randint(1, left), rng.randint(1, right)))
+    return pairs
+
+
+def seed(users: int, videos: int, likes: int, comments: int, subscriptions: int, history: int, seed_value: int = 0):
+    rng = random.Random(seed_value)
+    now = datetime.datetime.now()
+    password = get_hashed_password(PASSWORD)
+    with db.atomic():
+        insert_batches(models.User, ({'id': i, 'username': f'user{i}', 'password': password}
+                                     for i in range(1, users + 1)))
+        video_authors = [rng.randint(1, users) for _ in range(videos)]
+        insert_batches(models.Video, ({'id': i, 'title': f'video {i}', 'description': f'description of video {i}',
+                                       'author': f'user{author}', 'user': author, 'views': rng.randint(0, 100000),
+                                       'created': now - datetime.timedelta(minutes=rng.randint(0, 525600))}
+                                      for i, author in enumerate(video_authors, start=1)))
+        insert_batches(models.Like, ({'user': user, 'video': video}
+                                     for user, video in unique_pairs(rng, likes, users, videos)))
+        insert_batches(models.Comment, ({'content': f'comment {i}', 'user': rng.randint(1, users),
+                                         'video': rng.randint(1, videos),
+                                         'created': now - datetime.timedelta(minutes=rng.randint(0, 525600))}
+                                        for i in range(comments)))
+        insert_batches(models.Subscription, ({'subscriber': subscriber, 'channel': channel}
+                                             for subscriber, channel in unique_pairs(rng, subscriptions, users, users)
+                                             if subscriber != channel))
+        insert_batches(models.History, ({'user': user, 'video_id': video, 'timestamp': rng.uniform(0, 600),
+                                         'length': 600}
+                                        for user, video in unique_pairs(rng, history, users, videos)))
+    if db.sequences:
+        for model in migrations.MODELS:
+            if isinstance(model._meta.primary_key, peewee.AutoField):
+                table = model._meta.table_name
+                db.execute_sql(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                               f"(SELECT COALESCE(MAX(id), 1) FROM {table}))")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--videos', type=int, default=5000)
+    parser.add_argument('--likes', type=int, default=50000)
+    parser.add_argument('--comments', type=int, default=50000)
+    parser.add_argument('--subscriptions', type=int, default=20000)
+    parser.add_argument('--history', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--reset', action='store_true', help='drop and recreate all tables first')
+    args = parser.parse_args()
+
+    db.connect()
+    if args.reset:
+        db.drop_tables(migrations.MODELS)
+    migrations.create_schema()
+    seed(args.users, args.videos, args.likes, args.comments, args.subscriptions, args.history, args.seed)
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Compare the validated and trusted JSON-RPC result paths on a large get_videos-style list.
+
+Usage: python -m benchmarks.serialization [--items 10000] [--repeat 5]
+"""
+import argparse
+import asyncio
+import datetime
+import time
+from typing import List
+
+from fastapi.responses import JSONResponse, ORJSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+from pydantic import BaseModel
+
+from urfube import schemas
+
+
+class Response(BaseModel):
+    jsonrpc: str
+    result: List[schemas.VideoReturn]
+
+
+def make_rows(items: int):
+    created = datetime.datetime(2023, 5, 1, 12, 30)
+    link = 'https://storage.yandexcloud.net/jurmaev/images/{}.jpg?AWSAccessKeyId=key&Signature=sig&Expires=1700000000'
+    return [{'title': f'video {i}', 'id': i, 'author': f'user{i % 500}', 'views': i * 7,
+             'created': created + datetime.timedelta(minutes=i),
+             'image_link': link.format(i), 'profile_link': link.format(i % 500),
+             'timestamp': 0.0, 'progress': 0.0} for i in range(items)]
+
+
+async def validated(field, rows):
+    content = await serialize_response(field=field, response_content={'jsonrpc': '2.0', 'result': rows})
+    return JSONResponse(content=content).body
+
+
+async def trusted(rows):
+    return ORJSONResponse(content={'jsonrpc': '2.0', 'result': rows}).body
+
+
+def measure(func, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        asyncio.run(func())
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rows = make_rows(args.items)
+    field = create_response_field(name='response', type_=Response)
+    slow = measure(lambda: validated(field, rows), args.repeat)
+    fast = measure(lambda: trusted(rows), args.repeat)
+    print(f'items: {args.items}')
+    print(f'validated + json:  {slow * 1000:8.1f} ms')
+    print(f'trusted + orjson:  {fast * 1000:8.1f} ms')
+    print(f'speedup:           {slow / fast:8.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Measure how long a worker takes to import the app and to answer its first request.
+
+Usage: python -m benchmarks.startup [--runs 5] [--port 5056]
+
+Import time is measured in fresh interpreters. Time to first request runs uvicorn and counts from process
+start until /health/ready and then a get_videos call succeed, using the current environment (database,
+S3_ENDPOINT_URL, ...).
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+IMPORT_SCRIPT = 'import time; start = time.perf_counter(); import urfube.app; print(time.perf_counter() - start)'
+
+
+def import_time():
+    output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], capture_output=True, text=True, check=True)
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def first_request_time(port: int, timeout: float = 60):
+    url = f'http://127.0.0.1:{port}'
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'urfube.app:app', '--port', str(port),
+                               '--no-access-log'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        with httpx.Client(base_url=url, timeout=timeout) as client:
+            while time.perf_counter() - start < timeout:
+                try:
+                    if client.get('/health/ready').status_code == 200:
+                        ready = time.perf_counter() - start
+                        body = {'jsonrpc': '2.0', 'id': 0, 'method': 'get_videos', 'params': {}}
+                        client.post('/api', json=body).raise_for_status()
+                        return ready, time.perf_counter() - start
+                except httpx.HTTPError:
+                    pass
+                time.sleep(0.01)
+        raise RuntimeError(f'server at {url} did not start')
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--port', type=int, default=5056)
+    args = parser.parse_args()
+
+    imports = [import_time() for _ in range(args.runs)]
+    ready, first = zip(*(first_request_time(args.port) for _ in range(args.runs)))
+    for name, samples in (('import', imports), ('ready', ready), ('first request', first)):
+        print(f'{name:<15}median {statistics.median(samples) * 1000:8.1f} ms   '
+              f'min {min(samples) * 1000:8.1f} ms   max {max(samples) * 1000:8.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Rolls playback events up into hourly and daily per-video stats for get_channel_analytics.
+
+Usage: python -m urfube.analytics
+
+Each run takes the events not rolled up yet, batch by batch, and recomputes every (video, hour) and (video, day)
+bucket they fall into from that bucket's events, so unique viewers and average completion stay exact while
+buckets without new events are never read again. Events are marked once they are counted, so one that commits
+late is picked up by the next run. Rolled up events older than ANALYTICS_RETENTION_DAYS are deleted.
+"""
+import asyncio
+import datetime
+import logging
+
+import peewee
+from peewee import Case, Select, Value, fn
+
+from urfube import database, models
+from urfube.config import settings
+
+logger = logging.getLogger(__name__)
+
+LOCK_ID = 7237
+PERIODS = {'hour': 1, 'day': 24}
+
+
+def hour_of(moment: datetime.datetime) -> int:
+    return int(moment.timestamp() // 3600)
+
+
+def bucket_start(bucket: int) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(bucket * 3600, datetime.timezone.utc)
+
+
+def roll_up(period: str, event_ids: list[int]):
+    event, new = models.PlaybackEvent, models.PlaybackEvent.alias('new')
+    hours = PERIODS[period]
+    touched = (new.select(new.video_id, (new.hour / hours * hours).alias('bucket'))
+               .where(new.id.in_(event_ids)).distinct().alias('touched'))
+    # One row per viewer first: unique viewers and completion are per viewer, not per event.
+    per_viewer = (event.select(event.video_id, touched.c.bucket, event.user_id,
+                               fn.SUM(Case(None, [(event.started, 1)], 0)).alias('views'),
+                               fn.SUM(event.watched).alias('watch_time'),
+                               fn.MAX(event.position / event.length).alias('completion'))
+                  .join(touched, on=(event.video_id == touched.c.video_id) & (event.hour >= touched.c.bucket) &
+                                    (event.hour < touched.c.bucket + hours))
+                  .group_by(event.video_id, touched.c.bucket, event.user_id).alias('per_viewer'))
+    stats = (Select([per_viewer], [per_viewer.c.video_id, Value(period), per_viewer.c.bucket,
+                                   fn.SUM(per_viewer.c.views), fn.COUNT(per_viewer.c.user_id),
+                                   fn.SUM(per_viewer.c.watch_time), fn.AVG(per_viewer.c.completion)])
+             .group_by(per_viewer.c.video_id, per_viewer.c.bucket))
+    fields = [models.VideoStats.video_id, models.VideoStats.period, models.VideoStats.bucket, models.VideoStats.views,
+              models.VideoStats.viewers, models.VideoStats.watch_time, models.VideoStats.completion]
+    (models.VideoStats.insert_from(stats, fields)
+     .on_conflict(conflict_target=fields[:3], preserve=fields[3:])
+     .execute())
+
+
+def roll_up_batch():
+    db = models.PlaybackEvent._meta.database
+    with db.atomic():
+        if isinstance(db, peewee.PostgresqlDatabase) and \
+                not db.execute_sql('SELECT pg_try_advisory_xact_lock(%s)', (LOCK_ID,)).fetchone()[0]:
+            return 0
+        # A list, not a subquery: events committed while this runs must not be marked without being counted.
+        batch = [event_id for event_id, in models.PlaybackEvent.select(models.PlaybackEvent.id)
+                 .where(models.PlaybackEvent.rolled_up == False)
+                 .order_by(models.PlaybackEvent.id).limit(settings.analytics_batch_size).tuples()]
+        if not batch:
+            return 0
+        for period in PERIODS:
+            roll_up(period, batch)
+        models.PlaybackEvent.update(rolled_up=True).where(models.PlaybackEvent.id.in_(batch)).execute()
+    return len(batch)
+
+
+def delete_old_events(now: datetime.datetime):
+    cutoff = now - datetime.timedelta(days=settings.analytics_retention_days)
+    while True:
+        batch = (models.PlaybackEvent.select(models.PlaybackEvent.id)
+                 .where(models.PlaybackEvent.created < cutoff, models.PlaybackEvent.rolled_up == True)
+                 .limit(settings.analytics_batch_size))
+        if not models.PlaybackEvent.delete().where(models.PlaybackEvent.id.in_(batch)).execute():
+            return
+
+
+def update_analytics(now: datetime.datetime | None = None):
+    rolled_up = 0
+    while counted := roll_up_batch():
+        rolled_up += counted
+    delete_old_events(now or datetime.datetime.now())
+    return rolled_up
+
+
+async def run_periodically():
+    while True:
+        try:
+            rolled_up = await asyncio.to_thread(database.run_with_connection, update_analytics)
+            if rolled_up:
+                logger.info('rolled up %d playback events', rolled_up)
+        except Exception:
+            logger.exception('analytics rollup failed')
+        await asyncio.sleep(settings.analytics_interval_seconds)
+
+
+if __name__ == '__main__':
+    database.run_with_connection(update_analytics)
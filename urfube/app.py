@@ -1,45 +1,120 @@
-import logging
-from contextlib import asynccontextmanager
+import asyncio
+import hashlib
+import io
 from datetime import datetime
-from typing import Annotated, List
+from typing import Annotated, List, Literal
 
 import fastapi_jsonrpc as jsonrpc
-from fastapi import Depends, UploadFile
+from fastapi import BackgroundTasks, Body, Depends, Header, Query, Request, Response, UploadFile, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
 from jose import jwt
-from fastapi.responses import JSONResponse
-from urfube import (config, crud, database, dependencies, errors, models,
-                    schemas)
+from fastapi.responses import JSONResponse, ORJSONResponse
+from urfube import (analytics, archive, cleanup, config, crud, database, dependencies, errors, events, images, inbox,
+                    limits, media_cache, metrics, migrations, request_logging, routing, schemas,
+                    trending, utils)
 from urfube.utils import (create_access_token, create_presigned_url,
-                          create_refresh_token, upload_fileobj,
+                          create_refresh_token, etag_matches, upload_fileobj,
                           verify_password)
 
 origins = ['*']
-database.db.connect()
-database.db.create_tables(
-    [models.User, models.Video, models.History, models.Comment, models.Like, models.Subscription]
+cache_control = 'public, no-cache'
+
+app = jsonrpc.API()
+app.state.ready = False
+app.state.background_jobs = []
+
+
+def prepare_database():
+    database.run_with_connection(migrations.create_schema)
+    database.warm_pool(config.settings.database_min_connections)
+
+
+async def store_image(image_file: UploadFile, kind: str) -> tuple[str, list[str]]:
+    data = await image_file.read()
+    variants = await images.make_variants(data, kind)
+    if variants is None:
+        raise errors.InvalidImageError
+    digest = hashlib.sha256(data).hexdigest()
+    uploads = [upload_fileobj(io.BytesIO(data), 'jurmaev', utils.media_key(kind, None, digest), len(data),
+                              utils.IMMUTABLE_MEDIA_ARGS)]
+    uploads += [upload_fileobj(io.BytesIO(variant), 'jurmaev', utils.media_key(kind, None, digest, size), len(variant),
+                               utils.IMMUTABLE_VARIANT_ARGS) for size, variant in variants.items()]
+    if not all(await asyncio.gather(*uploads)):
+        raise errors.S3ClientError
+    return digest, list(variants)
+
+
+@app.on_event('startup')
+async def startup():
+    request_logging.start_logging()
+    # The S3 client's imports and the schema check overlap instead of running one after the other.
+    await asyncio.gather(asyncio.to_thread(prepare_database), utils.open_s3_client())
+    if config.settings.trending_interval_seconds > 0:
+        app.state.background_jobs.append(asyncio.create_task(trending.run_periodically()))
+    if config.settings.analytics_interval_seconds > 0:
+        app.state.background_jobs.append(asyncio.create_task(analytics.run_periodically()))
+    if config.settings.history_retention_days > 0:
+        app.state.background_jobs.append(asyncio.create_task(archive.run_periodically()))
+    if config.settings.cleanup_interval_seconds > 0:
+        app.state.background_jobs.append(asyncio.create_task(cleanup.run_periodically()))
+    if config.settings.events_backend == 'postgres':
+        app.state.background_jobs.append(asyncio.create_task(events.listen()))
+    if config.settings.rate_limit_backend == 'postgres':
+        app.state.background_jobs.append(asyncio.create_task(limits.run_periodically()))
+    app.state.ready = True
+
+
+@app.on_event('shutdown')
+async def shutdown():
+    # Runs once uvicorn has stopped accepting connections and finished the in-flight requests.
+    app.state.ready = False
+    for job in app.state.background_jobs:
+        job.cancel()
+    await asyncio.gather(*app.state.background_jobs, return_exceptions=True)
+    app.state.background_jobs.clear()
+    await utils.close_s3_client()
+    images.shutdown_pool()
+    database.db.close_all()
+    database.replicas.close_all()
+    metrics.mark_process_dead()
+    request_logging.stop_logging()
+
+
+api = routing.Entrypoint(
+    # Admission before logging: calls turned away during a flood are counted in metrics, not written to the log.
+    '/api', middlewares=[metrics.metrics_middleware, limits.admission_middleware, request_logging.logging_middleware],
+    response_class=ORJSONResponse,
+    tags=['user', 'video', 'history', 'comment', 'like', 'subscriptions']
 )
-database.db.close()
+app.add_middleware(CORSMiddleware, allow_origins=origins, allow_credentials=True, allow_methods=['*'],
+                   allow_headers=['*'], expose_headers=['ETag'])
+app.get('/metrics', include_in_schema=False)(metrics.metrics_endpoint)
 
-logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO)
 
+@app.get('/health/live', include_in_schema=False)
+async def liveness():
+    return {'status': 'ok'}
 
-@asynccontextmanager
-async def logging_middleware(ctx: jsonrpc.JsonRpcContext):
-    logger.info('Request: {request}'.format(request=ctx.raw_request))
+
+@app.get('/health/ready', include_in_schema=False)
+async def readiness():
     try:
-        yield
-    finally:
-        logger.info('Response: {response}\n'.format(response=ctx.raw_response))
+        database_ok = app.state.ready and await asyncio.to_thread(database.ping)
+    except Exception:
+        database_ok = False
+    if not database_ok:
+        return ORJSONResponse({'status': 'unavailable'}, status_code=503)
+    return {'status': 'ok'}
 
 
-app = jsonrpc.API()
-api = jsonrpc.Entrypoint(
-    '/api', middlewares=[logging_middleware], tags=['user', 'video', 'history', 'comment', 'like', 'subscriptions']
-)
-app.add_middleware(CORSMiddleware, allow_origins=origins, allow_credentials=True, allow_methods=['*'],
-                   allow_headers=['*'])
+@app.get('/media/{kind}/{key}', include_in_schema=False)
+async def media(kind: str, key: str, request: Request):
+    return await media_cache.serve(kind, key, request.headers)
+
+
+@app.websocket('/events')
+async def events_socket(websocket: WebSocket):
+    await events.serve(websocket)
 
 
 @api.method(errors=[errors.UserExistsError], dependencies=[Depends(dependencies.get_db)], tags=['user'])
@@ -90,61 +165,143 @@ async def refresh_tokens(refresh_token: str) -> schemas.Token:
     }
 
 
-@app.post('/upload_video/', tags=['video'], dependencies=[Depends(dependencies.get_db)])
+@app.post('/upload_video/', tags=['video'],
+          dependencies=[Depends(limits.rest_admission('upload_video')), Depends(dependencies.get_db)])
 async def upload_video(user: Annotated[schemas.User, Depends(dependencies.get_auth_user)], video_file: UploadFile,
                        image_file: UploadFile,
                        video_title: str,
-                       video_description: str):
+                       video_description: str,
+                       background_tasks: BackgroundTasks):
     if crud.get_video_by_title(video_title) is not None:
         return JSONResponse(content='Video already exists!')
+    try:
+        image_hash, image_variants = await store_image(image_file, 'images')
+    except errors.InvalidImageError:
+        return JSONResponse(content='Invalid image!')
+    except errors.S3ClientError:
+        return JSONResponse(content='Video upload failed!')
     db_video = crud.upload_video(schemas.VideoUpload(title=video_title, description=video_description),
-                                 user)
-    video_upload = await upload_fileobj(video_file.file, 'jurmaev', f'videos/{db_video.id}.mp4', video_file.size)
-    image_upload = await upload_fileobj(image_file.file, 'jurmaev', f'images/{db_video.id}.jpg', image_file.size)
-    if not video_upload or not image_upload:
+                                 user, image_hash, image_variants)
+    video_reader = utils.HashingReader(video_file.file)
+    uploaded_key = crud.video_key(db_video)
+    video_upload = await upload_fileobj(video_reader, 'jurmaev', uploaded_key, video_file.size)
+    if not video_upload:
         return JSONResponse(content='Video upload failed!')
+    if crud.deduplicate_video(db_video, video_reader.hexdigest()) is not None:
+        # The hash is only known once the bytes are read, so an identical upload is dropped afterwards.
+        await utils.delete_object('jurmaev', uploaded_key)
+    if config.settings.subscription_inbox:
+        background_tasks.add_task(database.run_with_connection, inbox.fan_out_video, db_video.id)
 
 
-@api.method(errors=[], dependencies=[Depends(dependencies.get_db)], tags=['video'])
-async def get_videos() -> List[schemas.VideoReturn]:
+@api.method(errors=[errors.VideoDoesNotExistError, errors.PermissionError], dependencies=[Depends(dependencies.get_db)],
+            tags=['video'])
+async def delete_video(user: Annotated[schemas.User, Depends(dependencies.get_auth_user)], video_id: int):
+    db_video = crud.get_video_by_id(video_id)
+    if db_video is None:
+        raise errors.VideoDoesNotExistError
+    if db_video.user_id != user.id:
+        raise errors.PermissionError
+    crud.delete_video(video_id)
+    cleanup.wake()
+
+
+@api.method(errors=[errors.NotModifiedError], dependencies=[Depends(dependencies.get_read_db)], trusted_result=True,
+            tags=['video'])
+async def get_videos(response: Response,
+                     if_none_match: str | None = Header(None, alias='if-none-match')) -> List[schemas.VideoReturn]:
+    etag = crud.get_videos_etag()
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = cache_control
+    if etag_matches(etag, if_none_match):
+        raise errors.NotModifiedError
     return await crud.get_videos()
 
 
+@app.get('/videos/', tags=['video'], dependencies=[Depends(dependencies.get_read_db)])
+async def get_videos_rest(if_none_match: str | None = Header(None, alias='if-none-match')) -> List[
+    schemas.VideoReturn]:
+    etag = crud.get_videos_etag()
+    headers = {'ETag': etag, 'Cache-Control': cache_control}
+    if etag_matches(etag, if_none_match):
+        return Response(status_code=304, headers=headers)
+    return ORJSONResponse(content=await crud.get_videos(), headers=headers)
+
+
+@api.method(errors=[], dependencies=[Depends(dependencies.get_read_db)], trusted_result=True, tags=['video'])
+async def search_videos(query: str, page: int = Body(1, ge=1),
+                        per_page: int = Body(20, ge=1, le=100)) -> List[schemas.VideoReturn]:
+    return await crud.search_videos(query, page, per_page)
+
+
+@api.method(errors=[], dependencies=[Depends(dependencies.get_read_db)], trusted_result=True, tags=['video'])
+async def get_trending_videos(page: int = Body(1, ge=1),
+                              per_page: int = Body(20, ge=1, le=100)) -> List[schemas.VideoReturn]:
+    return await crud.get_trending_videos(page, per_page)
+
+
+@api.method(errors=[], dependencies=[Depends(dependencies.get_read_db)], trusted_result=True, tags=['video'])
+async def get_recommendations(video_id: int) -> List[schemas.VideoReturn]:
+    return await crud.get_recommendations(video_id)
+
+
 @api.method(errors=[], dependencies=[Depends(dependencies.get_db)], tags=['history'])
 async def add_or_update_history(user: Annotated[schemas.User, Depends(dependencies.get_auth_user)],
                                 video: schemas.History):
     crud.add_or_update_history(user, video)
 
 
-@api.method(errors=[], dependencies=[Depends(dependencies.get_db)], tags=['history'])
-async def get_user_history(user: Annotated[schemas.User, Depends(dependencies.get_auth_user)]) -> List[
-    schemas.VideoReturn]:
-    return await crud.get_user_history(user)
+@api.method(errors=[errors.VideoDoesNotExistError], dependencies=[Depends(dependencies.get_db)], tags=['history'])
+async def add_or_update_history_batch(user: Annotated[schemas.User, Depends(dependencies.get_auth_user)],
+                                      videos: List[schemas.History] = Body(..., min_items=1, max_items=100)):
+    video_ids = {video.video_id for video in videos}
+    if len(crud.get_existing_video_ids(list(video_ids))) < len(video_ids):
+        raise errors.VideoDoesNotExistError
+    crud.add_or_update_history_batch(user, videos)
 
 
-@api.method(errors=[errors.LinkGenerateFailedError], dependencies=[Depends(dependencies.get_db)], tags=['video'])
+@api.method(errors=[], dependencies=[Depends(dependencies.get_read_db)], trusted_result=True,
+            tags=['history'])
+async def get_user_history(user: Annotated[schemas.User, Depends(dependencies.get_auth_user)],
+                           page: int = Body(1, ge=1),
+                           per_page: int = Body(20, ge=1, le=100)) -> List[schemas.VideoReturn]:
+    return await crud.get_user_history(user, page, per_page)
+
+
+@api.method(errors=[errors.LinkGenerateFailedError], dependencies=[Depends(dependencies.get_read_db)], tags=['video'])
 async def generate_video_link(video_id: int) -> str:
-    if crud.get_video_by_id(video_id) is None:
+    video = crud.get_video_by_id(video_id)
+    if video is None:
         raise errors.VideoDoesNotExistError
-    link = await create_presigned_url('jurmaev', f'videos/{video_id}.mp4')
+    link = await create_presigned_url('jurmaev', crud.video_key(video))
     if link is None:
         raise errors.LinkGenerateFailedError
     return link
 
 
-@api.method(errors=[errors.VideoDoesNotExistError], dependencies=[Depends(dependencies.get_db)], tags=['comment'])
+@api.method(errors=[errors.VideoDoesNotExistError, errors.CommentDoesNotExistError],
+            dependencies=[Depends(dependencies.get_db)], tags=['comment'])
 async def add_comment(user: Annotated[schemas.User, Depends(dependencies.get_auth_user)],
                       comment: schemas.CommentUpload):
     if crud.get_video_by_id(comment.video_id) is None:
         raise errors.VideoDoesNotExistError
-    crud.add_comment(comment.content, comment.video_id, user)
+    parent = None
+    if comment.parent_id is not None:
+        parent = crud.get_comment_by_id(comment.parent_id)
+        if parent is None or parent.video_id != comment.video_id:
+            raise errors.CommentDoesNotExistError
+    db_comment = crud.add_comment(comment.content, comment.video_id, user, parent)
+    events.publish(f'video:{comment.video_id}', 'comment_added', id=db_comment.id, content=db_comment.content,
+                   author=user.username, created=db_comment.created, parent_id=db_comment.parent_id)
 
 
 @api.method(errors=[errors.CommentDoesNotExistError], dependencies=[Depends(dependencies.get_db)], tags=['comment'])
 async def delete_comment(user: Annotated[schemas.User, Depends(dependencies.get_auth_user)], comment_id: int):
-    if crud.get_comment_by_id(comment_id) is None:
+    db_comment = crud.get_comment_by_id(comment_id)
+    if db_comment is None:
         raise errors.CommentDoesNotExistError
-    crud.delete_comment(comment_id)
+    crud.delete_comment(db_comment)
+    events.publish(f'video:{db_comment.video_id}', 'comment_deleted', id=comment_id)
 
 
 @api.method(errors=[errors.CommentDoesNotExistError], dependencies=[Depends(dependencies.get_db)], tags=['comment'])
@@ -155,14 +312,52 @@ async def edit_comment(user: Annotated[schemas.User, Depends(dependencies.get_au
     crud.edit_comment(comment_id, new_content)
 
 
-@api.method(errors=[errors.VideoDoesNotExistError], dependencies=[Depends(dependencies.get_db)], tags=['comment'])
-async def get_comments(video_id: int) -> List[schemas.VideoComment]:
+@api.method(errors=[errors.VideoDoesNotExistError, errors.NotModifiedError],
+            dependencies=[Depends(dependencies.get_read_db)], trusted_result=True, tags=['comment'])
+async def get_comments(video_id: int, response: Response,
+                       if_none_match: str | None = Header(None, alias='if-none-match'),
+                       page: int = Body(1, ge=1), per_page: int = Body(20, ge=1, le=100),
+                       replies: int = Body(3, ge=0, le=20)) -> List[schemas.VideoComment]:
     if crud.get_video_by_id(video_id) is None:
         raise errors.VideoDoesNotExistError
-    return await crud.get_comments(video_id)
+    etag = crud.get_comments_etag(video_id, page, per_page, replies)
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = cache_control
+    if etag_matches(etag, if_none_match):
+        raise errors.NotModifiedError
+    return await crud.get_comments(video_id, page, per_page, replies)
+
+
+@app.get('/videos/{video_id}/comments/', tags=['comment'], dependencies=[Depends(dependencies.get_read_db)])
+async def get_comments_rest(video_id: int, if_none_match: str | None = Header(None, alias='if-none-match'),
+                            page: int = Query(1, ge=1), per_page: int = Query(20, ge=1, le=100),
+                            replies: int = Query(3, ge=0, le=20)) -> List[schemas.VideoComment]:
+    if crud.get_video_by_id(video_id) is None:
+        return JSONResponse(status_code=404, content=errors.VideoDoesNotExistError.MESSAGE)
+    etag = crud.get_comments_etag(video_id, page, per_page, replies)
+    headers = {'ETag': etag, 'Cache-Control': cache_control}
+    if etag_matches(etag, if_none_match):
+        return Response(status_code=304, headers=headers)
+    return ORJSONResponse(content=await crud.get_comments(video_id, page, per_page, replies), headers=headers)
+
+
+@api.method(errors=[errors.CommentDoesNotExistError], dependencies=[Depends(dependencies.get_read_db)],
+            trusted_result=True, tags=['comment'])
+async def get_comment_replies(comment_id: int, after: int | None = Body(None),
+                              per_page: int = Body(20, ge=1, le=100)) -> List[schemas.VideoComment]:
+    db_comment = crud.get_comment_by_id(comment_id)
+    if db_comment is None:
+        raise errors.CommentDoesNotExistError
+    # after is the last reply already shown, e.g. the last one get_comments returned for the thread.
+    db_after = None
+    if after is not None:
+        db_after = crud.get_comment_by_id(after)
+        if db_after is None or not crud.is_reply_to(db_comment, db_after):
+            raise errors.CommentDoesNotExistError
+    return await crud.get_comment_replies(db_comment, db_after, per_page)
 
 
-@api.method(errors=[errors.VideoDoesNotExistError], dependencies=[Depends(dependencies.get_db)], tags=['video'])
+@api.method(errors=[errors.VideoDoesNotExistError], dependencies=[Depends(dependencies.get_read_db)], tags=['video'])
 async def get_video_info(video_id: int) -> schemas.Video:
     db_video = crud.get_video_by_id(video_id)
     if db_video is None:
@@ -180,6 +375,20 @@ async def post_like(
     if crud.user_liked_video(user, video_id) is not None:
         raise errors.LikeAlreadyExistsError
     crud.add_like(user, video_id)
+    events.publish(f'video:{video_id}', 'likes', delta=1)
+
+
+@api.method(errors=[errors.VideoDoesNotExistError], dependencies=[Depends(dependencies.get_db)], tags=['like'])
+async def post_like_batch(user: Annotated[schemas.User, Depends(dependencies.get_auth_user)],
+                          video_ids: List[int] = Body(..., min_items=1, max_items=100)):
+    liked = crud.get_like_states(user, list(set(video_ids)))
+    if len(liked) < len(set(video_ids)):
+        raise errors.VideoDoesNotExistError
+    new_ids = [video_id for video_id, already_liked in liked.items() if not already_liked]
+    if new_ids:
+        crud.add_likes(user, new_ids)
+    for video_id in new_ids:
+        events.publish(f'video:{video_id}', 'likes', delta=1)
 
 
 @api.method(errors=[errors.LikeDoesNotExistError, errors.VideoDoesNotExistError],
@@ -190,19 +399,20 @@ async def remove_like(user: Annotated[schemas.User, Depends(dependencies.get_aut
     if crud.user_liked_video(user, video_id) is None:
         raise errors.LikeDoesNotExistError
     crud.remove_like(user, video_id)
+    events.publish(f'video:{video_id}', 'likes', delta=-1)
 
 
 @api.method(errors=[errors.LikeDoesNotExistError, errors.VideoDoesNotExistError],
-            dependencies=[Depends(dependencies.get_db)], tags=['like'])
+            dependencies=[Depends(dependencies.get_read_db)], tags=['like'])
 async def get_like(user: Annotated[schemas.User, Depends(dependencies.get_auth_user)], video_id: int) -> bool:
     if crud.get_video_by_id(video_id) is None:
         raise errors.VideoDoesNotExistError
     if crud.user_liked_video(user, video_id) is None:
         raise errors.LikeDoesNotExistError
-    return crud.user_liked_video(user, video_id) is not None
+    return True
 
 
-@api.method(errors=[errors.VideoDoesNotExistError], dependencies=[Depends(dependencies.get_db)],
+@api.method(errors=[errors.VideoDoesNotExistError], dependencies=[Depends(dependencies.get_read_db)],
             tags=['like'])
 async def get_likes(video_id: int) -> int:
     if crud.get_video_by_id(video_id) is None:
@@ -210,10 +420,12 @@ async def get_likes(video_id: int) -> int:
     return crud.get_likes(video_id)
 
 
-@api.method(errors=[], dependencies=[Depends(dependencies.get_db)], tags=['like'])
-async def get_liked_videos(user: Annotated[schemas.User,
-Depends(dependencies.get_auth_user)]) -> List[schemas.VideoReturn]:
-    return await crud.get_liked_videos(user)
+@api.method(errors=[], dependencies=[Depends(dependencies.get_read_db)], trusted_result=True,
+            tags=['like'])
+async def get_liked_videos(user: Annotated[schemas.User, Depends(dependencies.get_auth_user)],
+                           page: int = Body(1, ge=1),
+                           per_page: int = Body(20, ge=1, le=100)) -> List[schemas.VideoReturn]:
+    return await crud.get_liked_videos(user, page, per_page)
 
 
 @api.method(errors=[errors.VideoDoesNotExistError], dependencies=[Depends(dependencies.get_db)], tags=['video'])
@@ -224,12 +436,49 @@ async def post_view(user: Annotated[schemas.User, Depends(dependencies.get_auth_
     crud.add_view(video_id)
 
 
+@api.method(errors=[errors.VideoDoesNotExistError], dependencies=[Depends(dependencies.get_db)], tags=['analytics'])
+async def post_playback_events(user: Annotated[schemas.User, Depends(dependencies.get_auth_user)],
+                               events: List[schemas.PlaybackEvent] = Body(..., min_items=1, max_items=1000)):
+    video_ids = {event.video_id for event in events}
+    if len(crud.get_existing_video_ids(list(video_ids))) < len(video_ids):
+        raise errors.VideoDoesNotExistError
+    crud.add_playback_events(user, events)
+
+
+@api.method(errors=[errors.VideoDoesNotExistError, errors.PermissionError],
+            dependencies=[Depends(dependencies.get_read_db)], tags=['analytics'])
+async def get_channel_analytics(user: Annotated[schemas.User, Depends(dependencies.get_auth_user)],
+                                period: Literal['hour', 'day'] = Body('day'), days: int = Body(28, ge=1, le=365),
+                                video_id: int | None = Body(None)) -> List[schemas.AnalyticsBucket]:
+    if video_id is not None:
+        db_video = crud.get_video_by_id(video_id)
+        if db_video is None:
+            raise errors.VideoDoesNotExistError
+        if db_video.user_id != user.id:
+            raise errors.PermissionError
+    return crud.get_channel_analytics(user, period, days, video_id)
+
+
 @api.method(errors=[errors.UserNotFoundError], dependencies=[Depends(dependencies.get_db)], tags=['subscriptions'])
 async def subscribe(user: Annotated[schemas.User, Depends(dependencies.get_auth_user)], channel: str):
     db_channel = crud.get_user_by_username(channel)
     if db_channel is None:
         raise errors.UserNotFoundError
     crud.subscribe(user.id, db_channel.id)
+    events.publish(f'channel:{db_channel.username}', 'subscribers', delta=1)
+
+
+@api.method(errors=[errors.UserNotFoundError], dependencies=[Depends(dependencies.get_db)], tags=['subscriptions'])
+async def subscribe_batch(user: Annotated[schemas.User, Depends(dependencies.get_auth_user)],
+                          channels: List[str] = Body(..., min_items=1, max_items=100)):
+    states = crud.get_subscription_states(user.id, channels)
+    if len(states) < len({channel.lower() for channel in channels}):
+        raise errors.UserNotFoundError
+    new_channels = [(channel_id, username) for channel_id, username, subscribed in states if not subscribed]
+    if new_channels:
+        crud.subscribe_batch(user.id, [channel_id for channel_id, _ in new_channels])
+    for _, username in new_channels:
+        events.publish(f'channel:{username}', 'subscribers', delta=1)
 
 
 @api.method(errors=[errors.UserNotFoundError], dependencies=[Depends(dependencies.get_db)], tags=['subscriptions'])
@@ -237,10 +486,11 @@ async def unsubscribe(user: Annotated[schemas.User, Depends(dependencies.get_aut
     db_channel = crud.get_user_by_username(channel)
     if db_channel is None:
         raise errors.UserNotFoundError
-    crud.unsubscribe(user.id, db_channel)
+    if crud.unsubscribe(user.id, db_channel):
+        events.publish(f'channel:{db_channel.username}', 'subscribers', delta=-1)
 
 
-@api.method(errors=[errors.UserNotFoundError], dependencies=[Depends(dependencies.get_db)], tags=['subscriptions'])
+@api.method(errors=[errors.UserNotFoundError], dependencies=[Depends(dependencies.get_read_db)], tags=['subscriptions'])
 async def get_subscribers(channel: str) -> int:
     channel = crud.get_user_by_username(channel)
     if channel is None:
@@ -248,7 +498,7 @@ async def get_subscribers(channel: str) -> int:
     return crud.get_subscribers(channel)
 
 
-@api.method(errors=[errors.UserNotFoundError], dependencies=[Depends(dependencies.get_db)], tags=['subscriptions'])
+@api.method(errors=[errors.UserNotFoundError], dependencies=[Depends(dependencies.get_read_db)], tags=['subscriptions'])
 async def is_subscribed(user: Annotated[schemas.User, Depends(dependencies.get_auth_user)], channel: str) -> bool:
     db_channel = crud.get_user_by_username(channel)
     if db_channel is None:
@@ -256,28 +506,35 @@ async def is_subscribed(user: Annotated[schemas.User, Depends(dependencies.get_a
     return crud.is_subscribed(user.id, db_channel.id)
 
 
-@app.post('/upload_profile_pic/', tags=['user'], dependencies=[Depends(dependencies.get_db)])
+@app.post('/upload_profile_pic/', tags=['user'],
+          dependencies=[Depends(limits.rest_admission('upload_profile_pic')), Depends(dependencies.get_db)])
 async def upload_profile_pic(user: Annotated[schemas.User, Depends(dependencies.get_auth_user)],
                        image_file: UploadFile):
-    image_upload = await upload_fileobj(image_file.file, 'jurmaev', f'profiles/{user.username}.jpg', image_file.size)
-    if not image_upload:
-        raise errors.S3ClientError
-
-@api.method(errors=[errors.UserNotFoundError], dependencies=[Depends(dependencies.get_db)], tags=['user'])
+    try:
+        avatar_hash, avatar_variants = await store_image(image_file, 'profiles')
+    except errors.InvalidImageError:
+        return JSONResponse(status_code=400, content=errors.InvalidImageError.MESSAGE)
+    except errors.S3ClientError:
+        return JSONResponse(status_code=502, content=errors.S3ClientError.MESSAGE)
+    crud.set_avatar(user, avatar_hash, avatar_variants)
+
+@api.method(errors=[errors.UserNotFoundError], dependencies=[Depends(dependencies.get_read_db)], tags=['user'])
 async def get_channel_info(channel: str) -> schemas.ChannelInfo:
     db_channel = crud.get_user_by_username(channel)
     if db_channel is None:
         raise errors.UserNotFoundError
     return await crud.get_channel_info(channel)
 
-@api.method(errors=[errors.UserNotFoundError], dependencies=[Depends(dependencies.get_db)], tags=['user'])
+@api.method(errors=[errors.UserNotFoundError], dependencies=[Depends(dependencies.get_read_db)], trusted_result=True,
+            tags=['user'])
 async def get_channel_videos(channel: str) -> List[schemas.VideoReturn]:
     db_channel = crud.get_user_by_username(channel)
     if db_channel is None:
         raise errors.UserNotFoundError
     return await crud.get_channel_videos(db_channel)
 
-@api.method(errors=[], dependencies=[Depends(dependencies.get_db)], tags=['user'])
+@api.method(errors=[], dependencies=[Depends(dependencies.get_read_db)], trusted_result=True,
+            tags=['user'])
 async def get_subscription_videos(user: Annotated[schemas.User, Depends(dependencies.get_auth_user)]) -> List[schemas.VideoReturn]:
     return await crud.get_subscription_videos(user)
 
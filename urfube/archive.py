@@ -0,0 +1,60 @@
+"""Moves history rows nobody has updated for HISTORY_RETENTION_DAYS from History to HistoryArchive.
+
+Usage: python -m urfube.archive
+
+Rows move in batches of HISTORY_ARCHIVE_BATCH_SIZE, each its own short transaction, so the hot History table
+is never locked for long and autovacuum can reclaim the space as the job goes. The app runs this every
+HISTORY_ARCHIVE_INTERVAL_SECONDS when a retention period is set.
+"""
+import asyncio
+import datetime
+import logging
+
+from peewee import Value
+
+from urfube import database, models
+from urfube.config import settings
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ['id', 'video_id', 'timestamp', 'length', 'user_id', 'updated']
+
+
+def archive_batch(cutoff: datetime.datetime, now: datetime.datetime):
+    batch = [row[0] for row in models.History.select(models.History.id)
+             .where(models.History.updated < cutoff).limit(settings.history_archive_batch_size).tuples()]
+    if not batch:
+        return 0
+    old = (models.History.select(*[models.History._meta.columns[name] for name in FIELDS], Value(now))
+           .where(models.History.id.in_(batch), models.History.updated < cutoff))
+    with models.History._meta.database.atomic():
+        (models.HistoryArchive.insert_from(old, [models.HistoryArchive._meta.fields[name]
+                                                 for name in [*FIELDS, 'archived']])
+         .on_conflict_ignore()
+         .execute())
+        models.History.delete().where(models.History.id.in_(batch), models.History.updated < cutoff).execute()
+    return len(batch)
+
+
+def archive_history(now: datetime.datetime | None = None):
+    now = now or datetime.datetime.now()
+    cutoff = now - datetime.timedelta(days=settings.history_retention_days)
+    archived = 0
+    while moved := archive_batch(cutoff, now):
+        archived += moved
+    return archived
+
+
+async def run_periodically():
+    while True:
+        try:
+            archived = await asyncio.to_thread(database.run_with_connection, archive_history)
+            if archived:
+                logger.info('archived %d history rows', archived)
+        except Exception:
+            logger.exception('history archiving failed')
+        await asyncio.sleep(settings.history_archive_interval_seconds)
+
+
+if __name__ == '__main__':
+    database.run_with_connection(archive_history)
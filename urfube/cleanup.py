@@ -0,0 +1,133 @@
+"""Removes videos that delete_video has soft-deleted, together with their rows and storage objects.
+
+Usage: python -m urfube.cleanup
+
+The app runs this every CLEANUP_INTERVAL_SECONDS and right after a deletion. Dependent rows go in batches
+of CLEANUP_BATCH_SIZE, each its own short transaction, so a popular video never locks the hot tables for
+long; objects go in DeleteObjects calls of up to 1000 keys. Every step can be repeated, so a run that
+fails half-way is finished by the next one, and a video row is only removed once its objects are gone.
+"""
+import asyncio
+import logging
+
+import peewee
+from peewee import CompositeKey, Tuple
+
+from urfube import crud, database, models, utils
+from urfube.config import settings
+
+logger = logging.getLogger(__name__)
+
+LOCK_ID = 7238
+# Each of these columns leads an index, so every batch below is an index lookup rather than a table scan.
+DEPENDENTS = [
+    models.Comment.video, models.Like.video, models.History.video_id, models.InboxEntry.video,
+    models.TrendingScore.video, models.CoOccurrence.video_id, models.CoOccurrence.other_id,
+    models.Recommendation.video_id, models.Recommendation.recommended_id, models.PlaybackEvent.video_id,
+    models.VideoStats.video_id, models.HistoryArchive.video_id,
+]
+
+wake_up = None
+
+
+def delete_in_batches(field, video_id: int):
+    model = field.model
+    key = model._meta.primary_key
+    columns = [model._meta.fields[name] for name in key.field_names] if isinstance(key, CompositeKey) else [key]
+    target = columns[0] if len(columns) == 1 else Tuple(*columns)
+    deleted = 0
+    while True:
+        batch = list(model.select(*columns).where(field == video_id).limit(settings.cleanup_batch_size).tuples())
+        if not batch:
+            return deleted
+        values = [row[0] for row in batch] if len(columns) == 1 else batch
+        with database.db.atomic():
+            model.delete().where(target.in_(values)).execute()
+        deleted += len(batch)
+
+
+def media_keys(kind: str, name, digest: str | None, variants: str | None):
+    keys = [utils.media_key(kind, name, digest)]
+    if digest is not None and variants:
+        keys += [utils.media_key(kind, name, digest, size) for size in variants.split(',')]
+    return keys
+
+
+def object_keys(video: models.Video):
+    # Objects a video that isn't being purged still uses, because of a duplicate upload or the same thumbnail, stay.
+    others = models.Video.select().where(models.Video.id != video.id, models.Video.deleted.is_null())
+    keys = []
+    video_key = crud.video_key(video)
+    sharing = models.Video.video_key == video_key
+    if video.video_hash is not None:
+        # The original of a duplicate keeps no video_key of its own; it resolves to the key through its id.
+        sharing |= models.Video.video_hash == video.video_hash
+    if not any(crud.video_key(other) == video_key for other in others.where(sharing)):
+        keys.append(video_key)
+    if video.image_hash is None or not others.where(models.Video.image_hash == video.image_hash).exists():
+        keys += media_keys('images', video.id, video.image_hash, video.image_variants)
+    return keys
+
+
+def collect_deleted_videos():
+    db = models.Video._meta.database
+    # One worker purges at a time. The batches are separate transactions, so this is a session lock rather than
+    # a transaction one; a worker that loses the race waits for the next run.
+    if isinstance(db, peewee.PostgresqlDatabase) and \
+            not db.execute_sql('SELECT pg_try_advisory_lock(%s)', (LOCK_ID,)).fetchone()[0]:
+        return {}
+    try:
+        videos = list(models.Video.select().where(models.Video.deleted.is_null(False))
+                      .order_by(models.Video.deleted).limit(settings.cleanup_batch_size))
+        for video in videos:
+            for field in DEPENDENTS:
+                delete_in_batches(field, video.id)
+        return {video.id: object_keys(video) for video in videos}
+    finally:
+        if isinstance(db, peewee.PostgresqlDatabase):
+            db.execute_sql('SELECT pg_advisory_unlock(%s)', (LOCK_ID,))
+
+
+def remove_videos(video_ids: list[int]):
+    for start in range(0, len(video_ids), settings.cleanup_batch_size):
+        batch = video_ids[start:start + settings.cleanup_batch_size]
+        models.Video.delete().where(models.Video.id.in_(batch), models.Video.deleted.is_null(False)).execute()
+
+
+async def purge_deleted_videos():
+    keys = await asyncio.to_thread(database.run_with_connection, collect_deleted_videos)
+    if not keys:
+        return 0
+    failed = set(await utils.delete_objects('jurmaev', [key for video_keys in keys.values() for key in video_keys]))
+    done = [video_id for video_id, video_keys in keys.items() if failed.isdisjoint(video_keys)]
+    await asyncio.to_thread(database.run_with_connection, remove_videos, done)
+    if failed:
+        logger.warning('%d objects could not be deleted, retrying on the next run', len(failed))
+    return len(done)
+
+
+def wake():
+    if wake_up is not None:
+        wake_up.set()
+
+
+async def run_periodically():
+    global wake_up
+    wake_up = asyncio.Event()
+    while True:
+        try:
+            removed = await purge_deleted_videos()
+            if removed:
+                logger.info('removed %d deleted videos', removed)
+        except Exception:
+            logger.exception('video cleanup failed')
+        try:
+            await asyncio.wait_for(wake_up.wait(), settings.cleanup_interval_seconds)
+        except asyncio.TimeoutError:
+            pass
+        wake_up.clear()
+
+
+if __name__ == '__main__':
+    while asyncio.run(purge_deleted_videos()):
+        pass
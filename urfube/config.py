@@ -1,7 +1,8 @@
+import logging
 import os
 import pathlib
 
-from pydantic import BaseSettings
+from pydantic import BaseSettings, validator
 
 
 class Settings(BaseSettings):
@@ -18,9 +19,107 @@ class Settings(BaseSettings):
     user: str
     password: str
     postgres_port: int
+    s3_endpoint_url: str = 'https://storage.yandexcloud.net'
+    # URL of the public-read 'public/' prefix (bucket, CDN or this app's /media); links are signed if unset.
+    public_media_url: str | None = None
+    image_workers: int = 2
+    # Serves content-addressed media from /media/{kind}/{key} through a local disk cache when set.
+    media_cache_dir: str | None = None
+    media_cache_max_bytes: int = 1 << 30
+    cleanup_interval_seconds: int = 60
+    cleanup_batch_size: int = 1000
+    search_language: str = 'simple'
+    search_trigram: bool = True
+    trending_interval_seconds: int = 300
+    trending_half_life_hours: float = 24
+    trending_view_weight: float = 1
+    trending_like_weight: float = 5
+    trending_comment_weight: float = 10
+    recommendations_per_video: int = 20
+    recommendations_batch_size: int = 10000
+    recommendations_like_weight: float = 2
+    # Hash-partitions History by user when set; an existing table is converted once, on the next start.
+    history_partitions: int = 0
+    # Moves history nobody has updated for this many days to HistoryArchive; 0 keeps everything.
+    history_retention_days: int = 0
+    history_archive_interval_seconds: int = 3600
+    history_archive_batch_size: int = 1000
+    analytics_interval_seconds: int = 300
+    analytics_batch_size: int = 10000
+    analytics_retention_days: int = 30
+    subscription_inbox: bool = False
+    inbox_fan_out_limit: int = 10000
+    inbox_batch_size: int = 1000
+    inbox_backfill: int = 50
+    # Newest entries kept per inbox, which is also the most get_subscription_videos returns with the inbox on.
+    inbox_size: int = 500
+    events_backend: str = 'memory'
+    events_queue_size: int = 100
+    events_max_topics: int = 50
+    # 'postgres' shares the rate limit buckets between workers, at one upsert per call.
+    rate_limit_backend: str = 'memory'
+    # Calls per second and burst size for one client (user, or address without a token) and method.
+    rate_limits: dict[str, tuple[float, float]] = {
+        'default': (20, 50), 'login': (1, 10), 'signup': (0.2, 5), 'refresh_tokens': (1, 10),
+        'get_videos': (5, 30), 'get_subscription_videos': (5, 30), 'search_videos': (5, 30),
+        'upload_video': (0.1, 5), 'upload_profile_pic': (0.2, 5),
+    }
+    rate_limit_max_clients: int = 100000
+    # How often the postgres backend deletes buckets that have refilled completely.
+    rate_limit_cleanup_interval_seconds: int = 300
+    # Calls of a method one worker runs at once; more wait up to concurrency_queue_timeout seconds, then fail.
+    concurrency_limits: dict[str, int] = {
+        'login': 8, 'signup': 8, 'get_videos': 32, 'get_subscription_videos': 16, 'search_videos': 16,
+        'upload_video': 8, 'upload_profile_pic': 8,
+    }
+    concurrency_queue_timeout: float = 0.5
+    database_max_connections: int = 20
+    database_min_connections: int = 2
+    database_stale_timeout: int = 300
+    database_pool_timeout: float = 10
+    replica_hosts: list[str] = []
+    replica_eject_seconds: float = 30
+    # Replicas further behind than this are ejected; their lag is checked at most once per replica_lag_check_seconds.
+    replica_max_lag_seconds: float = 5
+    replica_lag_check_seconds: float = 1
+    read_your_writes_seconds: int = 10
+    log_level: str = 'INFO'
+    log_method_levels: dict[str, str] = {}
+    log_sample_rate: float = 1.0
+    log_payloads: bool = True
+    log_max_length: int = 200
+    # Records waiting for the log writer thread; more are dropped and counted in urfube_log_records_dropped_total.
+    log_queue_size: int = 10000
+
+    @validator('log_level')
+    def check_log_level(cls, level: str):
+        if not isinstance(logging.getLevelName(level.upper()), int):
+            raise ValueError(f'unknown log level {level!r}')
+        return level.upper()
+
+    @validator('log_method_levels')
+    def check_log_method_levels(cls, levels: dict[str, str]):
+        return {method: cls.check_log_level(level) for method, level in levels.items()}
 
     class Config:
         env_file = f"{pathlib.Path(__file__).resolve().parent}/.env"
 
 
-settings = Settings()
+class LazySettings:
+    # Reads the environment and .env on first use, so importing the app needs neither.
+    def __init__(self):
+        object.__setattr__(self, '_settings', None)
+
+    def _load(self) -> Settings:
+        if self._settings is None:
+            object.__setattr__(self, '_settings', Settings())
+        return self._settings
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+
+settings = LazySettings()
@@ -1,7 +1,9 @@
 import datetime
 from peewee import *
-from urfube import models, schemas
-from urfube.utils import get_hashed_password, create_presigned_url
+from peewee import Expression
+from urfube import analytics, inbox, models, schemas
+from urfube.config import settings
+from urfube.utils import create_media_links, get_hashed_password, link_epoch, make_etag, media_key
 
 
 def get_user(user_id: int):
@@ -18,73 +20,210 @@ def create_user(user: schemas.UserLogin):
 
 
 def get_video_by_title(title: str):
-    return models.Video.get_or_none(models.Video.title == title.lower())
+    return models.Video.get_or_none(fn.LOWER(models.Video.title) == title.lower(), models.Video.deleted.is_null())
+
+
+def get_progress(history):
+    if history is None:
+        return 0.0, 0.0
+    return history.timestamp, round(history.timestamp / history.length, 2)
+
+
+def user_history_join(query, user_id: int):
+    return query.join_from(models.Video, models.History, JOIN.LEFT_OUTER, attr='history',
+                           on=((models.History.video_id == models.Video.id) & (models.History.user == user_id)))
+
+
+def listed_videos(query):
+    # Leaves out deleted videos and loads video.user with just the avatar hash, so building profile links needs
+    # no query per video.
+    return (query.select_extend(models.User.id, models.User.avatar_hash, models.User.avatar_variants)
+            .join_from(models.Video, models.User).where(models.Video.deleted.is_null()))
+
+
+def stored_size(variants: str | None, size: str):
+    # Uploads from before transcoding, or from before a size was added, fall back to the original.
+    return size if variants and size in variants.split(',') else None
+
+
+def image_key(video: models.Video, size: str = 'medium'):
+    return media_key('images', video.id, video.image_hash, stored_size(video.image_variants, size))
+
+
+def avatar_key(user: models.User, username: str, size: str = 'small'):
+    return media_key('profiles', username, user.avatar_hash, stored_size(user.avatar_variants, size))
+
+
+async def video_returns(rows, profile_link: bool = True):
+    # rows are (video, history) pairs; the links are built in one batch, each distinct key once.
+    image_keys = [image_key(video) for video, _ in rows]
+    profile_keys = [avatar_key(video.user, video.author) if profile_link else None for video, _ in rows]
+    links = await create_media_links(image_keys + [key for key in profile_keys if key is not None])
+    returns = []
+    for (video, history), image, profile in zip(rows, image_keys, profile_keys):
+        timestamp, progress = get_progress(history)
+        returns.append({'title': video.title, 'id': video.id, 'author': video.author, 'views': video.views,
+                        'created': video.created, 'image_link': links[image],
+                        'profile_link': links[profile] if profile_link else '',
+                        'timestamp': timestamp, 'progress': progress})
+    return returns
 
 
 async def get_videos():
-    videos = []
-    for video in models.Video.select():
-        history = get_history_by_id(video.id)
-        timestamp, progress = 0, 0
-        if history is not None:
-            timestamp = history.timestamp
-            progress = round(history.timestamp / history.length, 2)
-        video_dict = {'title': video.title, 'id': video.id, 'author': video.author,
-                      'user_id': video.user.id,
-                      'views': video.views,
-                      'created': video.created,
-                      'image_link': await create_presigned_url('jurmaev', f'images/{video.id}.jpg'),
-                      'profile_link': await create_presigned_url('jurmaev', f'profiles/{video.author}.jpg'),
-                      'timestamp': timestamp, 'progress': progress}
-        videos.append(video_dict)
-    return videos
+    return await video_returns([(video, None) for video in listed_videos(models.Video.select())])
+
+
+async def search_videos(query: str, page: int, per_page: int):
+    ts_query = fn.websearch_to_tsquery(settings.search_language, query)
+    rank = fn.ts_rank_cd(models.Video.search_vector, ts_query)
+    condition = Expression(models.Video.search_vector, '@@', ts_query)
+    if settings.search_trigram:
+        # word_similarity matches the query against any part of the title, so typos still hit; '<%%' is the
+        # pg_trgm "<%" operator with the percent sign escaped for the driver.
+        rank = rank + fn.word_similarity(query.lower(), fn.LOWER(models.Video.title))
+        condition = condition | Expression(query.lower(), '<%%', fn.LOWER(models.Video.title))
+    videos = (listed_videos(models.Video.select()).where(condition)
+              .order_by(rank.desc(), models.Video.id.desc()).paginate(page, per_page))
+    return await video_returns([(video, None) for video in videos])
+
+
+async def get_trending_videos(page: int, per_page: int):
+    videos = (listed_videos(models.Video.select()).join_from(models.Video, models.TrendingScore)
+              .order_by(models.TrendingScore.score.desc()).paginate(page, per_page))
+    return await video_returns([(video, None) for video in videos])
+
+
+async def get_recommendations(video_id: int):
+    videos = (listed_videos(models.Video.select())
+              .join_from(models.Video, models.Recommendation,
+                         on=(models.Recommendation.recommended_id == models.Video.id))
+              .where(models.Recommendation.video_id == video_id)
+              .order_by(models.Recommendation.score.desc()))
+    return await video_returns([(video, None) for video in videos])
+
+
+def avatars_updated():
+    # Avatar links change with the avatar's hash, so cached responses holding them must be revalidated.
+    return models.User.select(fn.MAX(models.User.avatar_updated))
+
+
+def get_videos_etag():
+    videos = models.Video.select(fn.COUNT(models.Video.id), fn.MAX(models.Video.id),
+                                 fn.SUM(models.Video.views), avatars_updated()) \
+        .where(models.Video.deleted.is_null()).scalar(as_tuple=True)
+    return make_etag('videos', videos, link_epoch())
 
 
 def add_or_update_history(user: schemas.User, video: schemas.History):
-    db_video = models.History.get_or_none(models.History.user == user, models.History.video_id == video.video_id)
-    if db_video is not None:
-        db_video.update(**video.dict(), user_id=user.id).execute()
-    else:
-        models.History.create(**video.dict(),
-                              user_id=user.id)
-
-
-async def get_user_history(user: schemas.User):
-    user_history = []
-    for history in get_user(user.id).history:
-        video = get_video_by_id(history.video_id)
-        user_history.append(
-            {'id': history.video_id, 'timestamp': history.timestamp, 'title': video.title, 'author': video.author,
-             'image_link': await create_presigned_url('jurmaev', f'images/{history.video_id}.jpg'),
-             'profile_link': await create_presigned_url('jurmaev', f'profiles/{video.author}.jpg'),
-             'progress': round(history.timestamp / history.length, 2),
-             'views': video.views,
-             'created': video.created})
-    return user_history
+    add_or_update_history_batch(user, [video])
+
+
+def add_or_update_history_batch(user: schemas.User, videos: list[schemas.History]):
+    # One row per video: the last entry wins, as a single upsert can't touch the same row twice.
+    rows = {video.video_id: {**video.dict(), 'user': user.id} for video in videos}
+    (models.History.insert_many(list(rows.values()))
+     .on_conflict(conflict_target=[models.History.user, models.History.video_id],
+                  preserve=[models.History.timestamp, models.History.length, models.History.updated])
+     .execute())
+
+
+def get_existing_video_ids(video_ids: list[int]):
+    return {video_id for video_id, in models.Video.select(models.Video.id)
+            .where(models.Video.id.in_(video_ids), models.Video.deleted.is_null()).tuples()}
+
+
+async def get_user_history(user: schemas.User, page: int, per_page: int):
+    query = (listed_videos(models.History.select(models.History, models.Video)
+                          .join(models.Video, on=(models.History.video_id == models.Video.id), attr='video'))
+             .where(models.History.user == user.id)
+             .order_by(models.History.updated.desc(), models.History.id.desc()).paginate(page, per_page))
+    return await video_returns([(history.video, history) for history in query])
 
 
 def get_history_by_id(video_id: int):
     return models.History.get_or_none(models.History.id == video_id)
 
 
-def upload_video(video: schemas.VideoUpload, user: schemas.User):
-    return models.Video.create(**video.dict(), user_id=user.id, author=user.username, created=datetime.datetime.now())
+def upload_video(video: schemas.VideoUpload, user: schemas.User, image_hash: str | None = None,
+                 image_variants: list[str] = ()):
+    return models.Video.create(**video.dict(), user_id=user.id, author=user.username, created=datetime.datetime.now(),
+                               image_hash=image_hash, image_variants=','.join(image_variants) or None)
+
+
+def video_key(video: models.Video):
+    return video.video_key or f'videos/{video.id}.mp4'
+
+
+def deduplicate_video(video: models.Video, digest: str):
+    # Returns the key of an identical upload the video now shares, or None if its content is new.
+    original = (models.Video.select()
+                .where(models.Video.video_hash == digest, models.Video.id != video.id, models.Video.deleted.is_null())
+                .order_by(models.Video.id).first())
+    key = video_key(original) if original is not None else None
+    models.Video.update(video_hash=digest, video_key=key).where(models.Video.id == video.id).execute()
+    return key
 
 
 def get_video_by_id(video_id: int):
-    return models.Video.get_or_none(models.Video.id == video_id)
+    return models.Video.get_or_none(models.Video.id == video_id, models.Video.deleted.is_null())
 
 
 def delete_video(video_id: int):
-    models.Video.delete_by_id(video_id)
+    # Hidden right away; cleanup.purge_deleted_videos removes the rows and objects later.
+    models.Video.update(deleted=datetime.datetime.now()).where(models.Video.id == video_id).execute()
+
+
+# Deeper replies join their parent's thread, so paths stay short and threads stay readable.
+MAX_COMMENT_DEPTH = 8
+
 
+def mark_trending(video_ids: list[int]):
+    # Counters only shrinking never raises a trending score, so just growth marks a video.
+    models.Video.update(trending_pending=True).where(models.Video.id.in_(video_ids)).execute()
 
-def add_comment(content: str, video_id: int, user: schemas.User):
-    models.Comment.create(content=content, video=video_id, user=user, created=datetime.datetime.now())
 
+def add_comment(content: str, video_id: int, user: schemas.User, parent: models.Comment | None = None):
+    if parent is None:
+        comment = models.Comment.create(content=content, video=video_id, user=user, created=datetime.datetime.now())
+        mark_trending([video_id])
+        return comment
+    if parent.depth >= MAX_COMMENT_DEPTH:
+        parent = models.Comment.get_by_id(parent.parent_id)
+    with models.Comment._meta.database.atomic():
+        comment = models.Comment.create(content=content, video=video_id, user=user, parent=parent,
+                                        depth=parent.depth + 1, created=datetime.datetime.now())
+        # The path ends with the reply's own id, which only the insert gives.
+        comment.root_id = parent.root_id or parent.id
+        comment.path = f'{parent.path}.{comment.id:010d}' if parent.path else f'{comment.id:010d}'
+        comment.save(only=[models.Comment.root_id, models.Comment.path])
+        models.Comment.update(reply_count=models.Comment.reply_count + 1).where(
+            models.Comment.id == parent.id).execute()
+    mark_trending([video_id])
+    return comment
 
-def delete_comment(comment_id: int):
-    models.Comment.delete_by_id(comment_id)
+
+def thread_filter(comment: models.Comment):
+    # Everything below the comment, without the comment itself.
+    if comment.root_id is None:
+        return models.Comment.root_id == comment.id
+    return ((models.Comment.root_id == comment.root_id) & (models.Comment.path > f'{comment.path}.') &
+            (models.Comment.path < f'{comment.path}/'))
+
+
+def is_reply_to(comment: models.Comment, reply: models.Comment):
+    return reply.root_id == (comment.root_id or comment.id) and (
+        comment.path is None or reply.path.startswith(f'{comment.path}.'))
+
+
+def delete_comment(comment: models.Comment):
+    subtree = (models.Comment.id == comment.id) | thread_filter(comment)
+    if comment.parent_id is None:
+        models.Comment.delete().where(subtree).execute()
+        return
+    with models.Comment._meta.database.atomic():
+        models.Comment.delete().where(subtree).execute()
+        models.Comment.update(reply_count=models.Comment.reply_count - 1).where(
+            models.Comment.id == comment.parent_id).execute()
 
 
 def get_comment_by_id(comment_id: int):
@@ -92,14 +231,50 @@ def get_comment_by_id(comment_id: int):
 
 
 def edit_comment(comment_id: int, new_content: str):
-    models.Comment.update(content=new_content).where(models.Comment.id == comment_id).execute()
+    models.Comment.update(content=new_content, updated=datetime.datetime.now()).where(
+        models.Comment.id == comment_id).execute()
+
+
+def get_comments_etag(video_id: int, *view):
+    comments = models.Comment.select(
+        fn.COUNT(models.Comment.id), fn.MAX(models.Comment.id),
+        fn.MAX(fn.COALESCE(models.Comment.updated, models.Comment.created)), avatars_updated()
+    ).where(models.Comment.video == video_id).scalar(as_tuple=True)
+    return make_etag('comments', video_id, *view, comments, link_epoch())
 
 
-async def get_comments(video_id: int):
+async def comment_returns(comments: list[models.Comment]):
+    links = await create_media_links([avatar_key(comment.user, comment.user.username) for comment in comments])
     return [{'content': comment.content, 'author': comment.user.username, 'id': comment.id, 'created': comment.created,
-             'profile_link': await create_presigned_url('jurmaev', f'profiles/{comment.user.username}.jpg')}
-            for comment in
-            list(models.Video.get_by_id(video_id).comments)]
+             'profile_link': links[avatar_key(comment.user, comment.user.username)], 'parent_id': comment.parent_id,
+             'depth': comment.depth, 'reply_count': comment.reply_count}
+            for comment in comments]
+
+
+async def get_comments(video_id: int, page: int, per_page: int, replies: int):
+    # One query: a page of top-level comments, each followed by the first replies of its thread, depth-first.
+    roots = (models.Comment.select(models.Comment.id)
+             .where(models.Comment.video == video_id, models.Comment.parent.is_null())
+             .order_by(models.Comment.id).paginate(page, per_page))
+    thread = fn.COALESCE(models.Comment.root_id, models.Comment.id)
+    order = fn.COALESCE(models.Comment.path, '')
+    ranked = (models.Comment.select(models.Comment.id, fn.ROW_NUMBER().over(partition_by=[thread], order_by=[order])
+                                    .alias('position'))
+              .where(models.Comment.id.in_(roots) | models.Comment.root_id.in_(roots))
+              .alias('ranked'))
+    query = (models.Comment.select(models.Comment, models.User).join(models.User)
+             .join_from(models.Comment, ranked, on=(models.Comment.id == ranked.c.id))
+             .where(ranked.c.position <= replies + 1)
+             .order_by(thread, order))
+    return await comment_returns(list(query))
+
+
+async def get_comment_replies(comment: models.Comment, after: models.Comment | None, per_page: int):
+    query = (models.Comment.select(models.Comment, models.User).join(models.User)
+             .where(thread_filter(comment)).order_by(models.Comment.path).limit(per_page))
+    if after is not None:
+        query = query.where(models.Comment.path > after.path)
+    return await comment_returns(list(query))
 
 
 def user_liked_video(user: schemas.User, video_id: int):
@@ -107,47 +282,110 @@ def user_liked_video(user: schemas.User, video_id: int):
 
 
 def get_likes(video_id: int):
-    return len(list(models.Video.get_by_id(video_id).likes))
+    return models.Like.select().where(models.Like.video == video_id).count()
 
 
 def add_like(user: schemas.User, video_id: int):
     models.Like.create(user=user, video=video_id)
+    mark_trending([video_id])
+
+
+def get_like_states(user: schemas.User, video_ids: list[int]):
+    # Existing videos only, mapped to whether the user already likes them.
+    query = (models.Video.select(models.Video.id, models.Like.video.is_null(False))
+             .join(models.Like, JOIN.LEFT_OUTER,
+                   on=((models.Like.video == models.Video.id) & (models.Like.user == user.id)))
+             .where(models.Video.id.in_(video_ids), models.Video.deleted.is_null()))
+    return dict(query.tuples())
+
+
+def add_likes(user: schemas.User, video_ids: list[int]):
+    models.Like.insert_many([{'user': user.id, 'video': video_id} for video_id in video_ids]) \
+        .on_conflict_ignore().execute()
+    mark_trending(video_ids)
 
 
 def remove_like(user: schemas.User, video_id: int):
     models.Like.delete().where(models.Like.user_id == user, models.Like.video_id == video_id).execute()
 
 
-async def get_liked_videos(user: schemas.User):
-    liked_videos = []
-    for video in user.likes:
-        history = get_history_by_id(video.video_id)
-        video_info = get_video_by_id(video.video_id)
-        liked_videos.append({'id': history.video_id, 'timestamp': history.timestamp, 'title': video_info.title,
-                             'author': video_info.author,
-                             'image_link': await create_presigned_url('jurmaev', f'images/{history.video_id}.jpg'),
-                             'profile_link': await create_presigned_url('jurmaev', f'profiles/{video_info.author}.jpg'),
-                             'progress': round(history.timestamp / history.length, 2),
-                             'views': video_info.views,
-                             'created': video_info.created})
-    return liked_videos
+async def get_liked_videos(user: schemas.User, page: int, per_page: int):
+    query = (user_history_join(
+        listed_videos(models.Video.select(models.Video, models.History)).join_from(models.Video, models.Like),
+        user.id).where(models.Like.user == user.id)
+             .order_by(models.Like.created.desc(), models.Like.video.desc()).paginate(page, per_page))
+    return await video_returns([(video, getattr(video, 'history', None)) for video in query])
 
 
 def add_view(video_id: int):
-    models.Video.update(views=models.Video.views + 1).where(models.Video.id == video_id).execute()
+    models.Video.update(views=models.Video.views + 1, trending_pending=True).where(
+        models.Video.id == video_id).execute()
+
+
+def add_playback_events(user: schemas.User, events: list[schemas.PlaybackEvent]):
+    now = datetime.datetime.now()
+    rows = [{**event.dict(), 'position': min(event.position, event.length), 'user_id': user.id,
+             'hour': analytics.hour_of(now), 'created': now} for event in events]
+    for batch in chunked(rows, 500):
+        models.PlaybackEvent.insert_many(batch).execute()
+
+
+def get_channel_analytics(user: schemas.User, period: str, days: int, video_id: int | None = None):
+    stats = models.VideoStats
+    since = analytics.hour_of(datetime.datetime.now()) - days * 24
+    query = (stats.select(stats.bucket, fn.SUM(stats.views).alias('views'), fn.SUM(stats.viewers).alias('viewers'),
+                          fn.SUM(stats.watch_time).alias('watch_time'),
+                          (fn.SUM(stats.completion * stats.viewers) / fn.SUM(stats.viewers)).alias('completion'))
+             .join(models.Video, on=(stats.video_id == models.Video.id))
+             .where(models.Video.user == user.id, models.Video.deleted.is_null(), stats.period == period,
+                    stats.bucket >= since)
+             .group_by(stats.bucket).order_by(stats.bucket))
+    if video_id is not None:
+        query = query.where(stats.video_id == video_id)
+    # Viewers of a channel-wide bucket add up each video's unique viewers.
+    return [{'start': analytics.bucket_start(row['bucket']), 'views': row['views'], 'viewers': row['viewers'],
+             'watch_time': row['watch_time'], 'completion': row['completion']} for row in query.dicts()]
+
+
+def set_avatar(user: schemas.User, digest: str, variants: list[str]):
+    models.User.update(avatar_hash=digest, avatar_variants=','.join(variants),
+                       avatar_updated=datetime.datetime.now()).where(models.User.id == user.id).execute()
 
 
 def subscribe(subscriber_id: int, channel_id: int):
     models.Subscription.create(subscriber=subscriber_id, channel=channel_id)
+    if settings.subscription_inbox:
+        inbox.backfill(subscriber_id, channel_id)
+
+
+def get_subscription_states(subscriber_id: int, channels: list[str]):
+    # Existing channels only, as (id, username, already subscribed).
+    query = (models.User.select(models.User.id, models.User.username, models.Subscription.subscriber.is_null(False))
+             .join(models.Subscription, JOIN.LEFT_OUTER,
+                   on=((models.Subscription.channel == models.User.id) &
+                       (models.Subscription.subscriber == subscriber_id)))
+             .where(fn.LOWER(models.User.username).in_([channel.lower() for channel in channels])))
+    return list(query.tuples())
+
+
+def subscribe_batch(subscriber_id: int, channel_ids: list[int]):
+    models.Subscription.insert_many([{'subscriber': subscriber_id, 'channel': channel_id}
+                                     for channel_id in channel_ids]).on_conflict_ignore().execute()
+    if settings.subscription_inbox:
+        for channel_id in channel_ids:
+            inbox.backfill(subscriber_id, channel_id)
 
 
 def unsubscribe(subscriber_id: int, channel_id: int):
-    models.Subscription.delete().where(models.Subscription.subscriber == subscriber_id,
-                                       models.Subscription.channel == channel_id).execute()
+    deleted = models.Subscription.delete().where(models.Subscription.subscriber == subscriber_id,
+                                                 models.Subscription.channel == channel_id).execute()
+    if deleted and settings.subscription_inbox:
+        inbox.remove_channel(subscriber_id, channel_id)
+    return deleted
 
 
 def get_subscribers(channel):
-    return len(list(channel.subscriptions))
+    return channel.subscriptions.count()
 
 
 def is_subscribed(user_id: int, channel_id: int):
@@ -157,43 +395,35 @@ def is_subscribed(user_id: int, channel_id: int):
 
 async def get_channel_info(channel: str):
     user = get_user_by_username(channel)
-    return {'channel': channel, 'subscribers': get_subscribers(user), 'videos': user.videos.select().count(),
-            'profile_link': await create_presigned_url('jurmaev', f'profiles/{channel}.jpg')}
+    profile_key = avatar_key(user, channel, 'medium')
+    links = await create_media_links([profile_key])
+    videos = user.videos.select().where(models.Video.deleted.is_null()).count()
+    return {'channel': channel, 'subscribers': get_subscribers(user), 'videos': videos,
+            'profile_link': links[profile_key]}
 
 
 async def get_channel_videos(channel: schemas.User):
-    videos = []
-    for video in channel.videos:
-        history = get_history_by_id(video.id)
-        timestamp, progress = 0, 0
-        if history is not None:
-            timestamp = history.timestamp
-            progress = round(history.timestamp / history.length, 2)
-        video_dict = {'title': video.title, 'id': video.id, 'author': video.author,
-                      'user_id': video.user.id,
-                      'views': video.views,
-                      'created': video.created,
-                      'image_link': await create_presigned_url('jurmaev', f'images/{video.id}.jpg'),
-                      'profile_link': '', 'timestamp': timestamp,
-                      'progress': progress}
-        videos.append(video_dict)
-    return videos
+    videos = channel.videos.select().where(models.Video.deleted.is_null())
+    return await video_returns([(video, None) for video in videos], profile_link=False)
 
 
 async def get_subscription_videos(user: schemas.User):
-    videos = []
-    for channel in user.subscribers:
-        for video in channel.channel.videos:
-            history = get_history_by_id(video.id)
-            timestamp, progress = 0, 0
-            if history is not None:
-                timestamp = history.timestamp
-                progress = round(history.timestamp / history.length, 2)
-            videos.append({'id': video.id, 'title': video.title,
-                           'author': video.author,
-                           'image_link': await create_presigned_url('jurmaev', f'images/{video.id}.jpg'),
-                           'profile_link': await create_presigned_url('jurmaev', f'profiles/{video.author}.jpg'),
-                           'views': video.views,
-                           'created': video.created, 'user_id': user.id, 'timestamp': timestamp,
-                           'progress': progress})
-    return videos
+    if settings.subscription_inbox:
+        # The inbox is read newest first along its (user, created) index. Channels that merge on read come from a
+        # second query, and a channel that switched over can have entries in both.
+        inboxed = (user_history_join(listed_videos(models.Video.select(models.Video, models.History))
+                                     .join_from(models.Video, models.InboxEntry,
+                                                on=(models.InboxEntry.video == models.Video.id)), user.id)
+                   .where(models.InboxEntry.user == user.id)
+                   .order_by(models.InboxEntry.created.desc()).limit(settings.inbox_size))
+        merged = (user_history_join(listed_videos(models.Video.select(models.Video, models.History)), user.id)
+                  .where(models.Video.user.in_(inbox.merged_channels(user.id)))
+                  .order_by(models.Video.created.desc()).limit(settings.inbox_size))
+        videos = sorted({video.id: video for video in [*merged, *inboxed]}.values(),
+                        key=lambda video: (video.created, video.id), reverse=True)[:settings.inbox_size]
+        return await video_returns([(video, getattr(video, 'history', None)) for video in videos])
+    query = user_history_join(
+        listed_videos(models.Video.select(models.Video, models.History))
+        .join_from(models.Video, models.Subscription, on=(models.Subscription.channel == models.Video.user)),
+        user.id).where(models.Subscription.subscriber == user.id)
+    return await video_returns([(video, getattr(video, 'history', None)) for video in query])
@@ -1,11 +1,18 @@
+import itertools
+import threading
+import time
+from contextlib import contextmanager
 from contextvars import ContextVar
 
 import peewee
+from playhouse.pool import PooledPostgresqlDatabase
 
 from urfube.config import settings
 
 db_state_default = {'closed': None, 'conn': None, 'ctx': None, 'transactions': None}
 db_state = ContextVar('db_state', default=db_state_default.copy())
+query_log = ContextVar('query_log', default=None)
+on_write = ContextVar('on_write', default=None)
 
 
 class PeeweeConnectionState(peewee._ConnectionState):
@@ -19,6 +26,196 @@ class PeeweeConnectionState(peewee._ConnectionState):
     def __getattr__(self, name):
         return self._state.get()[name]
 
-db = peewee.PostgresqlDatabase(settings.database_name, host=settings.host, port=settings.postgres_port, user=settings.user,
-                           password=settings.password)
+
+class QueryLog:
+    def __init__(self):
+        self.queries = []
+        self.duration = 0.0
+
+    def __len__(self):
+        return len(self.queries)
+
+
+query_recorders = []
+
+
+@contextmanager
+def record_queries():
+    log = QueryLog()
+    query_recorders.append(log)
+    try:
+        yield log
+    finally:
+        query_recorders.remove(log)
+
+
+class QueryLogMixin:
+    def execute_sql(self, sql, params=None, commit=None):
+        logs = [log for log in (query_log.get(), *query_recorders) if log is not None]
+        if not logs:
+            return super().execute_sql(sql, params, commit)
+        start = time.perf_counter()
+        try:
+            return super().execute_sql(sql, params, commit)
+        finally:
+            duration = time.perf_counter() - start
+            for log in logs:
+                log.duration += duration
+                log.queries.append(sql)
+
+
+class WriteHookMixin:
+    # Calls on_write once a statement that changes rows has run; reads and failed statements do not count.
+    def execute_sql(self, sql, params=None, commit=None):
+        cursor = super().execute_sql(sql, params, commit)
+        callback = on_write.get()
+        if callback is not None and sql.lstrip()[:6].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+            callback()
+        return cursor
+
+
+class PostgresqlDatabase(WriteHookMixin, QueryLogMixin, PooledPostgresqlDatabase):
+    init_lock = threading.Lock()
+
+    def connect(self, reuse_if_open=False):
+        # Configured on the first connection rather than at import.
+        if self.deferred:
+            with self.init_lock:
+                if self.deferred:
+                    self.init(settings.database_name, host=settings.host, port=settings.postgres_port,
+                              user=settings.user, password=settings.password,
+                              max_connections=settings.database_max_connections,
+                              stale_timeout=settings.database_stale_timeout, timeout=settings.database_pool_timeout)
+        return super().connect(reuse_if_open)
+
+    def close_all(self):
+        # A worker that never connected has no pool to close.
+        if not self.deferred:
+            super().close_all()
+
+
+def run_with_connection(func, *args, **kwargs):
+    # For work outside a request (background jobs, threads): give it its own connection state.
+    db_state.set(db_state_default.copy())
+    db._state.reset()
+    with db.connection_context():
+        return func(*args, **kwargs)
+
+
+class RecentWriters:
+    # Users whose writes the replicas may not have replayed yet. Per worker; the cookie carries it across workers.
+    def __init__(self):
+        self.until = {}
+
+    def add(self, user):
+        now = time.monotonic()
+        if len(self.until) >= 10000:
+            self.until = {key: until for key, until in self.until.items() if until > now}
+        self.until[user] = now + settings.read_your_writes_seconds
+
+    def __contains__(self, user):
+        return self.until.get(user, 0) > time.monotonic()
+
+
+class ReplicaDatabase(PostgresqlDatabase):
+    # A replica whose connection breaks mid-query (or that cancels queries while replaying) leaves the rotation.
+    def __init__(self, *args, router, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.router = router
+
+    def execute_sql(self, sql, params=None, commit=None):
+        try:
+            return super().execute_sql(sql, params, commit)
+        except (peewee.OperationalError, peewee.InterfaceError):
+            self.router.eject(self)
+            raise
+
+
+# Seconds of WAL the replica has received but not replayed; 0 when caught up (or when it is not a replica).
+LAG_SQL = '''SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END'''
+
+
+class ReplicaRouter:
+    # Replicas share the request's connection state (db_state), so whichever database connected in a request
+    # is the one every model query in that request runs on.
+    def __init__(self):
+        self.replicas = None
+        self.ejected_until = {}
+        self.lag_checked_until = {}
+        self.turn = itertools.count()
+        self.lock = threading.Lock()
+
+    def get_replicas(self):
+        with self.lock:
+            if self.replicas is None:
+                self.replicas = []
+                for address in settings.replica_hosts:
+                    host, _, port = address.partition(':')
+                    replica = ReplicaDatabase(settings.database_name, host=host,
+                                              port=int(port or settings.postgres_port), user=settings.user,
+                                              password=settings.password,
+                                              max_connections=settings.database_max_connections,
+                                              stale_timeout=settings.database_stale_timeout,
+                                              timeout=settings.database_pool_timeout, router=self)
+                    replica._state = PeeweeConnectionState()
+                    self.replicas.append(replica)
+            return self.replicas
+
+    def eject(self, replica):
+        self.ejected_until[replica] = time.monotonic() + settings.replica_eject_seconds
+
+    def lag(self, replica):
+        return replica.execute_sql(LAG_SQL).fetchone()[0]
+
+    def lagging(self, replica):
+        if self.lag_checked_until.get(replica, 0) > time.monotonic():
+            return False
+        self.lag_checked_until[replica] = time.monotonic() + settings.replica_lag_check_seconds
+        return self.lag(replica) > settings.replica_max_lag_seconds
+
+    def connect(self):
+        replicas = self.get_replicas()
+        start = next(self.turn)
+        for offset in range(len(replicas)):
+            replica = replicas[(start + offset) % len(replicas)]
+            if self.ejected_until.get(replica, 0) > time.monotonic():
+                continue
+            try:
+                replica.connect()
+                if not self.lagging(replica):
+                    return replica
+            except (peewee.OperationalError, peewee.InterfaceError):
+                pass
+            if not replica.is_closed():
+                replica.close()
+            self.eject(replica)
+        db.connect()
+        return db
+
+    def close_all(self):
+        for replica in self.replicas or []:
+            replica.close_all()
+
+
+def warm_pool(count: int):
+    # Open connections up front, each in its own state, then hand them all back to the pool.
+    states = []
+    for _ in range(count):
+        db_state.set(db_state_default.copy())
+        db._state.reset()
+        db.connect()
+        states.append(db_state.get())
+    for state in states:
+        db_state.set(state)
+        db.close()
+
+
+def ping():
+    return run_with_connection(lambda: db.execute_sql('SELECT 1').fetchone()[0] == 1)
+
+
+db = PostgresqlDatabase(None)
 db._state = PeeweeConnectionState()
+replicas = ReplicaRouter()
+recent_writers = RecentWriters()
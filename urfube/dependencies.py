@@ -1,7 +1,7 @@
 from datetime import datetime as dt
 from typing import Annotated
 
-from fastapi import Depends, Header
+from fastapi import Cookie, Depends, Header, Response
 from fastapi.security import SecurityScopes
 from jose import jwt
 from pydantic import ValidationError
@@ -19,7 +19,36 @@ async def reset_db_state():
     database.db._state.reset()
 
 
-def get_db(db_state=Depends(reset_db_state)):
+PRIMARY_COOKIE = 'urfube-primary'
+
+
+def token_user(token: str | None) -> str | None:
+    # Only routes reads; the methods still authenticate the token themselves.
+    if not token:
+        return None
+    try:
+        return jwt.decode(token, settings.jwt_secret_key, algorithms=[settings.algorithm]).get('sub')
+    except jwt.JWTError:
+        return None
+
+
+async def track_writes(response: Response, token: str | None = Header(None, alias='user-auth-token')):
+    # Read-your-writes: once this user's write has run, their reads skip the replicas until they have likely caught
+    # up. Remembered per worker for clients without cookies, and in a cookie naming the user for the other workers.
+    user = token_user(token)
+    if not settings.replica_hosts or user is None:
+        database.on_write.set(None)
+        return
+
+    def wrote():
+        if PRIMARY_COOKIE not in response.headers.get('set-cookie', ''):
+            response.set_cookie(PRIMARY_COOKIE, user, max_age=settings.read_your_writes_seconds, httponly=True)
+        database.recent_writers.add(user)
+
+    database.on_write.set(wrote)
+
+
+def get_db(db_state=Depends(reset_db_state), writes=Depends(track_writes)):
     try:
         database.db.connect()
         yield
@@ -28,6 +57,22 @@ def get_db(db_state=Depends(reset_db_state)):
             database.db.close()
 
 
+def get_read_db(db_state=Depends(reset_db_state), primary: str | None = Cookie(None, alias=PRIMARY_COOKIE),
+                token: str | None = Header(None, alias='user-auth-token')):
+    user = token_user(token) if settings.replica_hosts else None
+    sticky = user is not None and (user in database.recent_writers or primary == user)
+    if settings.replica_hosts and not sticky:
+        target = database.replicas.connect()
+    else:
+        target = database.db
+        target.connect()
+    try:
+        yield
+    finally:
+        if not target.is_closed():
+            target.close()
+
+
 async def get_auth_user(token: str = Header(
     None,
     alias='user-auth-token',
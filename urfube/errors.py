@@ -1,4 +1,5 @@
 import fastapi_jsonrpc as jsonrpc
+from pydantic import BaseModel
 
 
 class AuthError(jsonrpc.BaseError):
@@ -61,6 +62,11 @@ class LinkGenerateFailedError(jsonrpc.BaseError):
     MESSAGE = 'Failed to generate video link'
 
 
+class InvalidImageError(jsonrpc.BaseError):
+    CODE = 3004
+    MESSAGE = 'Could not read image'
+
+
 class CommentDoesNotExistError(jsonrpc.BaseError):
     CODE = 4000
     MESSAGE = 'Comment does not exist'
@@ -74,3 +80,24 @@ class LikeAlreadyExistsError(jsonrpc.BaseError):
 class LikeDoesNotExistError(jsonrpc.BaseError):
     CODE = 5001
     MESSAGE = 'Like does not exist'
+
+
+class NotModifiedError(jsonrpc.BaseError):
+    CODE = 6000
+    MESSAGE = 'Not modified'
+
+
+class RateLimitError(jsonrpc.BaseError):
+    CODE = 8000
+    MESSAGE = 'Too many requests'
+
+    class DataModel(BaseModel):
+        retry_after: float
+
+
+class OverloadedError(jsonrpc.BaseError):
+    CODE = 8001
+    MESSAGE = 'Server is busy, try again later'
+
+    class DataModel(BaseModel):
+        retry_after: float
@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import re
+from collections import defaultdict
+
+import orjson
+import psycopg2
+from fastapi import WebSocket, WebSocketDisconnect
+
+from urfube import database
+from urfube.config import settings
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = 'urfube_events'
+TOPIC = re.compile(r'(video|channel):[\w.-]{1,100}')
+
+
+class Broker:
+    def __init__(self):
+        self.topics = defaultdict(set)
+
+    def add(self, queue: asyncio.Queue, topic: str):
+        self.topics[topic].add(queue)
+
+    def discard(self, queue: asyncio.Queue, topic: str):
+        queues = self.topics.get(topic)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.topics[topic]
+
+    def dispatch(self, message: dict):
+        for queue in list(self.topics.get(message['topic'], ())):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # A client that can't keep up misses deltas rather than holding memory for them.
+                pass
+
+
+broker = Broker()
+
+
+def publish(topic: str, event: str, **data):
+    message = {'topic': topic, 'event': event, **data}
+    if settings.events_backend == 'postgres':
+        # Delivered after commit to every worker, this one included, through listen().
+        database.db.execute_sql('SELECT pg_notify(%s, %s)', (NOTIFY_CHANNEL, orjson.dumps(message).decode()))
+    else:
+        broker.dispatch(message)
+
+
+def connect_listener():
+    connection = psycopg2.connect(dbname=settings.database_name, host=settings.host, port=settings.postgres_port,
+                                  user=settings.user, password=settings.password)
+    try:
+        connection.autocommit = True
+        connection.cursor().execute(f'LISTEN {NOTIFY_CHANNEL}')
+    except psycopg2.Error:
+        connection.close()
+        raise
+    return connection
+
+
+async def listen():
+    loop = asyncio.get_running_loop()
+    while True:
+        connection = None
+        try:
+            # Connecting blocks, and a database that is down can keep it blocked until the connect timeout.
+            connection = await asyncio.to_thread(connect_listener)
+            readable = asyncio.Event()
+            loop.add_reader(connection.fileno(), readable.set)
+            try:
+                while True:
+                    await readable.wait()
+                    readable.clear()
+                    connection.poll()
+                    while connection.notifies:
+                        broker.dispatch(orjson.loads(connection.notifies.pop(0).payload))
+            finally:
+                loop.remove_reader(connection.fileno())
+        except psycopg2.Error:
+            logger.exception('event listener lost its connection')
+            await asyncio.sleep(1)
+        finally:
+            if connection is not None:
+                connection.close()
+
+
+async def serve(websocket: WebSocket):
+    await websocket.accept()
+    queue = asyncio.Queue(maxsize=settings.events_queue_size)
+    topics = set()
+
+    async def send():
+        while True:
+            await websocket.send_text(orjson.dumps(await queue.get()).decode())
+
+    sender = asyncio.create_task(send())
+    try:
+        while True:
+            message = await websocket.receive_json()
+            for topic in message.get('unsubscribe', []):
+                topics.discard(topic)
+                broker.discard(queue, topic)
+            for topic in message.get('subscribe', []):
+                if len(topics) < settings.events_max_topics and isinstance(topic, str) and TOPIC.fullmatch(topic):
+                    topics.add(topic)
+                    broker.add(queue, topic)
+    except WebSocketDisconnect:
+        pass
+    except (ValueError, TypeError, AttributeError):
+        await websocket.close(code=1003)
+    finally:
+        sender.cancel()
+        for topic in topics:
+            broker.discard(queue, topic)
@@ -0,0 +1,55 @@
+import asyncio
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from urfube.config import settings
+
+# Longest side in pixels; avatars are shown from 40px icons up to the channel page, thumbnails from feed cards up.
+VARIANTS = {
+    'profiles': {'small': 96, 'medium': 256, 'large': 512},
+    'images': {'small': 320, 'medium': 640, 'large': 1280},
+}
+FORMAT = 'WEBP'
+QUALITY = 80
+
+pool = None
+
+
+def transcode(data: bytes, kind: str) -> dict[str, bytes]:
+    # Runs in a worker process: decoding and resizing a large upload would stall the event loop for seconds.
+    from PIL import Image, ImageOps
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+        variants = {}
+        for size, pixels in VARIANTS[kind].items():
+            variant = image.copy()
+            variant.thumbnail((pixels, pixels), Image.LANCZOS)
+            output = io.BytesIO()
+            variant.save(output, FORMAT, quality=QUALITY, method=4)
+            variants[size] = output.getvalue()
+    return variants
+
+
+def get_pool():
+    global pool
+    if pool is None:
+        # Workers only import this module, so spawning them doesn't copy the server's threads and sockets.
+        pool = ProcessPoolExecutor(settings.image_workers, mp_context=multiprocessing.get_context('spawn'))
+    return pool
+
+
+async def make_variants(data: bytes, kind: str) -> dict[str, bytes] | None:
+    from PIL import Image
+    try:
+        return await asyncio.get_running_loop().run_in_executor(get_pool(), transcode, data, kind)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+
+def shutdown_pool():
+    global pool
+    if pool is not None:
+        pool.shutdown(cancel_futures=True)
+        pool = None
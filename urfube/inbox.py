@@ -0,0 +1,74 @@
+from peewee import Select, Tuple, Value, fn
+
+from urfube import database, models
+from urfube.config import settings
+
+
+def fan_out_video(video_id: int):
+    video = models.Video.get_or_none(models.Video.id == video_id)
+    if video is None:
+        return 0
+    channel = models.User.get_by_id(video.user_id)
+    if channel.merge_on_read:
+        return 0
+    subscribers = models.Subscription.select().where(models.Subscription.channel == channel.id)
+    if subscribers.limit(settings.inbox_fan_out_limit + 1).count() > settings.inbox_fan_out_limit:
+        models.User.update(merge_on_read=True).where(models.User.id == channel.id).execute()
+        return 0
+    last_subscriber, pushed = 0, 0
+    while True:
+        batch = [subscriber for subscriber, in models.Subscription.select(models.Subscription.subscriber)
+                 .where(models.Subscription.channel == channel.id, models.Subscription.subscriber > last_subscriber)
+                 .order_by(models.Subscription.subscriber).limit(settings.inbox_batch_size).tuples()]
+        if not batch:
+            return pushed
+        entries = [{'user': subscriber, 'video': video.id, 'channel': channel.id, 'created': video.created}
+                   for subscriber in batch]
+        models.InboxEntry.insert_many(entries).on_conflict_ignore().execute()
+        trim(batch)
+        last_subscriber, pushed = batch[-1], pushed + len(batch)
+
+
+def backfill(subscriber_id: int, channel_id: int):
+    latest = (models.Video.select(Value(subscriber_id), models.Video.id, models.Video.user, models.Video.created)
+              .join(models.User)
+              .where(models.Video.user == channel_id, models.Video.deleted.is_null(),
+                     models.User.merge_on_read == False)
+              .order_by(models.Video.created.desc()).limit(settings.inbox_backfill))
+    (models.InboxEntry.insert_from(latest, [models.InboxEntry.user, models.InboxEntry.video,
+                                            models.InboxEntry.channel, models.InboxEntry.created])
+     .on_conflict_ignore().execute())
+    trim([subscriber_id])
+
+
+def trim(user_ids: list[int]):
+    # Only the newest inbox_size entries can reach a feed; older ones would just grow the table.
+    position = fn.ROW_NUMBER().over(partition_by=[models.InboxEntry.user],
+                                    order_by=[models.InboxEntry.created.desc(), models.InboxEntry.video.desc()])
+    ranked = (models.InboxEntry.select(models.InboxEntry.user, models.InboxEntry.video, position.alias('position'))
+              .where(models.InboxEntry.user.in_(user_ids)).alias('ranked'))
+    overflow = Select([ranked], [ranked.c.user_id, ranked.c.video_id]).where(ranked.c.position > settings.inbox_size)
+    models.InboxEntry.delete().where(Tuple(models.InboxEntry.user, models.InboxEntry.video).in_(overflow)).execute()
+
+
+def remove_channel(subscriber_id: int, channel_id: int):
+    models.InboxEntry.delete().where(models.InboxEntry.user == subscriber_id,
+                                     models.InboxEntry.channel == channel_id).execute()
+
+
+def merged_channels(user_id: int):
+    # Channels too big to fan out; their videos are read from the video table instead.
+    return (models.Subscription.select(models.Subscription.channel)
+            .join(models.User, on=(models.User.id == models.Subscription.channel))
+            .where(models.Subscription.subscriber == user_id, models.User.merge_on_read == True))
+
+
+def rebuild():
+    # For switching subscription_inbox on: fill the inboxes from the existing subscriptions.
+    for subscriber_id, channel_id in models.Subscription.select(models.Subscription.subscriber,
+                                                                models.Subscription.channel).tuples().iterator():
+        backfill(subscriber_id, channel_id)
+
+
+if __name__ == '__main__':
+    database.run_with_connection(rebuild)
@@ -0,0 +1,175 @@
+import asyncio
+import contextlib
+import functools
+import logging
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+import fastapi_jsonrpc as jsonrpc
+from fastapi import HTTPException, Request
+from jose import jwt
+
+from urfube import database, errors
+from urfube.config import settings
+from urfube.metrics import ADMISSION_REJECTIONS
+
+logger = logging.getLogger(__name__)
+
+BUCKETS_SQL = '''
+    INSERT INTO ratelimitbucket AS bucket (key, tokens, allowed, updated) VALUES (%(key)s, %(burst)s - 1, TRUE, now())
+    ON CONFLICT (key) DO UPDATE SET
+        tokens = CASE WHEN {refilled} >= 1 THEN {refilled} - 1 ELSE {refilled} END,
+        allowed = {refilled} >= 1,
+        updated = now()
+    RETURNING allowed, tokens
+'''.format(refilled='LEAST(%(burst)s, bucket.tokens + EXTRACT(EPOCH FROM now() - bucket.updated) * %(rate)s)')
+
+
+class TokenBuckets:
+    # Per worker process; with RATE_LIMIT_BACKEND=postgres the buckets are shared by all of them instead.
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+
+    def take(self, key: str, rate: float, burst: float) -> float:
+        """Takes a token; returns 0 on success, otherwise the seconds until the next token."""
+        now = time.monotonic()
+        tokens, updated = self.buckets.pop(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        allowed = tokens >= 1
+        self.buckets[key] = (tokens - 1 if allowed else tokens, now)
+        while len(self.buckets) > self.max_keys:
+            # Least recently seen first; a forgotten client starts again with a full bucket.
+            self.buckets.popitem(last=False)
+        return 0 if allowed else (1 - tokens) / rate
+
+
+buckets = None
+slots = {}
+
+
+def get_buckets():
+    global buckets
+    if buckets is None:
+        buckets = TokenBuckets(settings.rate_limit_max_clients)
+    return buckets
+
+
+def take_shared_token(key: str, rate: float, burst: float) -> float:
+    allowed, tokens = database.db.execute_sql(BUCKETS_SQL, {'key': key, 'rate': rate, 'burst': burst}).fetchone()
+    return 0 if allowed else (1 - tokens) / rate
+
+
+async def take_token(method: str, client: str) -> float:
+    rate, burst = settings.rate_limits.get(method, settings.rate_limits['default'])
+    if rate <= 0:
+        return 0
+    key = f'{method}:{client}'
+    if settings.rate_limit_backend == 'postgres':
+        return await asyncio.to_thread(database.run_with_connection, take_shared_token, key, rate, burst)
+    return get_buckets().take(key, rate, burst)
+
+
+def delete_full_buckets():
+    # A bucket left alone for the longest refill time is full again, the same as having no row at all.
+    refill = max((burst / rate for rate, burst in settings.rate_limits.values() if rate > 0), default=0)
+    return database.db.execute_sql("DELETE FROM ratelimitbucket WHERE updated < now() - %s * interval '1 second'",
+                                   (refill,)).rowcount
+
+
+async def run_periodically():
+    while True:
+        try:
+            deleted = await asyncio.to_thread(database.run_with_connection, delete_full_buckets)
+            if deleted:
+                logger.info('deleted %d full rate limit buckets', deleted)
+        except Exception:
+            logger.exception('rate limit bucket cleanup failed')
+        await asyncio.sleep(settings.rate_limit_cleanup_interval_seconds)
+
+
+def client_key(request: Request) -> str:
+    # The signed token names the user without a database lookup; anyone else is limited by address.
+    token = request.headers.get('user-auth-token')
+    if token:
+        with contextlib.suppress(jwt.JWTError, KeyError):
+            return f"user:{jwt.decode(token, settings.jwt_secret_key, algorithms=[settings.algorithm])['sub']}"
+    return f'ip:{request.client.host if request.client else "unknown"}'
+
+
+def get_slots(method: str) -> asyncio.Semaphore | None:
+    limit = settings.concurrency_limits.get(method)
+    if limit is None:
+        return None
+    if method not in slots:
+        slots[method] = asyncio.Semaphore(limit)
+    return slots[method]
+
+
+def release_unused(semaphore: asyncio.Semaphore):
+    def callback(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is None:
+            semaphore.release()
+    return callback
+
+
+async def acquire(semaphore: asyncio.Semaphore, timeout: float) -> bool:
+    # Before Python 3.12, wait_for() can drop an acquire() that completes just as it times out or is cancelled,
+    # and that slot never comes back. Here an acquire that is given up on releases its slot whenever it completes.
+    task = asyncio.ensure_future(semaphore.acquire())
+    try:
+        await asyncio.wait([task], timeout=timeout)
+    finally:
+        if not task.done():
+            task.cancel()
+            task.add_done_callback(release_unused(semaphore))
+    return task.done() and not task.cancelled()
+
+
+@asynccontextmanager
+async def admission(method: str, request: Request):
+    retry_after = await take_token(method, client_key(request))
+    if retry_after:
+        ADMISSION_REJECTIONS.labels(method, 'rate').inc()
+        raise errors.RateLimitError(data={'retry_after': round(retry_after, 3)})
+    semaphore = get_slots(method)
+    if semaphore is None:
+        yield
+        return
+    # Waiting longer would only add to the pile; past the timeout the client gets an answer right away.
+    if not await acquire(semaphore, settings.concurrency_queue_timeout):
+        ADMISSION_REJECTIONS.labels(method, 'concurrency').inc()
+        raise errors.OverloadedError(data={'retry_after': settings.concurrency_queue_timeout})
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+
+@functools.cache
+def method_names(entrypoint: jsonrpc.Entrypoint) -> frozenset[str]:
+    return frozenset(route.name for route in entrypoint.routes if isinstance(route, jsonrpc.MethodRoute))
+
+
+@asynccontextmanager
+async def admission_middleware(ctx: jsonrpc.JsonRpcContext):
+    # Runs before the method is resolved; unknown names fail on their own without creating buckets.
+    method = ctx.raw_request.get('method') if isinstance(ctx.raw_request, dict) else None
+    if not isinstance(method, str) or method not in method_names(ctx.entrypoint):
+        yield
+        return
+    async with admission(method, ctx.http_request):
+        yield
+
+
+def rest_admission(method: str):
+    async def admit(request: Request):
+        try:
+            async with admission(method, request):
+                yield
+        except (errors.RateLimitError, errors.OverloadedError) as error:
+            status_code = 429 if isinstance(error, errors.RateLimitError) else 503
+            raise HTTPException(status_code, error.MESSAGE,
+                                headers={'Retry-After': str(max(1, round(error.data.retry_after)))})
+    return admit
@@ -0,0 +1,198 @@
+import asyncio
+import contextlib
+import os
+import re
+import tempfile
+from collections import OrderedDict
+from email.utils import formatdate
+
+from fastapi import Response
+from fastapi.responses import StreamingResponse
+
+from urfube import utils
+from urfube.config import settings
+from urfube.metrics import (MEDIA_CACHE_BYTES, MEDIA_CACHE_EVICTED_BYTES, MEDIA_CACHE_EVICTIONS, MEDIA_CACHE_REQUESTS,
+                            S3_LATENCY)
+
+KINDS = ('images', 'profiles')
+# Only content-addressed keys: they never change, so a cached copy never goes stale.
+KEY = re.compile(r'[0-9a-f]{64}(-(small|medium|large))?\.(jpg|webp)')
+RANGE = re.compile(r'bytes=(\d*)-(\d*)')
+MEDIA_TYPES = {'jpg': 'image/jpeg', 'webp': 'image/webp'}
+CHUNK_SIZE = 64 * 1024
+
+
+class MediaCache:
+    # The size cap is kept per worker process; a file another worker evicted is simply fetched again.
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.files = OrderedDict()
+        self.size = 0
+        self.fills = {}
+
+    def load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.startswith('.'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+            elif entry.name.startswith('.fill-'):
+                os.unlink(entry.path)
+        for _, name, size in sorted(entries):
+            self.add(name, size)
+        self.evict()
+
+    def path(self, name: str):
+        return os.path.join(self.directory, name)
+
+    def add(self, name: str, size: int):
+        self.files[name] = size
+        self.size += size
+        MEDIA_CACHE_BYTES.inc(size)
+
+    def forget(self, name: str):
+        size = self.files.pop(name)
+        self.size -= size
+        MEDIA_CACHE_BYTES.dec(size)
+        return size
+
+    def evict(self, keep: str | None = None):
+        if self.size <= self.max_bytes:
+            return
+        for name in list(self.files):
+            if self.size <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            size = self.forget(name)
+            MEDIA_CACHE_EVICTIONS.inc()
+            MEDIA_CACHE_EVICTED_BYTES.inc(size)
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.path(name))
+
+    async def get(self, kind: str, key: str):
+        # Returns the file already open: an open file stays readable after it is unlinked, so evicting it while it
+        # is served (here, or by another worker sharing the directory) can't break the response.
+        name = f'{kind}-{key}'
+        if name in self.files:
+            try:
+                file = open(self.path(name), 'rb')
+            except FileNotFoundError:
+                self.forget(name)
+            else:
+                self.files.move_to_end(name)
+                MEDIA_CACHE_REQUESTS.labels('hit').inc()
+                return file
+        while True:
+            fill = self.fills.get(name)
+            if fill is None:
+                MEDIA_CACHE_REQUESTS.labels('miss').inc()
+                # Single flight: concurrent misses for one file wait on the same download.
+                fill = self.fills[name] = asyncio.create_task(self.fill(kind, key, name))
+                fill.add_done_callback(lambda _: self.fills.pop(name, None))
+            else:
+                MEDIA_CACHE_REQUESTS.labels('coalesced').inc()
+            path = await asyncio.shield(fill)
+            if path is None:
+                return None
+            try:
+                return open(path, 'rb')
+            except FileNotFoundError:
+                # Evicted by other fills before this request got to it.
+                if name in self.files:
+                    self.forget(name)
+
+    async def fill(self, kind: str, key: str, name: str) -> str | None:
+        from botocore.exceptions import ClientError
+        async with utils.get_s3_client() as s3:
+            try:
+                with S3_LATENCY.labels('download').time():
+                    response = await s3.get_object(Bucket='jurmaev', Key=f'{utils.PUBLIC_MEDIA_PREFIX}/{kind}/{key}')
+                    async with response['Body'] as body:
+                        data = await body.read()
+            except ClientError as error:
+                if error.response['Error']['Code'] in ('NoSuchKey', '404'):
+                    return None
+                raise
+        await asyncio.to_thread(self.write, name, data)
+        self.add(name, len(data))
+        # The file just fetched stays until the next fill, so its waiters can still open it.
+        self.evict(keep=name)
+        return self.path(name)
+
+    def write(self, name: str, data: bytes):
+        # Readers never see a partly written file.
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory, prefix='.fill-')
+        with os.fdopen(descriptor, 'wb') as file:
+            file.write(data)
+        os.replace(temporary, self.path(name))
+
+
+cache = None
+
+
+def get_cache():
+    global cache
+    if cache is None:
+        cache = MediaCache(settings.media_cache_dir, settings.media_cache_max_bytes)
+        cache.load()
+    return cache
+
+
+def parse_range(value: str | None, size: int):
+    # None serves the whole file: no header, or one this cache doesn't handle (several ranges).
+    match = RANGE.fullmatch(value.strip()) if value else None
+    if match is None or match.groups() == ('', ''):
+        return None
+    start, end = match.groups()
+    if not start:
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError('unsatisfiable range')
+    return start, end
+
+
+def read_range(file, start: int, end: int):
+    file.seek(start)
+    return file.read(end - start + 1)
+
+
+async def read_chunks(file):
+    with file:
+        while chunk := await asyncio.to_thread(file.read, CHUNK_SIZE):
+            yield chunk
+
+
+async def serve(kind: str, key: str, headers) -> Response:
+    if not settings.media_cache_dir or kind not in KINDS or not KEY.fullmatch(key):
+        return Response(status_code=404)
+    etag = f'"{key}"'
+    response_headers = {'ETag': etag, 'Cache-Control': utils.IMMUTABLE_MEDIA_ARGS['CacheControl'],
+                        'Accept-Ranges': 'bytes'}
+    if_none_match = headers.get('if-none-match')
+    if utils.etag_matches(etag, if_none_match) or (if_none_match is None and headers.get('if-modified-since')):
+        return Response(status_code=304, headers=response_headers)
+    file = await get_cache().get(kind, key)
+    if file is None:
+        return Response(status_code=404)
+    stat = os.fstat(file.fileno())
+    media_type = MEDIA_TYPES[key.rsplit('.', 1)[1]]
+    if_range = headers.get('if-range')
+    try:
+        byte_range = parse_range(headers.get('range'), stat.st_size) if if_range in (None, etag) else None
+    except ValueError:
+        file.close()
+        return Response(status_code=416, headers={**response_headers, 'Content-Range': f'bytes */{stat.st_size}'})
+    if byte_range is None:
+        return StreamingResponse(read_chunks(file), media_type=media_type, headers={
+            **response_headers, 'Content-Length': str(stat.st_size),
+            'Last-Modified': formatdate(stat.st_mtime, usegmt=True)})
+    start, end = byte_range
+    with file:
+        content = await asyncio.to_thread(read_range, file, start, end)
+    return Response(content, status_code=206, media_type=media_type,
+                    headers={**response_headers, 'Content-Range': f'bytes {start}-{end}/{stat.st_size}'})
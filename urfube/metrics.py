@@ -0,0 +1,57 @@
+import os
+import time
+from contextlib import asynccontextmanager
+
+import fastapi_jsonrpc as jsonrpc
+from fastapi import Response
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest,
+                               multiprocess)
+
+from urfube.database import QueryLog, query_log
+
+REQUEST_LATENCY = Histogram('urfube_jsonrpc_request_duration_seconds', 'JSON-RPC method latency', ['method'])
+REQUEST_ERRORS = Counter('urfube_jsonrpc_errors_total', 'JSON-RPC error responses', ['method', 'code'])
+REQUEST_QUERIES = Histogram('urfube_jsonrpc_db_queries', 'SQL queries issued per JSON-RPC call', ['method'],
+                            buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144, 233))
+REQUEST_DB_TIME = Histogram('urfube_jsonrpc_db_duration_seconds', 'Time spent in SQL per JSON-RPC call', ['method'])
+S3_LATENCY = Histogram('urfube_s3_operation_duration_seconds', 'S3 call latency', ['operation'])
+ADMISSION_REJECTIONS = Counter('urfube_admission_rejections_total', 'Calls turned away by rate or concurrency limits',
+                               ['method', 'reason'])
+MEDIA_CACHE_REQUESTS = Counter('urfube_media_cache_requests_total', 'Media cache lookups', ['result'])
+MEDIA_CACHE_EVICTIONS = Counter('urfube_media_cache_evictions_total', 'Files evicted from the media cache')
+MEDIA_CACHE_EVICTED_BYTES = Counter('urfube_media_cache_evicted_bytes_total', 'Bytes evicted from the media cache')
+LOG_RECORDS_DROPPED = Counter('urfube_log_records_dropped_total', 'Log records dropped because the log queue was full')
+MEDIA_CACHE_BYTES = Gauge('urfube_media_cache_bytes', 'Bytes held in the media cache', multiprocess_mode='livesum')
+
+
+@asynccontextmanager
+async def metrics_middleware(ctx: jsonrpc.JsonRpcContext):
+    log = QueryLog()
+    token = query_log.set(log)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        query_log.reset(token)
+        method = ctx.method_route.name if ctx.method_route is not None else 'unknown'
+        REQUEST_LATENCY.labels(method).observe(duration)
+        REQUEST_QUERIES.labels(method).observe(len(log))
+        REQUEST_DB_TIME.labels(method).observe(log.duration)
+        error = (ctx.raw_response or {}).get('error')
+        if error is not None:
+            REQUEST_ERRORS.labels(method, str(error.get('code'))).inc()
+
+
+def metrics_endpoint():
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        # Several workers: any one of them answers for all, from the files they share.
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(content=generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+def mark_process_dead():
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        multiprocess.mark_process_dead(os.getpid())
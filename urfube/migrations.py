@@ -0,0 +1,145 @@
+import peewee
+from playhouse.migrate import SchemaMigrator, migrate
+
+from urfube import models
+from urfube.config import settings
+from urfube.database import db
+
+MODELS = [models.User, models.Video, models.History, models.HistoryArchive, models.Comment, models.Like, models.Subscription,
+          models.TrendingScore, models.CoOccurrence, models.Recommendation,
+          models.InboxEntry, models.PlaybackEvent, models.VideoStats, models.RateLimitBucket]
+SCHEMA_LOCK_ID = 7234
+
+
+def add_missing_columns(database, model_list):
+    migrator = SchemaMigrator.from_database(database)
+    operations = []
+    tables = set(database.get_tables())
+    for model in model_list:
+        table = model._meta.table_name
+        if table not in tables:
+            continue
+        existing = {column.name for column in database.get_columns(table)}
+        for field in model._meta.sorted_fields:
+            if field.column_name not in existing:
+                operations.append(migrator.add_column(table, field.column_name, field))
+    if operations:
+        with database.atomic():
+            migrate(*operations)
+
+
+def is_partitioned(database, table: str):
+    return isinstance(database, peewee.PostgresqlDatabase) and database.execute_sql(
+        'SELECT 1 FROM pg_partitioned_table JOIN pg_class ON pg_class.oid = partrelid WHERE relname = %s',
+        (table,)).fetchone() is not None
+
+
+def deduplicate_history(database):
+    # The unique (user, video_id) index can't be built over the duplicate rows older history updates left behind.
+    # A partitioned table always has it, but get_indexes doesn't list a partitioned table's indexes.
+    if 'history' not in database.get_tables() or is_partitioned(database, 'history') or \
+            any(index.name == 'history_user_id_video_id' for index in database.get_indexes('history')):
+        return
+    database.execute_sql('DELETE FROM history WHERE id NOT IN '
+                         '(SELECT MAX(id) FROM history GROUP BY user_id, video_id)')
+
+
+def carry_over_recommender_state(database):
+    # Counted rows used to be tracked by a History.id and a Like.created watermark; mark the rows they covered once.
+    if 'recommenderstate' not in database.get_tables():
+        return
+    state = database.execute_sql('SELECT history_id, like_created FROM recommenderstate').fetchone()
+    with database.atomic():
+        if state is not None:
+            models.History.update(counted=True).where(models.History.id <= state[0]).execute()
+            if state[1] is not None:
+                models.Like.update(counted=True).where(models.Like.created <= state[1]).execute()
+        database.execute_sql('DROP TABLE recommenderstate')
+
+
+def carry_over_analytics_state(database):
+    # Rolled up events used to be tracked by an id watermark; mark the events it covered once.
+    if 'analyticsstate' not in database.get_tables():
+        return
+    state = database.execute_sql('SELECT event_id FROM analyticsstate').fetchone()
+    with database.atomic():
+        if state is not None:
+            models.PlaybackEvent.update(rolled_up=True).where(models.PlaybackEvent.id <= state[0]).execute()
+        database.execute_sql('DROP TABLE analyticsstate')
+
+
+def partition_history(database, partitions: int):
+    # Hash partitions by user: one user's reads and upserts touch one small table and its indexes, and autovacuum
+    # works through the partitions one by one. The number of partitions is fixed once the table is converted.
+    if is_partitioned(database, 'history'):
+        return
+    with database.atomic():
+        database.execute_sql('ALTER TABLE history RENAME TO history_unpartitioned')
+        database.execute_sql('CREATE TABLE history (LIKE history_unpartitioned INCLUDING DEFAULTS) '
+                             'PARTITION BY HASH (user_id)')
+        for remainder in range(partitions):
+            database.execute_sql(f'CREATE TABLE history_{remainder} PARTITION OF history '
+                                 f'FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})')
+        database.execute_sql('INSERT INTO history SELECT * FROM history_unpartitioned')
+        # The id sequence would otherwise be dropped with the old table.
+        database.execute_sql('ALTER SEQUENCE history_id_seq OWNED BY history.id')
+        database.execute_sql('DROP TABLE history_unpartitioned')
+        # Unique keys of a partitioned table must contain the partition key.
+        database.execute_sql('ALTER TABLE history ADD PRIMARY KEY (id, user_id)')
+        database.execute_sql('ALTER TABLE history ADD FOREIGN KEY (user_id) REFERENCES "user" (id)')
+        database.create_tables([models.History])
+
+
+def create_search_index(database):
+    language = settings.search_language
+    with database.atomic():
+        database.execute_sql(f'''
+            CREATE OR REPLACE FUNCTION video_search_vector_update() RETURNS trigger AS $$
+            BEGIN
+                NEW.search_vector := setweight(to_tsvector('{language}', coalesce(NEW.title, '')), 'A') ||
+                                     setweight(to_tsvector('{language}', coalesce(NEW.description, '')), 'B');
+                RETURN NEW;
+            END
+            $$ LANGUAGE plpgsql''')
+        # Replacing the trigger would lock the video table on every start; the function above is enough to update.
+        # Rows only lack a search_vector from before the trigger existed, so they are filled in just once, here.
+        if not database.execute_sql("SELECT 1 FROM pg_trigger WHERE tgname = 'video_search_vector_update' "
+                                    "AND tgrelid = 'video'::regclass").fetchone():
+            database.execute_sql('CREATE TRIGGER video_search_vector_update BEFORE INSERT OR UPDATE OF title, '
+                                 'description ON video FOR EACH ROW EXECUTE FUNCTION video_search_vector_update()')
+            database.execute_sql('UPDATE video SET title = title WHERE search_vector IS NULL')
+        database.execute_sql('CREATE INDEX IF NOT EXISTS video_search_vector ON video USING GIN (search_vector)')
+        if settings.search_trigram:
+            database.execute_sql('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            database.execute_sql('CREATE INDEX IF NOT EXISTS video_title_trgm ON video '
+                                 'USING GIN (lower(title) gin_trgm_ops)')
+
+
+def create_schema(database=db, model_list=None):
+    model_list = model_list or MODELS
+    if isinstance(database, peewee.PostgresqlDatabase):
+        # Workers starting together would otherwise race on CREATE TABLE/INDEX.
+        database.execute_sql('SELECT pg_advisory_lock(%s)', (SCHEMA_LOCK_ID,))
+        try:
+            update_schema(database, model_list)
+        finally:
+            database.execute_sql('SELECT pg_advisory_unlock(%s)', (SCHEMA_LOCK_ID,))
+    else:
+        update_schema(database, model_list)
+
+
+def update_schema(database, model_list):
+    # New columns first: create_tables also creates indexes, which may cover them.
+    add_missing_columns(database, model_list)
+    if models.History in model_list:
+        deduplicate_history(database)
+    if models.History in model_list and models.Like in model_list:
+        carry_over_recommender_state(database)
+    if models.PlaybackEvent in model_list:
+        carry_over_analytics_state(database)
+    database.create_tables(model_list)
+    if isinstance(database, peewee.PostgresqlDatabase) and models.History in model_list and \
+            settings.history_partitions > 0:
+        partition_history(database, settings.history_partitions)
+    if isinstance(database, peewee.PostgresqlDatabase) and models.Video in model_list:
+        create_search_index(database)
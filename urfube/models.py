@@ -1,4 +1,7 @@
+import datetime
+
 from peewee import *
+from playhouse.postgres_ext import TSVectorField
 
 from .database import db
 
@@ -11,6 +14,12 @@ class BaseModel(Model):
 class User(BaseModel):
     username = CharField(unique=True)
     password = CharField()
+    # Set once a channel has too many subscribers to fan out to; its videos are merged into feeds on read.
+    merge_on_read = BooleanField(default=False)
+    avatar_hash = CharField(null=True)
+    # Comma-separated names of the transcoded sizes stored next to the original, see images.VARIANTS.
+    avatar_variants = CharField(null=True)
+    avatar_updated = DateTimeField(null=True, index=True)
 
 
 class Video(BaseModel):
@@ -20,13 +29,50 @@ class Video(BaseModel):
     views = IntegerField(default=0)
     user = ForeignKeyField(User, backref='videos')
     created = DateTimeField()
+    image_hash = CharField(null=True)
+    image_variants = CharField(null=True)
+    video_hash = CharField(null=True, index=True)
+    # Set when the video shares another upload's identical object; otherwise it is stored at videos/{id}.mp4.
+    video_key = CharField(null=True)
+    deleted = DateTimeField(null=True, index=True)
+    # Maintained by a Postgres trigger, see migrations.create_search_index.
+    search_vector = TSVectorField(null=True, index=False)
+    # Set when views, likes or comments grew; trending.py only recounts these videos, then clears it.
+    trending_pending = BooleanField(default=True)
+
+
+Video.add_index(Video.index(Video.id, where=(Video.trending_pending == True), name='video_trending_pending'))
 
 
 class History(BaseModel):
-    video_id = IntegerField()
+    video_id = IntegerField(index=True)
     timestamp = FloatField()
     length = FloatField()
     user = ForeignKeyField(User, backref='history')
+    # Indexed on its own too, for archive.py's scan of rows older than the retention period.
+    updated = DateTimeField(default=datetime.datetime.now, index=True)
+    # Set once recommendations.py has counted the row's pairs.
+    counted = BooleanField(default=False)
+
+    class Meta:
+        indexes = (
+            (('user', 'video_id'), True),
+            (('user', 'updated'), False),
+        )
+
+
+History.add_index(History.index(History.id, where=(History.counted == False), name='history_uncounted'))
+
+
+class HistoryArchive(BaseModel):
+    # History rows older than the retention period, moved here by archive.py; nothing in the app reads them.
+    id = IntegerField(primary_key=True)
+    video_id = IntegerField(index=True)
+    timestamp = FloatField()
+    length = FloatField()
+    user_id = IntegerField()
+    updated = DateTimeField()
+    archived = DateTimeField(default=datetime.datetime.now)
 
 
 class Comment(BaseModel):
@@ -34,16 +80,130 @@ class Comment(BaseModel):
     user = ForeignKeyField(User, backref='comments')
     video = ForeignKeyField(Video, backref='comments')
     created = DateTimeField()
+    updated = DateTimeField(null=True)
+    parent = ForeignKeyField('self', null=True, backref='children', on_delete='CASCADE')
+    # Replies only: the top-level comment of the thread, and the zero-padded ids from below it down to the reply,
+    # dot-separated, so a thread sorts depth-first by path and a reply's subtree is one path range.
+    root_id = IntegerField(null=True)
+    path = CharField(null=True)
+    depth = IntegerField(default=0)
+    reply_count = IntegerField(default=0)
+
+    class Meta:
+        indexes = (
+            (('root_id', 'path'), False),
+        )
 
 
 class Like(BaseModel):
     user = ForeignKeyField(User, backref='likes')
     video = ForeignKeyField(Video, backref='likes')
+    created = DateTimeField(default=datetime.datetime.now, index=True)
+    # Set once recommendations.py has counted the row's pairs.
+    counted = BooleanField(default=False)
 
     class Meta:
         primary_key = CompositeKey('user', 'video')
 
 
+Like.add_index(Like.index(Like.user, Like.video, where=(Like.counted == False), name='like_uncounted'))
+
+
+class TrendingScore(BaseModel):
+    video = ForeignKeyField(Video, primary_key=True, backref='trending', on_delete='CASCADE')
+    # log2 of the decayed score, shifted so that scores from different runs compare directly.
+    score = FloatField(index=True)
+    views = IntegerField()
+    likes = IntegerField()
+    comments = IntegerField()
+    updated = DateTimeField()
+
+
+class InboxEntry(BaseModel):
+    user = ForeignKeyField(User, backref='inbox', on_delete='CASCADE')
+    video = ForeignKeyField(Video, on_delete='CASCADE')
+    channel = ForeignKeyField(User, on_delete='CASCADE', index=False)
+    created = DateTimeField()
+
+    class Meta:
+        primary_key = CompositeKey('user', 'video')
+        indexes = (
+            (('user', 'created'), False),
+            (('user', 'channel'), False),
+        )
+
+
+class CoOccurrence(BaseModel):
+    # Pair weights for the recommender; the (video_id, video_id) entry holds the video's own weight.
+    video_id = IntegerField()
+    other_id = IntegerField(index=True)
+    weight = FloatField()
+    updated = DateTimeField(index=True)
+
+    class Meta:
+        primary_key = CompositeKey('video_id', 'other_id')
+
+
+class Recommendation(BaseModel):
+    video_id = IntegerField()
+    recommended_id = IntegerField(index=True)
+    score = FloatField()
+
+    class Meta:
+        primary_key = CompositeKey('video_id', 'recommended_id')
+        indexes = (
+            (('video_id', 'score'), False),
+        )
+
+
+class PlaybackEvent(BaseModel):
+    # Append-only player reports, rolled up into VideoStats by analytics.py and dropped after the retention period.
+    id = BigAutoField()
+    video_id = IntegerField()
+    user_id = IntegerField()
+    # Hours since the epoch (UTC), the rollup bucket.
+    hour = IntegerField()
+    position = FloatField()
+    watched = FloatField()
+    length = FloatField()
+    started = BooleanField(default=False)
+    created = DateTimeField(default=datetime.datetime.now, index=True)
+    # Set once the event is counted in VideoStats. Ids from concurrent inserts can commit out of order, so an id
+    # watermark would skip some.
+    rolled_up = BooleanField(default=False)
+
+    class Meta:
+        indexes = (
+            (('video_id', 'hour'), False),
+        )
+
+
+PlaybackEvent.add_index(PlaybackEvent.index(PlaybackEvent.id, where=(PlaybackEvent.rolled_up == False),
+                                            name='playbackevent_pending'))
+
+
+class VideoStats(BaseModel):
+    video_id = IntegerField()
+    period = CharField(max_length=4)
+    # First hour of the bucket in hours since the epoch (UTC), for days as well.
+    bucket = IntegerField()
+    views = IntegerField()
+    viewers = IntegerField()
+    watch_time = DoubleField()
+    completion = DoubleField()
+
+    class Meta:
+        primary_key = CompositeKey('video_id', 'period', 'bucket')
+
+
+class RateLimitBucket(BaseModel):
+    # Token buckets shared by all workers when RATE_LIMIT_BACKEND=postgres, see limits.py.
+    key = CharField(primary_key=True)
+    tokens = DoubleField()
+    allowed = BooleanField()
+    updated = DateTimeField()
+
+
 class Subscription(BaseModel):
     subscriber = ForeignKeyField(User, backref='subscribers')
     channel = ForeignKeyField(User, backref='subscriptions')
@@ -0,0 +1,112 @@
+"""Item-to-item "up next" recommendations from co-watch (History) and co-like (Like) counts.
+
+Usage: python -m urfube.recommendations [--full]
+
+Each run only counts the history and like rows not counted yet, batch by batch, and adds them to the pair
+weights in CoOccurrence with upserts, so the counting stays inside the database and memory stays bounded.
+Rows are marked as they are counted rather than tracked by id or timestamp, which concurrent inserts can
+commit out of order. The top neighbours are then recomputed for the videos whose weights changed and for
+their neighbours. Removed likes and history are only forgotten by a --full rebuild.
+"""
+import argparse
+import datetime
+
+from peewee import EXCLUDED, SQL, Select, Tuple, Value, fn
+
+from urfube import database, models
+from urfube.config import settings
+
+
+def add_weights(query):
+    fields = [models.CoOccurrence.video_id, models.CoOccurrence.other_id, models.CoOccurrence.weight,
+              models.CoOccurrence.updated]
+    (models.CoOccurrence.insert_from(query, fields)
+     .on_conflict(conflict_target=[models.CoOccurrence.video_id, models.CoOccurrence.other_id],
+                  update={models.CoOccurrence.weight: models.CoOccurrence.weight + EXCLUDED.weight,
+                          models.CoOccurrence.updated: EXCLUDED.updated})
+     .execute())
+
+
+def add_pairs(model, in_batch, earlier, weight: float, now: datetime.datetime):
+    # Each pair of one user's rows is counted once: when the later of the two rows is in the batch.
+    new, old = model.alias('new'), model.alias('old')
+    for video, other in ((new.video_id, old.video_id), (old.video_id, new.video_id)):
+        add_weights(new.select(video, other, fn.COUNT(SQL('*')) * weight, Value(now))
+                    .join(old, on=(old.user == new.user) & earlier(old, new) & (old.video_id != new.video_id))
+                    .where(in_batch(new))
+                    .group_by(video, other))
+    add_weights(new.select(new.video_id, new.video_id, fn.COUNT(SQL('*')) * weight, Value(now))
+                .where(in_batch(new))
+                .group_by(new.video_id))
+
+
+def row_key(table, key: list[str]):
+    return getattr(table, key[0]) if len(key) == 1 else Tuple(*[getattr(table, name) for name in key])
+
+
+def add_rows(model, key: list[str], weight: float, now: datetime.datetime):
+    while True:
+        batch = list(model.select(*[getattr(model, name) for name in key]).where(model.counted == False)
+                     .limit(settings.recommendations_batch_size).tuples())
+        if not batch:
+            return
+        values = [row[0] for row in batch] if len(key) == 1 else batch
+
+        def in_batch(table):
+            return row_key(table, key).in_(values)
+
+        def earlier(old, new):
+            # "Later" is whichever row is counted last, and within one batch the one with the greater key.
+            return (old.counted == True) | (in_batch(old) & (row_key(old, key) < row_key(new, key)))
+
+        with model._meta.database.atomic():
+            add_pairs(model, in_batch, earlier, weight, now)
+            model.update(counted=True).where(in_batch(model)).execute()
+
+
+def refresh_recommendations(since: datetime.datetime):
+    # A score also depends on the other video's own weight, so a change reranks every video paired with it.
+    changed = (models.CoOccurrence.select(models.CoOccurrence.video_id)
+               .where(models.CoOccurrence.updated >= since).distinct())
+    changed = (models.CoOccurrence.select(models.CoOccurrence.other_id)
+               .where(models.CoOccurrence.video_id.in_(changed)).distinct())
+    pair, own, other = (models.CoOccurrence.alias('pair'), models.CoOccurrence.alias('own'),
+                        models.CoOccurrence.alias('other'))
+    # Squared cosine similarity: same order as the cosine without needing sqrt in every database.
+    score = pair.weight * pair.weight / (own.weight * other.weight)
+    position = fn.ROW_NUMBER().over(partition_by=[pair.video_id], order_by=[score.desc(), pair.other_id])
+    ranked = (pair.select(pair.video_id, pair.other_id, score.alias('score'), position.alias('position'))
+              .join(own, on=(own.video_id == pair.video_id) & (own.other_id == pair.video_id))
+              .join(other, on=(other.video_id == pair.other_id) & (other.other_id == pair.other_id))
+              .where(pair.video_id.in_(changed) & (pair.video_id != pair.other_id))
+              .alias('ranked'))
+    top = (Select([ranked], [ranked.c.video_id, ranked.c.other_id, ranked.c.score])
+           .where(ranked.c.position <= settings.recommendations_per_video))
+    with models.Recommendation._meta.database.atomic():
+        models.Recommendation.delete().where(models.Recommendation.video_id.in_(changed)).execute()
+        models.Recommendation.insert_from(top, [models.Recommendation.video_id, models.Recommendation.recommended_id,
+                                                models.Recommendation.score]).execute()
+
+
+def build_recommendations(full: bool = False):
+    now = datetime.datetime.now()
+    if full:
+        with models.CoOccurrence._meta.database.atomic():
+            for model in (models.CoOccurrence, models.Recommendation):
+                model.delete().execute()
+            for model in (models.History, models.Like):
+                model.update(counted=False).where(model.counted == True).execute()
+    add_rows(models.History, ['id'], 1, now)
+    add_rows(models.Like, ['user', 'video'], settings.recommendations_like_weight, now)
+    refresh_recommendations(now)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--full', action='store_true', help='forget the stored weights and recount everything')
+    args = parser.parse_args()
+    database.run_with_connection(build_recommendations, args.full)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+import json
+import logging
+import queue
+import random
+import time
+from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
+
+import fastapi_jsonrpc as jsonrpc
+
+from urfube.config import settings
+from urfube.metrics import LOG_RECORDS_DROPPED
+
+REDACTED_KEYS = {'password', 'token', 'access_token', 'refresh_token', 'user-auth-token'}
+MAX_ITEMS = 5
+MAX_DEPTH = 4
+
+logger = logging.getLogger('urfube.requests')
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name,
+                 'message': record.getMessage()}
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(QueueHandler):
+    # Records are formatted by the listener thread, not by the request coroutine.
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        # A full queue means the output can't keep up; dropping beats blocking requests or growing without limit.
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+listener = None
+previous_handlers = []
+
+
+def start_logging():
+    # Called at app startup: anything that only imports the app keeps its own logging setup.
+    global listener, previous_handlers
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter())
+    log_queue = queue.Queue(settings.log_queue_size)
+    root = logging.getLogger()
+    root.setLevel(settings.log_level)
+    previous_handlers, root.handlers = root.handlers, [_QueueHandler(log_queue)]
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+
+
+def stop_logging():
+    global listener
+    if listener is not None:
+        logging.getLogger().handlers = previous_handlers
+        listener.stop()
+        listener = None
+
+
+def redact(value, max_length: int = None, depth: int = 0):
+    max_length = max_length or settings.log_max_length
+    if depth >= MAX_DEPTH:
+        return '...'
+    if isinstance(value, dict):
+        items = list(value.items())
+        result = {key: '***' if str(key).lower() in REDACTED_KEYS else redact(item, max_length, depth + 1)
+                  for key, item in items[:MAX_ITEMS]}
+        if len(items) > MAX_ITEMS:
+            result['...'] = f'{len(items) - MAX_ITEMS} more'
+        return result
+    if isinstance(value, (list, tuple)):
+        result = [redact(item, max_length, depth + 1) for item in value[:MAX_ITEMS]]
+        if len(value) > MAX_ITEMS:
+            result.append(f'... {len(value) - MAX_ITEMS} more')
+        return result
+    if isinstance(value, str) and len(value) > max_length:
+        return value[:max_length] + '...'
+    return value
+
+
+def method_level(method) -> int:
+    return logging.getLevelName(settings.log_method_levels.get(method, settings.log_level).upper())
+
+
+@asynccontextmanager
+async def logging_middleware(ctx: jsonrpc.JsonRpcContext):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        request = ctx.raw_request if isinstance(ctx.raw_request, dict) else {}
+        response = ctx.raw_response or {}
+        method = request.get('method')
+        # Only failures are always logged; expected errors (not modified, rate limited, ...) are sampled like
+        # any other call, or a flood of them would flood the log too.
+        if ctx.is_unhandled_exception:
+            level = logging.ERROR
+        elif random.random() < settings.log_sample_rate:
+            level = method_level(method)
+        else:
+            level = None
+        if level is not None and logger.isEnabledFor(level):
+            fields = {'method': method, 'id': request.get('id'),
+                      'duration_ms': round((time.perf_counter() - start) * 1000, 2)}
+            if 'error' in response:
+                fields['error'] = redact(response['error'])
+            if settings.log_payloads:
+                fields['params'] = redact(request.get('params'))
+                fields['result'] = redact(response.get('result'))
+            logger.log(level, 'jsonrpc call', extra={'fields': fields})
@@ -0,0 +1,42 @@
+import fastapi_jsonrpc as jsonrpc
+from fastapi.dependencies.utils import solve_dependencies
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse
+
+
+class MethodRoute(jsonrpc.MethodRoute):
+    def __init__(self, *args, trusted_result: bool = False, **kwargs):
+        kwargs.setdefault('response_class', ORJSONResponse)
+        super().__init__(*args, **kwargs)
+        self.trusted_result = trusted_result
+
+    async def handle_req(self, http_request, background_tasks, sub_response, ctx, dependency_cache=None,
+                         shared_dependencies_error=None):
+        if not self.trusted_result:
+            return await super().handle_req(http_request, background_tasks, sub_response, ctx,
+                                            dependency_cache=dependency_cache,
+                                            shared_dependencies_error=shared_dependencies_error)
+
+        # Same as the parent, minus serialize_response: the result is built by crud from plain
+        # json types and datetimes, so it goes to orjson as is. The OpenAPI schema still comes
+        # from the return annotation.
+        await ctx.enter_middlewares(self.middlewares)
+        if shared_dependencies_error:
+            raise shared_dependencies_error
+        values, errors, background_tasks, _, _ = await solve_dependencies(
+            request=http_request,
+            dependant=self.func_dependant,
+            body=ctx.request.params,
+            background_tasks=background_tasks,
+            response=sub_response,
+            dependency_overrides_provider=self.dependency_overrides_provider,
+            dependency_cache=dependency_cache.copy(),
+        )
+        if errors:
+            raise jsonrpc.invalid_params_from_validation_error(RequestValidationError(errors))
+        result = await jsonrpc.call_sync_async(self.func, **values)
+        return {'jsonrpc': '2.0', 'result': result}
+
+
+class Entrypoint(jsonrpc.Entrypoint):
+    method_route_class = MethodRoute
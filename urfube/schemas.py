@@ -2,7 +2,7 @@ import datetime
 from typing import Any
 
 import peewee
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from pydantic.utils import GetterDict
 
 
@@ -80,6 +80,7 @@ class VideoReturn(BaseModel):
 class CommentUpload(BaseModel):
     content: str
     video_id: int
+    parent_id: int | None = None
 
 
 class VideoComment(BaseModel):
@@ -88,6 +89,9 @@ class VideoComment(BaseModel):
     id: int
     created: datetime.datetime
     profile_link: str
+    parent_id: int | None
+    depth: int
+    reply_count: int
 
 
 class Comment(CommentUpload):
@@ -123,3 +127,20 @@ class ChannelInfo(BaseModel):
     subscribers: int
     videos: int
     profile_link: str
+
+
+class PlaybackEvent(BaseModel):
+    video_id: int
+    # Seconds: where the player is, how much was played since the previous report, and the video's duration.
+    position: float = Field(ge=0)
+    watched: float = Field(ge=0)
+    length: float = Field(gt=0)
+    started: bool = False
+
+
+class AnalyticsBucket(BaseModel):
+    start: datetime.datetime
+    views: int
+    viewers: int
+    watch_time: float
+    completion: float
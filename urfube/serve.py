@@ -0,0 +1,41 @@
+"""Production entry point.
+
+Usage: python -m urfube.serve [--host 0.0.0.0] [--port 80] [--workers N]
+
+Runs N uvicorn worker processes (WORKERS from the environment by default). On SIGTERM uvicorn stops
+accepting connections, finishes in-flight requests and then runs the app's shutdown hook in every worker.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+
+import uvicorn
+
+
+def prepare_metrics_dir():
+    # Workers are separate processes; prometheus_client only aggregates them through files in this directory,
+    # which has to be set before any worker imports it and must not hold files from a previous run.
+    directory = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if directory is None:
+        directory = os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='urfube-metrics-')
+    else:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=80)
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WORKERS', 1)))
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        prepare_metrics_dir()
+    uvicorn.run('urfube.app:app', host=args.host, port=args.port, workers=args.workers, access_log=False,
+                proxy_headers=True)
+
+
+if __name__ == '__main__':
+    main()
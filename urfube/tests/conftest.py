@@ -0,0 +1,74 @@
+import contextlib
+
+import pytest
+from peewee import fn
+
+from urfube import app, config, database, dependencies, migrations, models, utils
+from urfube.database import PeeweeConnectionState
+
+from .support import FakeS3, QueryCountingDatabase, seed
+
+
+@pytest.fixture(scope='module', params=[3, 30])
+def seeded_db(request, tmp_path_factory):
+    test_db = QueryCountingDatabase(str(tmp_path_factory.mktemp('queries') / 'test.db'), check_same_thread=False)
+    test_db._state = PeeweeConnectionState()
+
+    def override_get_db():
+        try:
+            test_db.connect(reuse_if_open=True)
+            yield
+        finally:
+            if not test_db.is_closed():
+                test_db.close()
+
+    previous_overrides = {dependency: app.app.dependency_overrides.get(dependency)
+                          for dependency in (dependencies.get_db, dependencies.get_read_db)}
+    for dependency in previous_overrides:
+        app.app.dependency_overrides[dependency] = override_get_db
+    with test_db.bind_ctx(migrations.MODELS):
+        with test_db.connection_context():
+            migrations.create_schema(test_db)
+            seed(request.param)
+        yield test_db
+    for dependency, previous_override in previous_overrides.items():
+        if previous_override is None:
+            del app.app.dependency_overrides[dependency]
+        else:
+            app.app.dependency_overrides[dependency] = previous_override
+
+
+@pytest.fixture
+def searchable_db(seeded_db, monkeypatch):
+    # SQLite has no full-text types: the vector is the lower-cased text, and "@@" becomes MATCH, which calls match().
+    monkeypatch.setattr(config.settings, 'search_trigram', False)
+    monkeypatch.setitem(seeded_db._operations, '@@', 'MATCH')
+    seeded_db.register_function(lambda language, query: query.lower(), 'websearch_to_tsquery', 2)
+    seeded_db.register_function(lambda vector, query: (vector or '').count(query), 'ts_rank_cd', 2)
+    seeded_db.register_function(lambda query, vector: query in (vector or ''), 'match', 2)
+    with seeded_db.connection_context():
+        models.Video.update(search_vector=fn.LOWER(models.Video.title.concat(' ').concat(models.Video.description))) \
+            .execute()
+    return seeded_db
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    fake = FakeS3({})
+
+    @contextlib.asynccontextmanager
+    async def get_s3_client():
+        yield fake
+
+    monkeypatch.setattr(utils, 'get_s3_client', get_s3_client)
+    return fake
+
+
+@pytest.fixture
+def run_with_seeded_db(seeded_db, monkeypatch):
+    # Background jobs run on the seeded database rather than opening a connection of their own.
+    def run_with_connection(func, *args):
+        with seeded_db.connection_context():
+            return func(*args)
+
+    monkeypatch.setattr(database, 'run_with_connection', run_with_connection)
@@ -0,0 +1,59 @@
+import datetime
+import unittest.mock
+
+import peewee
+
+from urfube import models, recommendations, trending, utils
+from urfube.database import QueryLogMixin, WriteHookMixin
+
+
+class QueryCountingDatabase(WriteHookMixin, QueryLogMixin, peewee.SqliteDatabase):
+    pass
+
+
+password = 'sfamjisoer345'
+
+
+def seed(size: int):
+    now = datetime.datetime.now()
+    hashed_password = utils.get_hashed_password(password)
+    channels = [f'channel{i}' for i in range(1, size + 1)]
+    models.User.insert_many([{'username': username, 'password': hashed_password}
+                             for username in ['viewer', 'newchannel', *channels]]).execute()
+    # Video 1 belongs to a channel the viewer neither follows nor has watched or liked.
+    videos = [{'title': 'new video', 'description': '', 'author': 'newchannel', 'user': 2, 'created': now}]
+    videos += [{'title': f'video {i}', 'description': '', 'author': 'channel1', 'user': 3, 'created': now}
+               for i in range(size)]
+    videos += [{'title': f'video of {channel}', 'description': '', 'author': channel, 'user': user_id, 'created': now}
+               for user_id, channel in enumerate(channels[1:], start=4)]
+    models.Video.insert_many(videos).execute()
+    video_ids = range(2, len(videos) + 1)
+    models.Like.insert_many([{'user': 1, 'video': video_id} for video_id in video_ids]).execute()
+    models.History.insert_many([{'user': 1, 'video_id': video_id, 'timestamp': 10, 'length': 100}
+                                for video_id in video_ids]).execute()
+    models.Subscription.insert_many([{'subscriber': 1, 'channel': user_id}
+                                     for user_id in range(3, size + 3)]).execute()
+    models.Comment.insert_many([{'content': f'comment {i}', 'user': 3 + i % size, 'video': 1, 'created': now}
+                                for i in range(size)]).execute()
+    trending.update_trending_scores()
+    recommendations.build_recommendations()
+
+
+class FakeS3:
+    def __init__(self, objects):
+        self.objects = objects
+        self.downloads = 0
+        self.deleted = []
+
+    async def get_object(self, Bucket, Key):
+        from botocore.exceptions import ClientError
+        self.downloads += 1
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        body = unittest.mock.AsyncMock()
+        body.__aenter__.return_value.read.return_value = self.objects[Key]
+        return {'Body': body}
+
+    async def delete_objects(self, Bucket, Delete):
+        self.deleted.append([item['Key'] for item in Delete['Objects']])
+        return {}
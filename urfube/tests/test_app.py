@@ -1,10 +1,24 @@
+import asyncio
+import datetime
+import io
+import logging
+import queue
+import unittest.mock
+
 import peewee
 import pytest
+from fastapi import Response
 from fastapi.testclient import TestClient
+from peewee import fn
+from PIL import Image
+from prometheus_client import REGISTRY
 
-from urfube import app, errors, utils, dependencies
+from urfube import (analytics, app, archive, cleanup, config, crud, database, dependencies, errors, events, images, inbox,
+                    limits, media_cache, models, recommendations, request_logging, utils)
 from urfube.crud import *
-from urfube.database import PeeweeConnectionState
+from urfube.database import PeeweeConnectionState, ReplicaRouter
+
+from .support import QueryCountingDatabase, password
 
 test_db = peewee.SqliteDatabase('urfube/tests/test.db', check_same_thread=False)
 test_db._state = PeeweeConnectionState()
@@ -31,6 +45,7 @@ def override_get_db():
 
 
 app.app.dependency_overrides[dependencies.get_db] = override_get_db
+app.app.dependency_overrides[dependencies.get_read_db] = override_get_db
 client = TestClient(app.app)
 
 
@@ -63,6 +78,30 @@ def test_create_user():
     assert utils.verify_password('sfamjisoer345', user.password) is True
 
 
+def test_request_log_redaction():
+    data = request_logging.redact({'user': user['user'], 'videos': list(range(100)), 'title': 'x' * 1000})
+    assert data['user'] == {'username': 'JohnDoe', 'password': '***'}
+    assert len(data['videos']) == request_logging.MAX_ITEMS + 1
+    assert len(data['title']) < 1000
+
+
+def test_request_logging_runs_with_the_app():
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    assert not any(isinstance(handler, request_logging._QueueHandler) for handler in handlers)
+    request_logging.start_logging()
+    try:
+        assert [type(handler) for handler in root.handlers] == [request_logging._QueueHandler]
+    finally:
+        request_logging.stop_logging()
+    assert root.handlers == handlers
+    handler = request_logging._QueueHandler(queue.Queue(1))
+    dropped = REGISTRY.get_sample_value('urfube_log_records_dropped_total')
+    for _ in range(3):
+        handler.handle(logging.makeLogRecord({'msg': 'call'}))
+    assert REGISTRY.get_sample_value('urfube_log_records_dropped_total') == dropped + 2
+
+
 def test_create_same_user():
     response = client.post(url, json=get_json_rpc_body('signup', {
         'user': {
@@ -315,6 +354,20 @@ def test_get_comments():
     assert data == [{'content': 'not cool!', 'author': 'JohnDoe', 'id': 1}]
 
 
+def test_get_comments_not_modified():
+    response = client.post(url, json=get_json_rpc_body('get_comments', {'video_id': 1}))
+    etag = response.headers['ETag']
+    response = client.post(url, json=get_json_rpc_body('get_comments', {'video_id': 1}),
+                           headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    data = response.json()['error']
+    assert data['code'] == errors.NotModifiedError.CODE
+    assert data['message'] == errors.NotModifiedError.MESSAGE
+    response = client.get('/videos/1/comments/', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+
+
 def test_get_wrong_comments():
     response = client.post(url, json=get_json_rpc_body('get_comments', {'video_id': 2}))
     assert response.status_code == 200
@@ -480,3 +533,424 @@ def test_remove_same_like():
     data = response.json()['error']
     assert data['code'] == errors.LikeDoesNotExistError.CODE
     assert data['message'] == errors.LikeDoesNotExistError.MESSAGE
+
+
+def test_recommendations_build_incrementally(seeded_db):
+    with seeded_db.connection_context():
+        recommendations.build_recommendations(full=True)
+        before = {(row[0], row[1]): row[2] for row in models.CoOccurrence.select().tuples()}
+        models.History.insert_many([{'user': 2, 'video_id': video_id, 'timestamp': 1, 'length': 10}
+                                    for video_id in (1, 2)]).execute()
+        models.Like.insert_many([{'user': 2, 'video': video_id} for video_id in (1, 2)]).execute()
+        recommendations.build_recommendations()
+        # A row with a lower id than counted ones, as when a concurrent insert commits late, is still counted.
+        late_id = models.History.select(fn.MIN(models.History.id)).scalar() - 1
+        models.History.insert(id=late_id, user=2, video_id=3, timestamp=1, length=10).execute()
+        recommendations.build_recommendations()
+        incremental = {(row[0], row[1]): row[2] for row in models.CoOccurrence.select().tuples()}
+        recommended = set(models.Recommendation.select().tuples())
+        recommendations.build_recommendations(full=True)
+        rebuilt = {(row[0], row[1]): row[2] for row in models.CoOccurrence.select().tuples()}
+        assert recommended == set(models.Recommendation.select().tuples())
+    assert incremental[(1, 2)] > before.get((1, 2), 0)
+    assert incremental[(2, 3)] > before.get((2, 3), 0)
+    assert incremental == rebuilt
+    response = client.post(url, json=get_json_rpc_body('get_recommendations', {'video_id': 1}))
+    assert response.json()['result'][0]['id'] == 2
+
+
+def test_search_videos(searchable_db):
+    response = client.post(url, json=get_json_rpc_body('search_videos', {'query': 'New'}))
+    assert [video['id'] for video in response.json()['result']] == [1]
+    response = client.post(url, json=get_json_rpc_body('search_videos', {'query': 'video', 'per_page': 2}))
+    assert len(response.json()['result']) == 2
+
+
+def test_subscription_inbox(seeded_db, monkeypatch):
+    monkeypatch.setattr(config.settings, 'subscription_inbox', True)
+    monkeypatch.setattr(config.settings, 'inbox_fan_out_limit', 1)
+    monkeypatch.setattr(config.settings, 'inbox_size', 2)
+    headers = {'User-Auth-Token': utils.create_access_token({'sub': 'viewer', 'scopes': []})}
+    with seeded_db.connection_context():
+        inbox.rebuild()
+        assert models.InboxEntry.select().where(models.InboxEntry.user == 1).count() == 2
+        models.Subscription.insert_many([{'subscriber': 2, 'channel': 4}]).on_conflict_ignore().execute()
+        big_channel_video = models.Video.create(title='big', description='', author='channel2', user=4,
+                                                created=datetime.datetime.now())
+        small_channel_video = models.Video.create(title='small', description='', author='channel3', user=5,
+                                                  created=datetime.datetime.now())
+        assert inbox.fan_out_video(big_channel_video.id) == 0
+        assert models.User.get_by_id(4).merge_on_read
+        assert inbox.fan_out_video(small_channel_video.id) == 1
+        inboxed = models.InboxEntry.select(models.InboxEntry.video).where(models.InboxEntry.user == 1)
+        assert small_channel_video.id in [entry.video_id for entry in inboxed] and inboxed.count() == 2
+    response = client.post(url, json=get_json_rpc_body('get_subscription_videos', {}), headers=headers)
+    feed = [video['id'] for video in response.json()['result']]
+    assert feed == [small_channel_video.id, big_channel_video.id]
+
+
+def test_events_pushed_to_subscribers(seeded_db, monkeypatch):
+    monkeypatch.setattr(config.settings, 'trending_interval_seconds', 0)
+    monkeypatch.setattr(config.settings, 'cleanup_interval_seconds', 0)
+    monkeypatch.setattr(config.settings, 'analytics_interval_seconds', 0)
+    monkeypatch.setattr(config.settings, 'events_backend', 'memory')
+    # Startup would otherwise create the schema in Postgres and open an S3 client; the requests use seeded_db.
+    monkeypatch.setattr(app, 'prepare_database', lambda: None)
+    monkeypatch.setattr(utils, 'open_s3_client', unittest.mock.AsyncMock())
+    # The JSON-RPC job scheduler was created on the event loop of an earlier request; start a fresh one.
+    monkeypatch.setattr(app.api, 'scheduler', None)
+    headers = {'User-Auth-Token': utils.create_access_token({'sub': 'viewer', 'scopes': []})}
+    with TestClient(app.app) as live_client, live_client.websocket_connect('/events') as websocket:
+        websocket.send_json({'subscribe': ['video:3', 'channel:newchannel', 'bogus']})
+        live_client.post(url, json=get_json_rpc_body('add_comment', {'comment': {'content': 'hi', 'video_id': 3}}),
+                         headers=headers)
+        live_client.post(url, json=get_json_rpc_body('post_like', {'video_id': 1}), headers=headers)
+        live_client.post(url, json=get_json_rpc_body('remove_like', {'video_id': 3}), headers=headers)
+        message = websocket.receive_json()
+        assert (message['topic'], message['event'], message['content']) == ('video:3', 'comment_added', 'hi')
+        assert websocket.receive_json() == {'topic': 'video:3', 'event': 'likes', 'delta': -1}
+        # Only an unsubscribe that removed something changes the count.
+        with seeded_db.connection_context():
+            models.Subscription.insert(subscriber=1, channel=2).on_conflict_ignore().execute()
+        for _ in range(2):
+            live_client.post(url, json=get_json_rpc_body('unsubscribe', {'channel': 'newchannel'}), headers=headers)
+        live_client.post(url, json=get_json_rpc_body('add_comment', {'comment': {'content': 'bye', 'video_id': 3}}),
+                         headers=headers)
+        assert websocket.receive_json() == {'topic': 'channel:newchannel', 'event': 'subscribers', 'delta': -1}
+        assert websocket.receive_json()['content'] == 'bye'
+    assert not events.broker.topics
+
+
+def test_replica_router_ejects_unreachable_replicas(seeded_db, tmp_path, monkeypatch):
+    monkeypatch.setattr(config.settings, 'replica_hosts', ['down', 'behind', 'up'])
+    router = ReplicaRouter()
+    down = QueryCountingDatabase(str(tmp_path / 'missing' / 'replica.db'))
+    behind = QueryCountingDatabase(str(tmp_path / 'behind.db'))
+    up = QueryCountingDatabase(str(tmp_path / 'replica.db'))
+    router.replicas = [down, behind, up]
+    router.lag = lambda replica: 60 if replica is behind else 0
+    for _ in range(3):
+        assert router.connect() is up
+        up.close()
+    assert down in router.ejected_until and behind in router.ejected_until and behind.is_closed()
+
+    monkeypatch.setattr(database, 'db', seeded_db)
+    monkeypatch.setattr(database, 'replicas', router)
+    monkeypatch.setattr(database, 'recent_writers', database.RecentWriters())
+    viewer = utils.create_access_token({'sub': 'viewer', 'scopes': []})
+    other = utils.create_access_token({'sub': 'other', 'scopes': []})
+
+    async def request(token, sql):
+        response = Response()
+        await dependencies.track_writes(response, token)
+        with seeded_db.connection_context():
+            seeded_db.execute_sql(sql)
+        return response
+
+    # Logging in or failing to write does not make reads sticky; a write does, for that user only.
+    assert 'set-cookie' not in asyncio.run(request(viewer, 'SELECT 1')).headers
+    with pytest.raises(peewee.OperationalError):
+        asyncio.run(request(viewer, 'UPDATE missing SET id = 1'))
+    assert 'viewer' not in database.recent_writers
+    response = asyncio.run(request(viewer, 'UPDATE video SET views = views WHERE id = 0'))
+    assert f'{dependencies.PRIMARY_COOKIE}=viewer' in response.headers['set-cookie']
+    assert 'viewer' in database.recent_writers and 'other' not in database.recent_writers
+
+    def reads_from(primary, token):
+        for _ in dependencies.get_read_db(primary=primary, token=token):
+            target = up if seeded_db.is_closed() else seeded_db
+        return target
+
+    # Without a cookie this worker still remembers the writer; other workers go by the cookie.
+    assert reads_from(None, viewer) is seeded_db and reads_from(None, other) is up
+    monkeypatch.setattr(database, 'recent_writers', database.RecentWriters())
+    assert reads_from('viewer', viewer) is seeded_db
+    assert reads_from('viewer', other) is up and reads_from('viewer', None) is up
+
+
+def test_batch_writes(seeded_db):
+    headers = {'User-Auth-Token': utils.create_access_token({'sub': 'viewer', 'scopes': []})}
+    response = client.post(url, json=get_json_rpc_body('post_like_batch', {'video_ids': [1, 2, 10 ** 6]}),
+                           headers=headers)
+    assert response.json()['error']['code'] == errors.VideoDoesNotExistError.CODE
+    history = [{'video_id': 1, 'timestamp': timestamp, 'length': 100} for timestamp in (20, 30)]
+    response = client.post(url, json=get_json_rpc_body('add_or_update_history_batch', {'videos': history}),
+                           headers=headers)
+    assert 'error' not in response.json()
+    with seeded_db.connection_context():
+        assert [row.timestamp for row in models.History.select().where(models.History.user == 1,
+                                                                        models.History.video_id == 1)] == [30]
+        models.Like.delete().where(models.Like.user == 1, models.Like.video == 1).execute()
+    response = client.post(url, json=get_json_rpc_body('post_like_batch', {'video_ids': [1, 1, 2]}), headers=headers)
+    assert 'error' not in response.json()
+    with seeded_db.connection_context():
+        assert models.Like.select().where(models.Like.user == 1, models.Like.video.in_([1, 2])).count() == 2
+
+
+def test_library_ordered_by_recency(seeded_db):
+    headers = {'User-Auth-Token': utils.create_access_token({'sub': 'viewer', 'scopes': []})}
+    with seeded_db.connection_context():
+        models.Like.delete().where(models.Like.user == 1, models.Like.video == 3).execute()
+    client.post(url, json=get_json_rpc_body('post_like', {'video_id': 3}), headers=headers)
+    client.post(url, json=get_json_rpc_body('add_or_update_history',
+                                            {'video': {'video_id': 3, 'timestamp': 50, 'length': 100}}),
+                headers=headers)
+    for method in ('get_liked_videos', 'get_user_history'):
+        response = client.post(url, json=get_json_rpc_body(method, {'per_page': 2}), headers=headers)
+        videos = response.json()['result']
+        assert len(videos) == 2 and videos[0]['id'] == 3
+        assert videos[0]['progress'] == 0.5
+        response = client.post(url, json=get_json_rpc_body(method, {'page': 2, 'per_page': 1}), headers=headers)
+        assert response.json()['result'][0]['id'] == videos[1]['id']
+
+
+def test_comment_threads(seeded_db):
+    headers = {'User-Auth-Token': utils.create_access_token({'sub': 'viewer', 'scopes': []})}
+    with seeded_db.connection_context():
+        video = models.Video.create(title='discussed', description='', author='viewer', user=1,
+                                    created=datetime.datetime.now())
+
+    def comment(content, parent_id=None):
+        response = client.post(url, json=get_json_rpc_body('add_comment', {'comment': {
+            'content': content, 'video_id': video.id, 'parent_id': parent_id}}), headers=headers)
+        assert 'error' not in response.json()
+        with seeded_db.connection_context():
+            return models.Comment.select(fn.MAX(models.Comment.id)).scalar()
+
+    first, second = comment('first'), comment('second')
+    reply = comment('reply', first)
+    nested = comment('nested', reply)
+    late = comment('late reply', first)
+    comment('answer', second)
+    response = client.post(url, json=get_json_rpc_body('get_comments', {'video_id': video.id, 'per_page': 1,
+                                                                        'replies': 2}))
+    comments = response.json()['result']
+    assert [(c['content'], c['parent_id'], c['depth']) for c in comments] == [
+        ('first', None, 0), ('reply', first, 1), ('nested', reply, 2)]
+    assert comments[0]['reply_count'] == 2
+    response = client.post(url, json=get_json_rpc_body('get_comment_replies', {'comment_id': first, 'after': nested}))
+    assert [c['id'] for c in response.json()['result']] == [late]
+    response = client.post(url, json=get_json_rpc_body('get_comment_replies', {'comment_id': second, 'after': nested}))
+    assert response.json()['error']['code'] == errors.CommentDoesNotExistError.CODE
+
+    client.post(url, json=get_json_rpc_body('delete_comment', {'comment_id': reply}), headers=headers)
+    response = client.post(url, json=get_json_rpc_body('get_comments', {'video_id': video.id}))
+    assert [(c['content'], c['reply_count']) for c in response.json()['result']] == [
+        ('first', 1), ('late reply', 0), ('second', 1), ('answer', 0)]
+
+
+def test_old_history_is_archived(seeded_db, monkeypatch):
+    monkeypatch.setattr(config.settings, 'history_retention_days', 30)
+    monkeypatch.setattr(config.settings, 'history_archive_batch_size', 2)
+    now = datetime.datetime.now()
+    with seeded_db.connection_context():
+        user = models.User.create(username='forgetful', password=password)
+        models.History.insert_many([{'user': user.id, 'video_id': video_id, 'timestamp': 1, 'length': 10,
+                                     'updated': now - datetime.timedelta(days=days)}
+                                    for video_id, days in ((1, 40), (2, 31), (3, 1))]).execute()
+        assert archive.archive_history(now) == 2
+        assert [row.video_id for row in models.History.select().where(models.History.user == user.id)] == [3]
+        archived = models.HistoryArchive.select().where(models.HistoryArchive.user_id == user.id)
+        assert {row.video_id for row in archived} == {1, 2}
+        assert archive.archive_history(now) == 0
+
+
+def test_content_addressed_media_links(seeded_db, monkeypatch):
+    monkeypatch.setattr(config.settings, 'public_media_url', 'https://cdn.example.com/urfube/')
+    etag = client.post(url, json=get_json_rpc_body('get_videos', {})).headers['etag']
+    with seeded_db.connection_context():
+        models.Video.update(image_hash='ab12', image_variants='small,medium,large') \
+            .where(models.Video.id == 1).execute()
+        models.User.update(avatar_hash='cd34', avatar_updated=datetime.datetime.now()) \
+            .where(models.User.username == 'newchannel').execute()
+    response = client.post(url, json=get_json_rpc_body('get_videos', {}))
+    assert response.headers['etag'] != etag
+    videos = {video['id']: video for video in response.json()['result']}
+    assert videos[1]['image_link'] == 'https://cdn.example.com/urfube/images/ab12-medium.webp'
+    assert videos[1]['profile_link'] == 'https://cdn.example.com/urfube/profiles/cd34.jpg'
+    assert 'images/2.jpg?' in videos[2]['image_link']
+
+
+def test_image_variants():
+    source = io.BytesIO()
+    Image.new('RGB', (2000, 1000), 'red').save(source, 'PNG')
+    variants = images.transcode(source.getvalue(), 'profiles')
+    assert list(variants) == ['small', 'medium', 'large']
+    for size, data in variants.items():
+        with Image.open(io.BytesIO(data)) as variant:
+            assert variant.format == 'WEBP'
+            assert variant.size[0] == images.VARIANTS['profiles'][size]
+    try:
+        assert asyncio.run(images.make_variants(b'not an image', 'images')) is None
+    finally:
+        images.shutdown_pool()
+
+
+def test_invalid_profile_pic_is_rejected(seeded_db):
+    headers = {'User-Auth-Token': utils.create_access_token({'sub': 'viewer', 'scopes': []})}
+    response = client.post('/upload_profile_pic/', headers=headers,
+                           files={'image_file': ('avatar.png', b'not an image', 'image/png')})
+    assert response.status_code == 400
+    assert response.json() == errors.InvalidImageError.MESSAGE
+
+
+def test_media_cache(s3, tmp_path, monkeypatch):
+    first, second = 'a' * 64 + '-small.webp', 'b' * 64 + '.jpg'
+    s3.objects.update({f'public/images/{first}': b'0123456789', f'public/images/{second}': b'abcdefghij'})
+    monkeypatch.setattr(config.settings, 'media_cache_dir', str(tmp_path))
+    monkeypatch.setattr(config.settings, 'media_cache_max_bytes', 15)
+    monkeypatch.setattr(media_cache, 'cache', None)
+    response = client.get(f'/media/images/{first}')
+    assert response.content == b'0123456789' and response.headers['content-type'] == 'image/webp'
+    assert client.get(f'/media/images/{first}', headers={'Range': 'bytes=2-4'}).content == b'234'
+    response = client.get(f'/media/images/{first}', headers={'Range': 'bytes=-3'})
+    assert (response.status_code, response.headers['content-range']) == (206, 'bytes 7-9/10')
+    assert client.get(f'/media/images/{first}', headers={'Range': 'bytes=10-'}).status_code == 416
+    assert client.get(f'/media/images/{first}', headers={'If-None-Match': f'"{first}"'}).status_code == 304
+    assert s3.downloads == 1
+    assert client.get(f'/media/images/{second}').content == b'abcdefghij'
+    assert not (tmp_path / f'images-{first}').exists()
+    # A file evicted while it is being served (here or by another worker) is still sent whole.
+    file = asyncio.run(media_cache.cache.get('images', second))
+    (tmp_path / f'images-{second}').unlink()
+    with file:
+        assert file.read() == b'abcdefghij'
+    # One larger than the whole cache is still served, once.
+    monkeypatch.setattr(media_cache.cache, 'max_bytes', 5)
+    assert client.get(f'/media/images/{first}').content == b'0123456789' and s3.downloads == 3
+    assert client.get('/media/images/' + 'c' * 64 + '.jpg').status_code == 404
+    assert client.get('/media/images/..%2Fsecret').status_code == 404
+
+
+def test_duplicate_uploads_share_one_object(seeded_db):
+    reader = utils.HashingReader(io.BytesIO(b'same clip'))
+    while reader.read(4):
+        pass
+    with seeded_db.connection_context():
+        first, second = [models.Video.create(title=f'clip {i}', description='', author='viewer', user=1,
+                                             created=datetime.datetime.now()) for i in range(2)]
+        assert crud.deduplicate_video(first, reader.hexdigest()) is None
+        assert crud.deduplicate_video(second, reader.hexdigest()) == f'videos/{first.id}.mp4'
+    response = client.post(url, json=get_json_rpc_body('generate_video_link', {'video_id': second.id}))
+    assert f'videos/{first.id}.mp4?' in response.json()['result']
+
+
+def test_deleted_videos_are_purged(seeded_db, s3, run_with_seeded_db, monkeypatch):
+    monkeypatch.setattr(config.settings, 'cleanup_batch_size', 2)
+    headers = {'User-Auth-Token': utils.create_access_token({'sub': 'viewer', 'scopes': []})}
+    with seeded_db.connection_context():
+        video = models.Video.create(title='to delete', description='', author='viewer', user=1, image_hash='ef',
+                                    image_variants='small', created=datetime.datetime.now())
+        models.Like.insert_many([{'user': user_id, 'video': video.id} for user_id in (1, 2, 3)]).execute()
+        models.Comment.insert_many([{'content': 'bye', 'user': 1, 'video': video.id,
+                                     'created': datetime.datetime.now()}] * 3).execute()
+        models.History.create(user=1, video_id=video.id, timestamp=1, length=10)
+    response = client.post(url, json=get_json_rpc_body('delete_video', {'video_id': 1}), headers=headers)
+    assert response.json()['error']['code'] == errors.PermissionError.CODE
+    response = client.post(url, json=get_json_rpc_body('delete_video', {'video_id': video.id}), headers=headers)
+    assert 'error' not in response.json()
+    response = client.post(url, json=get_json_rpc_body('get_video_info', {'video_id': video.id}))
+    assert response.json()['error']['code'] == errors.VideoDoesNotExistError.CODE
+
+    assert asyncio.run(cleanup.purge_deleted_videos()) == 1
+    assert s3.deleted == [[f'videos/{video.id}.mp4', 'public/images/ef.jpg', 'public/images/ef-small.webp']]
+    with seeded_db.connection_context():
+        assert models.Video.get_or_none(models.Video.id == video.id) is None
+        for field in cleanup.DEPENDENTS:
+            assert not field.model.select().where(field == video.id).exists()
+    s3.deleted.clear()
+    assert asyncio.run(utils.delete_objects('jurmaev', [str(key) for key in range(2500)])) == []
+    assert [len(batch) for batch in s3.deleted] == [1000, 1000, 500]
+
+
+def test_purging_a_duplicate_keeps_the_original(seeded_db, s3, run_with_seeded_db):
+    with seeded_db.connection_context():
+        original, duplicate = [models.Video.create(title=f'same clip {i}', description='', author='viewer', user=1,
+                                                   created=datetime.datetime.now()) for i in range(2)]
+        crud.deduplicate_video(original, 'ab' * 32)
+        assert crud.deduplicate_video(duplicate, 'ab' * 32) == f'videos/{original.id}.mp4'
+        crud.delete_video(duplicate.id)
+        # The title is free again before the purge runs.
+        assert crud.get_video_by_title('same clip 1') is None
+    assert asyncio.run(cleanup.purge_deleted_videos()) == 1
+    assert s3.deleted == [[f'images/{duplicate.id}.jpg']]
+    with seeded_db.connection_context():
+        crud.delete_video(original.id)
+    assert asyncio.run(cleanup.purge_deleted_videos()) == 1
+    assert s3.deleted[-1] == [f'videos/{original.id}.mp4', f'images/{original.id}.jpg']
+
+
+def test_playback_analytics(seeded_db):
+    with seeded_db.connection_context():
+        video = models.Video.create(title='analysed', description='', author='viewer', user=1,
+                                    created=datetime.datetime.now())
+        analytics.update_analytics()
+    sessions = {
+        'viewer': [{'video_id': video.id, 'position': 0, 'watched': 0, 'length': 100, 'started': True},
+                   {'video_id': video.id, 'position': 40, 'watched': 40, 'length': 100}],
+        'newchannel': [{'video_id': video.id, 'position': 0, 'watched': 0, 'length': 100, 'started': True},
+                       {'video_id': video.id, 'position': 120, 'watched': 100, 'length': 100}],
+    }
+    for username, events in sessions.items():
+        headers = {'User-Auth-Token': utils.create_access_token({'sub': username, 'scopes': []})}
+        response = client.post(url, json=get_json_rpc_body('post_playback_events', {'events': events}), headers=headers)
+        assert 'error' not in response.json()
+        with seeded_db.connection_context():
+            analytics.update_analytics()
+    headers = {'User-Auth-Token': utils.create_access_token({'sub': 'viewer', 'scopes': []})}
+    for period in ('hour', 'day'):
+        response = client.post(url, json=get_json_rpc_body('get_channel_analytics',
+                                                           {'period': period, 'video_id': video.id}), headers=headers)
+        [bucket] = response.json()['result']
+        assert (bucket['views'], bucket['viewers'], bucket['watch_time'], bucket['completion']) == (2, 2, 140, 0.7)
+    # An event whose id is below already rolled up ones, as when a concurrent insert commits late, still counts.
+    with seeded_db.connection_context():
+        event = models.PlaybackEvent.select().where(models.PlaybackEvent.video_id == video.id).get()
+        late_id = models.PlaybackEvent.select(fn.MIN(models.PlaybackEvent.id)).scalar() - 1
+        models.PlaybackEvent.insert(id=late_id, video_id=video.id, user_id=2, hour=event.hour, position=0, watched=10,
+                                    length=100, started=True).execute()
+        assert analytics.update_analytics() == 1
+        assert models.VideoStats.get(video_id=video.id, period='hour').views == 3
+    response = client.post(url, json=get_json_rpc_body('get_channel_analytics', {'video_id': 1}), headers=headers)
+    assert response.json()['error']['code'] == errors.PermissionError.CODE
+
+
+def test_admission_limits(seeded_db, monkeypatch, caplog):
+    caplog.set_level('INFO', logger='urfube.requests')
+    monkeypatch.setattr(config.settings, 'log_sample_rate', 1)
+    monkeypatch.setattr(limits, 'buckets', None)
+    monkeypatch.setattr(limits, 'slots', {})
+    monkeypatch.setattr(config.settings, 'rate_limits', {'default': (0, 0), 'login': (0.01, 2),
+                                                         'upload_profile_pic': (1, 0)})
+    monkeypatch.setattr(config.settings, 'concurrency_limits', {'get_likes': 0})
+    monkeypatch.setattr(config.settings, 'concurrency_queue_timeout', 0.01)
+    login = get_json_rpc_body('login', {'user': {'username': 'viewer', 'password': password}})
+    assert ['error' in client.post(url, json=login).json() for _ in range(3)] == [False, False, True]
+    error = client.post(url, json=login).json()['error']
+    assert error['code'] == errors.RateLimitError.CODE and error['data']['retry_after'] > 90
+    # Limits are per client: a signed-in user has buckets of their own.
+    headers = {'User-Auth-Token': utils.create_access_token({'sub': 'viewer', 'scopes': []})}
+    assert 'error' not in client.post(url, json=login, headers=headers).json()
+    response = client.post(url, json=get_json_rpc_body('get_likes', {'video_id': 2}))
+    assert response.json()['error']['code'] == errors.OverloadedError.CODE
+    response = client.post('/upload_profile_pic/', headers=headers,
+                           files={'image_file': ('avatar.png', b'not an image', 'image/png')})
+    assert response.status_code == 429 and response.headers['Retry-After'] == '1'
+    # Turned away before the logging middleware: a flood of rejections doesn't flood the log.
+    logged = [record.fields.get('error', {}).get('code') for record in caplog.records if hasattr(record, 'fields')]
+    assert errors.RateLimitError.CODE not in logged and errors.OverloadedError.CODE not in logged
+    assert logged
+
+
+def test_concurrency_slots_survive_giving_up():
+    async def contend():
+        semaphore = asyncio.Semaphore(1)
+        assert await limits.acquire(semaphore, 0.01)
+        assert not await limits.acquire(semaphore, 0.01)
+        semaphore.release()
+        # With no time to wait, acquire() may or may not get to run; a slot it took is either returned or held.
+        acquired = await limits.acquire(semaphore, 0)
+        await asyncio.sleep(0)
+        return acquired, semaphore._value
+    acquired, free = asyncio.run(contend())
+    assert free == (0 if acquired else 1)
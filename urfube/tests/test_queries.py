@@ -0,0 +1,134 @@
+import datetime
+
+import peewee
+import pytest
+from fastapi.testclient import TestClient
+
+from urfube import app, cleanup, config, crud, inbox, models, trending, utils
+from urfube.database import record_queries
+
+from .support import password
+
+client = TestClient(app.app)
+url = '/api'
+
+
+def get_json_rpc_body(method, params):
+    return {
+        'jsonrpc': '2.0',
+        'id': 0,
+        'method': method,
+        'params': params
+    }
+
+
+# Read methods first: the write methods below change the seeded rows they touch.
+BUDGETS = [
+    ('get_videos', {}, False, 2),
+    ('get_user_history', {}, True, 2),
+    ('get_liked_videos', {}, True, 2),
+    ('get_subscription_videos', {}, True, 2),
+    ('get_channel_videos', {'channel': 'channel1'}, False, 2),
+    ('get_trending_videos', {}, False, 1),
+    ('get_recommendations', {'video_id': 2}, False, 1),
+    ('get_channel_info', {'channel': 'channel1'}, False, 4),
+    ('get_comments', {'video_id': 1}, False, 3),
+    ('get_comment_replies', {'comment_id': 1}, False, 2),
+    ('get_likes', {'video_id': 2}, False, 2),
+    ('get_like', {'video_id': 2}, True, 3),
+    ('get_video_info', {'video_id': 2}, False, 1),
+    ('generate_video_link', {'video_id': 2}, False, 1),
+    ('get_subscribers', {'channel': 'channel1'}, False, 2),
+    ('is_subscribed', {'channel': 'channel1'}, True, 3),
+    ('login', {'user': {'username': 'viewer', 'password': password}}, False, 1),
+    ('signup', {'user': {'username': 'newuser', 'password': password}}, False, 2),
+    ('post_view', {'video_id': 2}, True, 3),
+    ('add_or_update_history', {'video': {'video_id': 1, 'timestamp': 5, 'length': 100}}, True, 2),
+    ('add_or_update_history_batch', {'videos': [{'video_id': 1, 'timestamp': 6, 'length': 100},
+                                                {'video_id': 2, 'timestamp': 7, 'length': 100}]}, True, 3),
+    ('add_comment', {'comment': {'content': 'great video!', 'video_id': 1}}, True, 4),
+    ('edit_comment', {'comment_id': 1, 'new_content': 'not cool!'}, True, 3),
+    ('delete_comment', {'comment_id': 2}, True, 3),
+    ('post_like', {'video_id': 1}, True, 5),
+    ('remove_like', {'video_id': 2}, True, 4),
+    ('subscribe', {'channel': 'newchannel'}, True, 3),
+    ('unsubscribe', {'channel': 'channel1'}, True, 3),
+    ('post_like_batch', {'video_ids': [1, 2, 3]}, True, 4),
+    ('subscribe_batch', {'channels': ['newchannel', 'channel1', 'channel2']}, True, 3),
+    ('post_playback_events', {'events': [{'video_id': 1, 'position': 0, 'watched': 0, 'length': 100, 'started': True},
+                                         {'video_id': 2, 'position': 5, 'watched': 5, 'length': 100}]}, True, 3),
+    ('get_channel_analytics', {}, True, 2),
+]
+
+
+@pytest.mark.parametrize('method, params, auth, budget', BUDGETS, ids=[budget[0] for budget in BUDGETS])
+def test_query_budget(seeded_db, method, params, auth, budget):
+    headers = {'User-Auth-Token': utils.create_access_token({'sub': 'viewer', 'scopes': []})} if auth else {}
+    with record_queries() as log:
+        response = client.post(url, json=get_json_rpc_body(method, params), headers=headers)
+    assert response.status_code == 200
+    assert 'error' not in response.json()
+    assert len(log) <= budget, '\n'.join(log.queries)
+
+
+def test_refresh_tokens_query_budget(seeded_db):
+    refresh_token = utils.create_refresh_token({'sub': 'viewer', 'scopes': []})
+    with record_queries() as log:
+        response = client.post(url, json=get_json_rpc_body('refresh_tokens', {'refresh_token': refresh_token}))
+    assert 'error' not in response.json()
+    assert len(log) <= 1, '\n'.join(log.queries)
+
+
+def test_search_query_budget(searchable_db):
+    with record_queries() as log:
+        response = client.post(url, json=get_json_rpc_body('search_videos', {'query': 'New'}))
+    assert 'error' not in response.json()
+    assert len(log) <= 1, '\n'.join(log.queries)
+
+
+def test_inbox_query_budget(seeded_db, monkeypatch):
+    monkeypatch.setattr(config.settings, 'subscription_inbox', True)
+    headers = {'User-Auth-Token': utils.create_access_token({'sub': 'viewer', 'scopes': []})}
+    with seeded_db.connection_context():
+        inbox.rebuild()
+        # A channel too big to fan out is merged in when the feed is read.
+        models.User.update(merge_on_read=True).where(models.User.username == 'channel2').execute()
+    with record_queries() as log:
+        response = client.post(url, json=get_json_rpc_body('get_subscription_videos', {}), headers=headers)
+    assert 'error' not in response.json()
+    assert len(log) <= 3, '\n'.join(log.queries)
+
+
+def test_comment_thread_query_budget(seeded_db):
+    with seeded_db.connection_context():
+        viewer = models.User.get(models.User.username == 'viewer')
+        reply = crud.add_comment('reply', 1, viewer, models.Comment.get_by_id(1))
+        crud.add_comment('nested', 1, viewer, reply)
+    with record_queries() as log:
+        response = client.post(url, json=get_json_rpc_body('get_comments', {'video_id': 1, 'replies': 2}))
+    assert 'error' not in response.json()
+    assert len(log) <= 3, '\n'.join(log.queries)
+
+
+def test_trending_scores_only_rewrite_changed_videos(seeded_db):
+    now = datetime.datetime.now()
+    with seeded_db.connection_context():
+        trending.update_trending_scores(now)
+        assert trending.update_trending_scores(now) == 0
+        for _ in range(3):
+            crud.add_view(1)
+        # Only videos with new activity are counted again.
+        with record_queries() as log:
+            assert trending.update_trending_scores(now + datetime.timedelta(hours=1)) == 1
+        assert all('IN (?)' in query for query in log.queries if 'COUNT' in query)
+    response = client.post(url, json=get_json_rpc_body('get_trending_videos', {'per_page': 1}))
+    assert [video['id'] for video in response.json()['result']] == [1]
+
+
+def test_purge_lookups_are_indexed():
+    for field in cleanup.DEPENDENTS:
+        meta = field.model._meta
+        leading = [index._expressions[0] for index in meta.fields_to_index()]
+        if isinstance(meta.primary_key, peewee.CompositeKey):
+            leading.append(meta.fields[meta.primary_key.field_names[0]])
+        assert field.primary_key or field in leading, field
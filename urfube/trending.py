@@ -0,0 +1,102 @@
+import asyncio
+import datetime
+import logging
+import math
+
+import peewee
+from peewee import fn
+
+from urfube import database, models
+from urfube.config import settings
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime.datetime(2023, 1, 1)
+BATCH_SIZE = 1000
+# Arbitrary constant, so only one worker refreshes the table at a time.
+LOCK_ID = 7233
+NO_ACTIVITY = -1e9
+
+
+def decay_offset(now: datetime.datetime):
+    # Scores decay by half every half-life; instead of rewriting every row each run, new activity is worth
+    # 2 ** (hours since EPOCH / half-life) and scores are stored as log2, which keeps the order the same.
+    return (now - EPOCH).total_seconds() / 3600 / settings.trending_half_life_hours
+
+
+def add_log_scores(a: float, b: float):
+    high, low = max(a, b), min(a, b)
+    return high + math.log2(1 + 2 ** (low - high))
+
+
+def take_pending():
+    # Cleared before counting, so activity landing meanwhile marks the video again for the next run.
+    video_ids = [video_id for video_id, in models.Video.select(models.Video.id)
+                 .where(models.Video.trending_pending == True).tuples()]
+    for start in range(0, len(video_ids), BATCH_SIZE):
+        models.Video.update(trending_pending=False).where(
+            models.Video.id.in_(video_ids[start:start + BATCH_SIZE])).execute()
+    return video_ids
+
+
+def counters(video_ids: list[int]):
+    for start in range(0, len(video_ids), BATCH_SIZE):
+        batch = video_ids[start:start + BATCH_SIZE]
+        likes = dict(models.Like.select(models.Like.video, fn.COUNT(models.Like.user))
+                     .where(models.Like.video.in_(batch)).group_by(models.Like.video).tuples())
+        comments = dict(models.Comment.select(models.Comment.video, fn.COUNT(models.Comment.id))
+                        .where(models.Comment.video.in_(batch)).group_by(models.Comment.video).tuples())
+        previous = {row[0]: row[1:] for row in models.TrendingScore.select(
+            models.TrendingScore.video, models.TrendingScore.score, models.TrendingScore.views,
+            models.TrendingScore.likes, models.TrendingScore.comments)
+            .where(models.TrendingScore.video.in_(batch)).tuples()}
+        for video_id, views in models.Video.select(models.Video.id, models.Video.views).where(
+                models.Video.id.in_(batch)).tuples():
+            yield video_id, views, likes.get(video_id, 0), comments.get(video_id, 0), previous.get(video_id)
+
+
+def activity(views: int, likes: int, comments: int):
+    return (views * settings.trending_view_weight + likes * settings.trending_like_weight +
+            comments * settings.trending_comment_weight)
+
+
+def update_trending_scores(now: datetime.datetime | None = None):
+    now = now or datetime.datetime.now()
+    offset = decay_offset(now)
+    db = models.TrendingScore._meta.database
+    with db.atomic():
+        if isinstance(db, peewee.PostgresqlDatabase) and \
+                not db.execute_sql('SELECT pg_try_advisory_xact_lock(%s)', (LOCK_ID,)).fetchone()[0]:
+            return 0
+        rows = []
+        for video_id, views, likes, comments, previous in counters(take_pending()):
+            score, old_views, old_likes, old_comments = previous or (None, 0, 0, 0)
+            # Counters can go down (unlikes, deleted comments); only growth counts as activity.
+            gained = activity(max(views - old_views, 0), max(likes - old_likes, 0), max(comments - old_comments, 0))
+            if score is not None and (views, likes, comments) == (old_views, old_likes, old_comments):
+                continue
+            if gained > 0:
+                new_score = math.log2(gained) + offset
+                score = new_score if score is None else add_log_scores(score, new_score)
+            elif score is None:
+                score = NO_ACTIVITY
+            rows.append({'video': video_id, 'score': score, 'views': views, 'likes': likes, 'comments': comments,
+                         'updated': now})
+        for start in range(0, len(rows), BATCH_SIZE):
+            (models.TrendingScore.insert_many(rows[start:start + BATCH_SIZE])
+             .on_conflict(conflict_target=[models.TrendingScore.video],
+                          preserve=[models.TrendingScore.score, models.TrendingScore.views,
+                                    models.TrendingScore.likes, models.TrendingScore.comments,
+                                    models.TrendingScore.updated])
+             .execute())
+    return len(rows)
+
+
+async def run_periodically():
+    while True:
+        try:
+            updated = await asyncio.to_thread(database.run_with_connection, update_trending_scores)
+            logger.info('trending scores updated for %d videos', updated)
+        except Exception:
+            logger.exception('trending update failed')
+        await asyncio.sleep(settings.trending_interval_seconds)
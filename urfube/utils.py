@@ -1,23 +1,34 @@
+import asyncio
+import functools
+import hashlib
 import logging
+import time
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
-from botocore.exceptions import ClientError
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 
 from urfube.config import settings
+from urfube.metrics import S3_LATENCY
 from urfube.schemas import *
 
-import aioboto3
+PRESIGNED_URL_EXPIRATION = 3600
+s3_client = None
+s3_client_context = None
 
-pwd_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
+
+# passlib and aioboto3 are imported on first use: together they are most of the app's import time.
+@functools.cache
+def get_pwd_context():
+    from passlib.context import CryptContext
+    return CryptContext(schemes=['bcrypt'], deprecated='auto')
 
 
 def get_hashed_password(password: str) -> str:
-    return pwd_context.hash(password)
+    return get_pwd_context().hash(password)
 
 
 def verify_password(password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(password, hashed_password)
+    return get_pwd_context().verify(password, hashed_password)
 
 
 def create_access_token(token_data: dict, expires_delta: int = None) -> str:
@@ -43,6 +54,24 @@ def create_refresh_token(token_data: dict, expires_delta: int = None) -> str:
     return encoded_jwt
 
 
+def make_etag(*parts) -> str:
+    # Weak tag: responses embed presigned links that differ byte-wise between calls.
+    digest = hashlib.blake2b(repr(parts).encode(), digest_size=12).hexdigest()
+    return f'W/"{digest}"'
+
+
+def etag_matches(etag: str, if_none_match: str | None) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags
+
+
+def link_epoch(expiration: int = PRESIGNED_URL_EXPIRATION) -> int:
+    # Rolls over at half the link lifetime so a cached response never holds expired links.
+    return int(time.time()) // (expiration // 2)
+
+
 class ProgressBar:
     def __init__(self, filesize):
         self.current_value = 0
@@ -52,11 +81,82 @@ class ProgressBar:
         self.current_value += chunk
 
 
-async def upload_fileobj(fileobj, bucket, key, filesize):
-    session = aioboto3.Session()
-    async with session.client("s3", endpoint_url='https://storage.yandexcloud.net',
-                              aws_access_key_id=settings.aws_access_key_id,
-                              aws_secret_access_key=settings.aws_secret_access_key) as s3:
+def create_s3_client():
+    import aioboto3
+    return aioboto3.Session().client('s3', endpoint_url=settings.s3_endpoint_url,
+                                     aws_access_key_id=settings.aws_access_key_id,
+                                     aws_secret_access_key=settings.aws_secret_access_key)
+
+
+async def open_s3_client():
+    global s3_client, s3_client_context
+    s3_client_context = await asyncio.to_thread(create_s3_client)
+    s3_client = await s3_client_context.__aenter__()
+
+
+async def close_s3_client():
+    global s3_client, s3_client_context
+    if s3_client_context is not None:
+        s3_client = None
+        await s3_client_context.__aexit__(None, None, None)
+        s3_client_context = None
+
+
+@asynccontextmanager
+async def get_s3_client():
+    # The shared client lives on the event loop that opened it at startup; without one, use a short-lived client.
+    if s3_client is not None:
+        yield s3_client
+    else:
+        async with create_s3_client() as s3:
+            yield s3
+
+
+class HashingReader:
+    # Hashes a file while an upload reads it, so spotting duplicates takes no extra pass over the file.
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+
+PUBLIC_MEDIA_PREFIX = 'public'
+IMMUTABLE_MEDIA_ARGS = {'CacheControl': 'public, max-age=31536000, immutable', 'ContentType': 'image/jpeg'}
+IMMUTABLE_VARIANT_ARGS = {**IMMUTABLE_MEDIA_ARGS, 'ContentType': 'image/webp'}
+
+
+def media_key(kind: str, name, digest: str | None = None, size: str | None = None) -> str:
+    # Images uploaded before content addressing only exist at their mutable key.
+    if digest is None:
+        return f'{kind}/{name}.jpg'
+    if size is not None:
+        return f'{PUBLIC_MEDIA_PREFIX}/{kind}/{digest}-{size}.webp'
+    return f'{PUBLIC_MEDIA_PREFIX}/{kind}/{digest}.jpg'
+
+
+async def create_media_links(keys: list[str]) -> dict[str, str | None]:
+    links = {}
+    if settings.public_media_url:
+        # Content-addressed objects never change: the link is a plain, permanently cacheable URL.
+        base = settings.public_media_url.rstrip('/')
+        prefix = f'{PUBLIC_MEDIA_PREFIX}/'
+        links = {key: f'{base}/{key.removeprefix(prefix)}' for key in keys if key.startswith(prefix)}
+    private = [key for key in keys if key not in links]
+    if private:
+        links.update(await create_presigned_urls('jurmaev', private))
+    return links
+
+
+async def upload_fileobj(fileobj, bucket, key, filesize, extra_args=None):
+    from botocore.exceptions import ClientError
+    async with get_s3_client() as s3:
         progress_bar = ProgressBar(filesize)
 
         def upload_progress(chunk):
@@ -64,22 +164,67 @@ async def upload_fileobj(fileobj, bucket, key, filesize):
             logging.info(progress_bar.current_value / progress_bar.filesize)
 
         try:
-            await s3.upload_fileobj(fileobj, bucket, key, Callback=upload_progress)
+            with S3_LATENCY.labels('upload').time():
+                await s3.upload_fileobj(fileobj, bucket, key, ExtraArgs=extra_args, Callback=upload_progress)
         except ClientError:
             return False
         return True
 
 
-async def create_presigned_url(bucket: str, object_name: str, expiration=3600):
-    session = aioboto3.Session()
-    async with session.client("s3", endpoint_url='https://storage.yandexcloud.net',
-                              aws_access_key_id=settings.aws_access_key_id,
-                              aws_secret_access_key=settings.aws_secret_access_key) as s3:
+async def delete_object(bucket, key):
+    from botocore.exceptions import ClientError
+    async with get_s3_client() as s3:
         try:
-            response = await s3.generate_presigned_url('get_object',
-                                                       Params={'Bucket': bucket,
-                                                               'Key': f'{object_name}'},
+            with S3_LATENCY.labels('delete').time():
+                await s3.delete_object(Bucket=bucket, Key=key)
+        except ClientError:
+            return False
+        return True
+
+
+async def delete_objects(bucket, keys: list[str]) -> list[str]:
+    # DeleteObjects takes at most 1000 keys per call; returns the keys that could not be deleted.
+    from botocore.exceptions import ClientError
+    failed = []
+    async with get_s3_client() as s3:
+        for start in range(0, len(keys), 1000):
+            batch = keys[start:start + 1000]
+            try:
+                with S3_LATENCY.labels('delete').time():
+                    response = await s3.delete_objects(Bucket=bucket, Delete={
+                        'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+            except ClientError:
+                failed += batch
+                continue
+            failed += [error['Key'] for error in response.get('Errors', [])]
+    return failed
+
+
+async def create_presigned_urls(bucket: str, object_names: list[str], expiration=PRESIGNED_URL_EXPIRATION):
+    from botocore.exceptions import ClientError
+    object_names = list(dict.fromkeys(object_names))
+    async with get_s3_client() as s3:
+        async def sign(object_name):
+            try:
+                return await s3.generate_presigned_url('get_object', Params={'Bucket': bucket, 'Key': object_name},
                                                        ExpiresIn=expiration)
+            except ClientError:
+                return None
+
+        with S3_LATENCY.labels('sign').time():
+            links = await asyncio.gather(*map(sign, object_names))
+    return dict(zip(object_names, links))
+
+
+async def create_presigned_url(bucket: str, object_name: str, expiration=PRESIGNED_URL_EXPIRATION):
+    from botocore.exceptions import ClientError
+    async with get_s3_client() as s3:
+        try:
+            with S3_LATENCY.labels('sign').time():
+                response = await s3.generate_presigned_url('get_object',
+                                                           Params={'Bucket': bucket,
+                                                                   'Key': f'{object_name}'},
+                                                           ExpiresIn=expiration)
         except ClientError:
             return None
         return response